@@ -0,0 +1,140 @@
+import logging
+from collections import namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+# Adaptive batching settings. Every batch limit moves between its bounds; the
+# upper count bounds are the fixed batch sizes used before.
+rpc_batch_count_bounds = (1, 5)
+execution_batch_count_bounds = (10, 200)
+file_watcher_batch_count_bounds = (10, 2000)
+batch_bytes_bounds = (72 * 1024, 4 * 1024 * 1024)  # JSON body of one email
+execution_linger_bounds = (0, 2)  # Seconds a part-filled execution batch waits to fill up
+target_send_latency = 5  # Seconds; slower SMTP sends shrink the batches
+failure_rate_limit = 0.2  # Batches only grow while fewer sends fail than this
+latency_smoothing = 0.2  # Weight of the newest send in the moving averages
+
+BatchLimits = namedtuple("BatchLimits", ["count", "max_bytes", "linger"])
+
+
+def clamp(value, bounds):
+    return max(bounds[0], min(bounds[1], value))
+
+
+class BatchController:
+    """
+    Tunes the batch limits of one lane from how its sends go.
+
+    Limits start at the lower bounds and double with every full batch sent
+    within target_send_latency (slow start), then grow by a quarter. A send
+    slower than the target shrinks them by a quarter, a failed send halves
+    them and ends slow start. Full batches mean backlog, so they grow under
+    load and settle where SMTP latency stays on target.
+
+    While sends are slow and the backlog is small, a part-filled batch waits
+    up to the smoothed send latency (within the linger bounds) to fill up,
+    so a trickle of records does not cost one email each. Latency-sensitive
+    work waiting elsewhere (RPCs) cancels the wait and caps the count at the
+    lower bound, so the send slot is free again soon.
+    """
+
+    def __init__(self, name, count_bounds, bytes_bounds=None, linger_bounds=(0, 0)):
+        self.name = name
+        self.count_bounds = count_bounds
+        self.bytes_bounds = bytes_bounds or batch_bytes_bounds
+        self.linger_bounds = linger_bounds
+        self.count = count_bounds[0]
+        self.max_bytes = self.bytes_bounds[0]
+        self.slow_start = True
+        self.send_latency = None  # Smoothed seconds per successful send
+        self.failure_rate = 0.0
+        self.sends = 0
+
+    def get_limits(self, backlog=None, urgent=False):
+        """
+        :param backlog: Records waiting in this lane, if known.
+        :param urgent: True while latency-sensitive work waits for the slot.
+        :return: BatchLimits for the next batch.
+        """
+        if urgent:
+            return BatchLimits(self.count_bounds[0], self.max_bytes, self.linger_bounds[0])
+        if backlog is not None and backlog >= self.count:
+            linger = self.linger_bounds[0]  # A full batch is ready
+        else:
+            linger = clamp(self.send_latency or 0, self.linger_bounds)
+        return BatchLimits(self.count, self.max_bytes, linger)
+
+    def record_send(self, seconds, ok, records, size):
+        """
+        :param seconds: How long the SMTP send took.
+        :param ok: Whether the email was sent.
+        :param records: Records in the batch.
+        :param size: Bytes of the batch's JSON body.
+        """
+        self.sends += 1
+        self.failure_rate += latency_smoothing * ((0.0 if ok else 1.0) - self.failure_rate)
+        if not ok:
+            self.slow_start = False
+            self.resize(0.5)
+            return
+
+        if self.send_latency is None:
+            self.send_latency = seconds
+        else:
+            self.send_latency += latency_smoothing * (seconds - self.send_latency)
+
+        full = records >= self.count or size >= self.max_bytes * 0.9
+        if seconds > target_send_latency:
+            self.slow_start = False
+            self.resize(0.75)
+        elif full and self.failure_rate < failure_rate_limit:
+            self.resize(2 if self.slow_start else 1.25)
+
+    def resize(self, factor):
+        previous = self.count
+        # Growing always adds at least one record, or small counts never grow
+        count = int(self.count * factor)
+        if factor > 1:
+            count = max(count, self.count + 1)
+        self.count = clamp(count, self.count_bounds)
+        self.max_bytes = clamp(int(self.max_bytes * factor), self.bytes_bounds)
+        if self.count != previous:
+            logger.debug(f"Batch limit of {self.name}: {previous} -> {self.count} records.")
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "max_bytes": self.max_bytes,
+            "send_latency": self.send_latency,
+            "failure_rate": round(self.failure_rate, 3),
+            "sends": self.sends,
+        }
+
+
+batch_controllers = {}
+
+
+def get_batch_controller(name):
+    """
+    :param name: "rpc", "executions" or "file_watcher".
+    :return: The process's controller for the lane.
+    """
+    controller = batch_controllers.get(name)
+    if controller is None:
+        if name == "rpc":
+            controller = BatchController(name, rpc_batch_count_bounds)
+        elif name == "file_watcher":
+            controller = BatchController(
+                name, file_watcher_batch_count_bounds, linger_bounds=execution_linger_bounds
+            )
+        else:
+            controller = BatchController(
+                name, execution_batch_count_bounds, linger_bounds=execution_linger_bounds
+            )
+        batch_controllers[name] = controller
+    return controller
+
+
+def get_batching_stats():
+    return {name: controller.as_dict() for name, controller in batch_controllers.items()}
@@ -0,0 +1,172 @@
+import atexit
+import asyncio
+import logging
+import threading
+from collections import deque
+
+from .nadoo_connect import (
+    get_execution_data,
+    setup_directories,
+    spool_execution,
+    start_sender_loop_if_not_running,
+)
+from .nadoo_spool import SpoolFullError, spill_execution_to_summary
+
+
+logger = logging.getLogger(__name__)
+
+# Client settings
+client_flush_batch_size = 500  # Executions written to the spool per flush
+client_flush_linger = 0.05  # Seconds a started batch waits to fill up
+client_exit_timeout = 10  # Seconds close (and the exit hook) waits for the last flush
+
+
+class ExecutionClient:
+    """
+    Thread-safe synchronous front end for create_execution.
+
+    create_execution only stamps the execution and appends it to an in-memory
+    queue. One background thread runs an event loop that writes the queue to
+    the spool in batches and checks for a sender once per batch, instead of a
+    new event loop per call. close, which also runs at interpreter exit,
+    writes whatever is still queued.
+
+    Executions are accepted before the spool quota is checked, so the reject
+    policy cannot reach the caller: a record the spool refuses is folded into
+    an overflow summary like under the spill policy.
+
+    :param overflow_policy: Spool overflow policy for the flushes, see create_execution.
+    :param block_timeout: Seconds the block policy waits for room.
+    """
+
+    def __init__(self, overflow_policy=None, block_timeout=None):
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.queue = deque()  # Appends and pops are atomic, so producers need no lock
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.wakeup = None
+        self.closing = False
+
+    def create_execution(self, customer_program_uuid):
+        """
+        Queues an execution for the spool without waiting for any I/O.
+
+        :return: The execution UUID.
+        """
+        if self.closing:
+            raise RuntimeError("ExecutionClient is closed")
+        execution_data = get_execution_data(customer_program_uuid)
+        self.queue.append(execution_data)
+        if self.thread is None:
+            self.start()
+        # Wake the flusher for a new batch, or a full one; a spurious wakeup is harmless
+        if len(self.queue) in (1, client_flush_batch_size):
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return execution_data["execution_uuid"]
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.wakeup = asyncio.Event()
+            self.thread = threading.Thread(
+                target=self.loop.run_until_complete,
+                args=(self.flush_loop(),),
+                name="nadoo-connect-client",
+                daemon=True,
+            )
+            self.thread.start()
+            atexit.register(self.close)
+
+    async def flush_loop(self):
+        # Flushes must not need the default executor: the exit hook runs after it shut down
+        setup_directories()
+        loop = asyncio.get_running_loop()
+        while not (self.closing and not self.queue):
+            if not self.queue:
+                await self.wakeup.wait()
+            # Let the batch fill up; only a full batch or close ends this early
+            deadline = loop.time() + client_flush_linger
+            while len(self.queue) < client_flush_batch_size and not self.closing:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            self.wakeup.clear()
+            try:
+                await self.flush_batch()
+            except Exception as e:
+                logger.error(f"Error spooling queued executions: {e!r}")
+
+    async def flush_batch(self):
+        batch = []
+        while self.queue and len(batch) < client_flush_batch_size:
+            batch.append(self.queue.popleft())
+        for execution_data in batch:
+            try:
+                await spool_execution(execution_data, self.overflow_policy, self.block_timeout)
+            except SpoolFullError:
+                spill_execution_to_summary(execution_data)
+        if batch:
+            logger.debug(f"Spooled {len(batch)} queued executions.")
+            start_sender_loop_if_not_running()
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything queued so far is in the spool.
+        """
+        if self.thread is None:
+            return
+
+        async def flush_all():
+            while self.queue:
+                await self.flush_batch()
+
+        asyncio.run_coroutine_threadsafe(flush_all(), self.loop).result(timeout)
+
+    def close(self, timeout=None):
+        """
+        Writes the remaining queue and stops the background thread.
+        """
+        with self.lock:
+            self.closing = True
+            if self.thread is None:
+                return
+        atexit.unregister(self.close)
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+            self.thread.join(client_exit_timeout if timeout is None else timeout)
+        if self.thread.is_alive():
+            logger.warning(f"Closed with {len(self.queue)} executions not yet spooled.")
+        else:
+            self.loop.close()
+
+
+default_client = None
+default_client_lock = threading.Lock()
+
+
+def get_execution_client():
+    # One client per process, created on first use
+    global default_client
+    if default_client is None:
+        with default_client_lock:
+            if default_client is None:
+                default_client = ExecutionClient()
+    return default_client
+
+
+def create_execution_sync(customer_program_uuid):
+    """
+    Records that a customer program was used, from synchronous code.
+
+    Returns immediately; the shared ExecutionClient spools the execution in the
+    background and writes what is left when the interpreter exits.
+
+    :return: The execution UUID.
+    """
+    return get_execution_client().create_execution(customer_program_uuid)
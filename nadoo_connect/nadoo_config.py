@@ -0,0 +1,154 @@
+import os
+import time
+import logging
+import threading
+from types import MappingProxyType
+from collections.abc import Mapping
+
+from dotenv import dotenv_values
+
+
+logger = logging.getLogger(__name__)
+
+# Config settings
+config_path = ".env"
+config_check_interval = 1  # Seconds between checks of the .env mtime
+required_config_vars = []  # Prompted for when missing
+# Typed fields are converted and validated when a snapshot is built; any other
+# key is kept as a string.
+config_fields = {
+    "SMTP_PORT": int,
+    "IMAP_PORT": int,
+    "POP3_PORT": int,
+    "MAX_INFLIGHT_BATCHES": int,
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class ConfigSnapshot(Mapping):
+    """
+    An immutable view of the configuration: the .env values, overridden by
+    the environment, with typed fields converted. Behaves like the config
+    dict it replaces.
+    """
+
+    def __init__(self, values, version=None):
+        typed = {}
+        for key, value in values.items():
+            field_type = config_fields.get(key)
+            if field_type is not None and value not in (None, ""):
+                try:
+                    value = field_type(value)
+                except (TypeError, ValueError):
+                    raise ConfigError(f"Invalid value for {key}: {value!r}")
+            typed[key] = value
+        self.values = MappingProxyType(typed)
+        self.version = version  # (mtime_ns, size) of the file it was read from
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return f"ConfigSnapshot({sorted(self.values)})"  # Values may be passwords
+
+
+current_snapshot = None
+next_check = 0.0
+reload_lock = threading.Lock()
+applied_values = {}  # Values this module copied from .env into os.environ
+
+
+def get_config_version(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def read_env_file(path):
+    """
+    :return: The key/value pairs of an env file; comments and lines
+        without "=" are skipped.
+    """
+    if not os.path.exists(path):
+        return {}
+    return {key: value for key, value in dotenv_values(path).items() if value is not None}
+
+
+def load_config_snapshot(path=None):
+    path = path or config_path
+    version = get_config_version(path)
+    values = read_env_file(path)
+    for key, value in values.items():
+        external = os.environ.get(key)
+        if external is not None and applied_values.get(key) != external:
+            continue  # Set outside .env; the environment wins, as with load_dotenv
+        # Keeps os.getenv users (transport and retention settings) in step with .env
+        os.environ[key] = applied_values[key] = value
+    keys = set(values) | set(config_fields) | set(required_config_vars)
+    values.update({key: os.environ[key] for key in keys if key in os.environ})
+    return ConfigSnapshot(values, version)
+
+
+def get_config_snapshot():
+    """
+    :return: The current ConfigSnapshot. Loaded once per process and only
+        rebuilt when the .env file changes; reads take no lock.
+    """
+    global current_snapshot, next_check
+    snapshot = current_snapshot
+    now = time.monotonic()
+    if snapshot is not None and now < next_check:
+        return snapshot
+    with reload_lock:
+        if current_snapshot is not snapshot:
+            return current_snapshot  # Reloaded by another thread meanwhile
+        next_check = now + config_check_interval
+        if snapshot is not None and get_config_version(config_path) == snapshot.version:
+            return snapshot
+        try:
+            current_snapshot = load_config_snapshot()
+        except ConfigError as e:
+            if snapshot is None:
+                raise
+            logger.error(f"Keeping the previous configuration: {e}")
+            return snapshot
+        return current_snapshot
+
+
+def reload_config():
+    global next_check
+    next_check = 0.0
+    return get_config_snapshot()
+
+
+def save_missing_config_to_env(config, path=None):
+    """
+    Appends the given values that .env does not already hold.
+    """
+    path = path or config_path
+    existing_config = read_env_file(path)
+    missing = {
+        var: value
+        for var, value in config.items()
+        if value is not None and existing_config.get(var) != str(value)
+    }
+    if not missing:
+        return
+    with open(path, "a+") as env_file:
+        if env_file.tell():
+            env_file.seek(env_file.tell() - 1)
+            if env_file.read(1) != "\n":
+                env_file.write("\n")  # Keeps the last line intact
+        for var, value in missing.items():
+            env_file.write(f"{var}={value}\n")
@@ -1,20 +1,90 @@
 import os
+import sys
 import json
 import sqlite3
 import uuid
-import portalocker
 import time
 from datetime import datetime
-from dotenv import load_dotenv
 from tkinter import simpledialog, Tk
 import logging
 import asyncio
 import aiofiles
+import multiprocessing
 from multiprocessing import Process
 import aiofiles.os as async_os  # Correct import statement for async_os
 import traceback
 
 from .nadoo_email import *
+from .nadoo_config import (
+    get_config_snapshot,
+    reload_config,
+    required_config_vars,
+    save_missing_config_to_env,
+)
+from .nadoo_retention import retention_loop
+from .nadoo_scheduler import (
+    create_default_scheduler,
+    get_oldest_pending_age,
+    wait_for_new_work,
+)
+from .nadoo_leader import (
+    claim_spawn,
+    clear_heartbeat,
+    heartbeat_interval,
+    heartbeat_loop,
+    is_sender_alive,
+    liveness_cache_ttl,
+    release_spawn_claim,
+    try_acquire_leadership,
+    write_file_exclusive,
+    write_heartbeat,
+)
+from .nadoo_instrumentation import dump_all_task_stacks, instrumentation_loop
+from .nadoo_rpc import (
+    coalesce_rpc_call,
+    get_rpc_request_path,
+    reply_observers,
+    release_inflight_request,
+    rpc_reply_listener,
+    stage_or_join_rpc_request,
+    stage_rpc_request,
+    wait_for_rpc_reply,
+)
+from .nadoo_storage import get_storage
+from .nadoo_batching import get_batch_controller, get_batching_stats
+from .nadoo_mime import StreamingBatchMessage
+from .nadoo_parts import (
+    message_part_size,
+    message_parts_loop,
+    save_sent_parts,
+    send_parts,
+    split_into_parts,
+)
+from .nadoo_retry import get_retry_queue
+from .nadoo_manifest import (
+    get_awaited_rpcs,
+    get_spool_manifest,
+    track_awaited_rpc,
+    track_batch,
+)
+from .nadoo_rpc_expiry import RPCDeadlines, rpc_expiry_loop
+from .nadoo_rpc_cache import get_rpc_cache_ttl, get_rpc_result_cache
+from .nadoo_tracing import BatchTrace, get_stage_percentiles, read_traced_record
+from .nadoo_lifecycle import SenderLifecycle, standby_poll_interval
+from .nadoo_inflight import dispatchers, get_dispatcher_for_email_account
+from .nadoo_spool import (
+    SpoolFullError,
+    drain_overflow_summaries,
+    get_spool_depth,
+    note_spooled,
+    reserve_spool_slot,
+    spill_execution_to_summary,
+    SpoolCursor,
+    get_spool_bucket,
+    get_spool_file_path,
+    iter_spool_files,
+    migrate_flat_spool,
+)
 
 
 # Create 'logs' directory if it doesn't exist
@@ -39,35 +109,31 @@ staged_dir = "rpc_staged"
 awaiting_response_dir = "rpc_awaiting_response"
 done_dir = "rpc_done"
 executions_dir = "executions"
-lockfile_path = os.path.join(executions_dir, "sender.lock")
+lockfile_path = os.path.join(executions_dir, "sender.lock")  # Legacy, no longer locked
+directories_ready = False  # Set once setup_directories_async has run in this process
 idle_time = 120  # Idle time in seconds before shutting down the sender loop
 max_wait_time = 120  # Maximum wait time in seconds between retries
 email_size_limit = 72 * 1024  # Email size limit in bytes (72 KB)
 sender_process = None  # To keep track of the sender process
+spool_manifest = None  # Outstanding work of this process, if it sends; see open_spool_manifest
+rpc_deadlines = None  # Reply deadlines of sent RPCs, in the sender; see start_rpc_expiry
 
 
 async def print_all_stack_traces():
-    for task in asyncio.all_tasks():
-        task.print_stack()
+    dump_all_task_stacks(file=sys.stderr)
 
 
-# Call this function at points where you want to inspect the state of all tasks
+# Call this function at points where you want to inspect the state of all tasks;
+# a running sender also dumps them on SIGUSR1 or a logs/dump_stacks trigger file.
 
 
-# Remaining functions (load_or_request_config and get_config_from_env_or_prompt) will stay the same
 async def load_or_request_config():
-    load_dotenv()
-    config = get_config_from_env_or_prompt()
-    save_missing_config_to_env(config)
-    return config
-
-
-def get_config_from_env_or_prompt():
-    required_vars = []  # Empty list for now
-    config = {var: os.getenv(var) for var in required_vars}
-    missing_configs = {var for var in required_vars if not config[var]}
+    # Cheap after the first call: the snapshot is only rebuilt when .env changes
+    config = get_config_snapshot()
+    missing_configs = {var for var in required_config_vars if not config.get(var)}
     if missing_configs:
-        config.update(request_missing_config(missing_configs))
+        save_missing_config_to_env(request_missing_config(missing_configs))
+        config = reload_config()
     return config
 
 
@@ -83,46 +149,103 @@ def request_missing_config(missing_configs):
     return config_updates
 
 
-def save_missing_config_to_env(config):
-    existing_config = {}
-    if os.path.exists(".env"):
-        with open(".env", "r") as env_file:
-            for line in env_file:
-                var, value = line.strip().split("=", 1)
-                existing_config[var] = value
-
-    with open(".env", "a") as env_file:
-        for var, value in config.items():
-            if var not in existing_config or existing_config[var] != value:
-                if value is not None:
-                    env_file.write(f"{var}={value}\n")
-
-
-def record_execution_in_db(execution_uuid, customer_program_uuid, is_sent):
-    conn = sqlite3.connect("executions.db")
-    cursor = conn.cursor()
+def setup_execution_records_table(cursor):
+    # Only takes effect on a new database; lets retention free pages incrementally
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
     cursor.execute(
         """CREATE TABLE IF NOT EXISTS execution_records 
-           (execution_uuid TEXT, customer_program_uuid TEXT, is_sent BOOLEAN)"""
+           (execution_uuid TEXT, customer_program_uuid TEXT, is_sent BOOLEAN, timestamp TEXT,
+            execution_count INTEGER DEFAULT 1)"""
     )
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(execution_records)")]
+    if "timestamp" not in columns:
+        # Databases created before retention existed have no timestamp column.
+        # Their rows are stamped with the migration time, so they age out under
+        # the normal retention limit instead of being archived on the first pass.
+        cursor.execute("ALTER TABLE execution_records ADD COLUMN timestamp TEXT")
+        cursor.execute(
+            "UPDATE execution_records SET timestamp = ? WHERE timestamp IS NULL",
+            (datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),),
+        )
+    if "execution_count" not in columns:
+        # Spilled overflow summaries stand for several executions
+        cursor.execute(
+            "ALTER TABLE execution_records ADD COLUMN execution_count INTEGER DEFAULT 1"
+        )
     cursor.execute(
-        "INSERT INTO execution_records VALUES (?, ?, ?)",
-        (execution_uuid, customer_program_uuid, is_sent),
+        """CREATE INDEX IF NOT EXISTS execution_records_timestamp
+           ON execution_records (timestamp)"""
+    )
+
+
+def insert_execution_records(conn, rows):
+    conn.executemany(
+        """INSERT INTO execution_records
+           (execution_uuid, customer_program_uuid, is_sent, timestamp, execution_count)
+           VALUES (?, ?, ?, ?, ?)""",
+        rows,
+    )
+
+
+def get_execution_row(execution_data, is_sent=True):
+    timestamp = execution_data.get("timestamp") or datetime.now().strftime(
+        "%Y-%m-%d %H:%M:%S.%f"
+    )
+    return (
+        execution_data["execution_uuid"],
+        execution_data["customer_program_uuid"],
+        is_sent,
+        timestamp,
+        execution_data.get("execution_count", 1),
+    )
+
+
+async def record_executions_in_db(rows, db_path="executions.db"):
+    # One transaction for the whole batch (rows from get_execution_row),
+    # written by the database's storage actor
+    await get_storage(db_path).write(
+        insert_execution_records, rows, setup=setup_execution_records_table
     )
-    conn.commit()
-    conn.close()
+
+
+def record_execution_in_db(
+    execution_uuid,
+    customer_program_uuid,
+    is_sent,
+    timestamp=None,
+    db_path="executions.db",
+    execution_count=1,
+):
+    # Blocking variant for callers outside the event loop
+    row = get_execution_row(
+        {
+            "execution_uuid": execution_uuid,
+            "customer_program_uuid": customer_program_uuid,
+            "timestamp": timestamp,
+            "execution_count": execution_count,
+        },
+        is_sent,
+    )
+    get_storage(db_path).submit(
+        insert_execution_records, [row], setup=setup_execution_records_table
+    ).result()
 
 
 async def setup_directories_async():
+    global directories_ready
     # Create directories if they do not exist
     for directory in [staged_dir, awaiting_response_dir, done_dir, executions_dir]:
         if not await async_os.path.exists(directory):
             await async_os.makedirs(directory)
+    directories_ready = True
 
-    # Create the lock file if it does not exist
-    if not await async_os.path.exists(lockfile_path):
-        async with aiofiles.open(lockfile_path, "a"):
-            pass  # Just opening and closing to create the file if it doesn't exist
+
+def setup_directories():
+    # For threads without the default executor, which is gone once the interpreter exits
+    global directories_ready
+    for directory in [staged_dir, awaiting_response_dir, done_dir, executions_dir]:
+        os.makedirs(directory, exist_ok=True)
+    directories_ready = True
 
 
 def inject_config(async_func):
@@ -134,63 +257,92 @@ def inject_config(async_func):
     return wrapper
 
 
-async def create_execution(customer_program_uuid, config=None):
-    await setup_directories_async()
-    execution_data = get_execution_data(customer_program_uuid)
-    await save_execution_data_async(execution_data)
+async def create_execution(
+    customer_program_uuid, config=None, overflow_policy=None, block_timeout=None
+):
+    """
+    Records that a customer program was used.
+
+    :param customer_program_uuid: The program that was used.
+    :param overflow_policy: What happens when the spool is over quota: "block"
+        waits up to block_timeout seconds for room, "reject" raises
+        SpoolFullError, "spill" folds the execution into an aggregated summary.
+        Defaults to spool_overflow_policy.
+    :raises SpoolFullError: When the record could not be stored.
+    """
+    if not directories_ready:
+        await setup_directories_async()
+    await spool_execution(get_execution_data(customer_program_uuid), overflow_policy, block_timeout)
     start_sender_loop_if_not_running()
 
 
+async def spool_execution(execution_data, overflow_policy=None, block_timeout=None):
+    # Writes one execution under the overflow policy; starting the sender is up to the caller
+    record_size = len(json.dumps(execution_data))
+    if await reserve_spool_slot(record_size, overflow_policy, block_timeout):
+        await save_execution_data_async(execution_data)
+        note_spooled(record_size)
+    else:
+        spill_execution_to_summary(execution_data)
+
+
 async def save_execution_data_async(execution_data):
-    file_path = os.path.join(executions_dir, f"{execution_data['execution_uuid']}.json")
+    # A few hundred bytes written directly are cheaper than a thread hop
     try:
-        async with aiofiles.open(file_path, "w") as file:
-            await file.write(json.dumps(execution_data))
+        save_execution_data(execution_data)
     except Exception as e:
         print(f"Error saving execution data: {e}")
 
 
-async def get_xyz_for_xyz_remote(uuid, data, config):
+async def get_xyz_for_xyz_remote(uuid, data, config=None, timeout=None, cache_ttl=None):
     """
     Sends a request for a remote procedure call and handles the response.
 
+    The request is staged for the sender, which emails it in the RPC lane; the
+    sender also receives the reply (IMAP IDLE push, or polling) and hands it
+    over through rpc_done, so this works from any process.
+
     :param uuid: The unique identifier for the remote procedure.
     :param data: The data to be sent to the remote procedure.
-    :param config: Configuration data containing SMTP details and other necessary information.
-    :return: The result from the remote procedure call.
+    :param config: Not needed anymore, the sender uses the default email account.
+    :param timeout: Seconds to wait for the reply; rpc_reply_timeout by default.
+    :param cache_ttl: Seconds a result may be reused for the same uuid and data;
+        rpc_cache_ttls[uuid] by default, no caching if neither is set.
+    :return: The result from the remote procedure call, or None if no reply
+        arrived in time.
     """
-    # Serialize the data along with the UUID to JSON
-    request_body = json.dumps({"uuid": uuid, "data": data})
-
-    # Extract SMTP configuration from the config dictionary
-    smtp_server = config["SMTP_SERVER"]
-    smtp_port = config["SMTP_PORT"]
-    email = config["EMAIL"]
-    password = config["PASSWORD"]
-    to_email = config["DESTINATION_EMAIL"]
-
-    # Send the request via email
-    email_sent = await send_email(
-        subject="RPC Request",
-        message=request_body,
-        to_email=to_email,
-        smtp_server=smtp_server,
-        smtp_port=smtp_port,
-        email=email,
-        password=password,
-    )
+    ttl = get_rpc_cache_ttl(uuid, cache_ttl)
+    if ttl:
+        return await get_rpc_result_cache().call(
+            uuid, data, ttl, lambda: request_xyz_remote(uuid, data, timeout)
+        )
+    return await request_xyz_remote(uuid, data, timeout)
 
-    if not email_sent:
-        return None  # or handle the failure as appropriate
 
-    # TODO: Implement the logic to wait and retrieve the response
-    # This depends on how your system handles receiving responses
-    # It might involve checking an inbox, a database, etc.
+async def request_xyz_remote(uuid, data, timeout=None):
+    # Identical calls share one email round trip: in this process one task,
+    # across processes one staged request, see stage_or_join_rpc_request
+    return await coalesce_rpc_call(uuid, data, lambda: send_xyz_request(uuid, data, timeout))
 
-    # For demonstration, here's a placeholder for the response
-    response = None  # Replace with actual response retrieval logic
 
-    return response
+async def send_xyz_request(uuid, data, timeout=None):
+    if not directories_ready:
+        await setup_directories_async()
+    request_uuid, inflight_path = stage_or_join_rpc_request(uuid, data)
+    if inflight_path is None:
+        logger.debug(f"Joining in-flight RPC request {request_uuid}.")
+    else:
+        start_sender_loop_if_not_running()
+
+    try:
+        reply = await wait_for_rpc_reply(request_uuid, timeout)
+    finally:
+        if inflight_path is not None:
+            release_inflight_request(inflight_path, request_uuid)
+    if reply is None:
+        logger.warning(f"No reply to RPC request {request_uuid} in time.")
+        return None
+    return reply.get("result")
 
 
 def get_execution_data(customer_program_uuid):
@@ -204,190 +356,586 @@ def get_execution_data(customer_program_uuid):
 
 
 def save_execution_data(execution_data):
-    filepath = os.path.join(executions_dir, f"{execution_data['execution_uuid']}.json")
-    with open(filepath, "w") as file:
-        json.dump(execution_data, file)
+    filepath = get_spool_file_path(execution_data["execution_uuid"])
+    content = json.dumps(execution_data)
+    try:
+        write_file_exclusive(filepath, content)
+    except FileNotFoundError:
+        # First record of a new time bucket
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        write_file_exclusive(filepath, content)
 
 
 def start_sender_loop_if_not_running():
+    # Never waits on a lock: a cached heartbeat check covers the common case,
+    # and an O_EXCL spawn claim makes sure only one producer spawns a sender.
     global sender_process
-    try:
-        logger.debug("Attempting to acquire lock before starting process...")
-        with portalocker.Lock(lockfile_path, mode="w", timeout=5):  # Increased timeout
-            if sender_process is not None and sender_process.is_alive():
-                logger.warning("A sender loop process is already running.")
-                return
-            logger.debug("Lock acquired. Starting sender loop process.")
-            sender_process = Process(target=run_sender_loop_process)
-            sender_process.start()
-    except portalocker.exceptions.LockException:
-        logger.warning("Unable to acquire lock, another process may be running.")
-
-
-async def process_rpc_requests():
-    batch_size_limit = 5  # Maximum number of requests to batch
-    max_wait_time = 5  # Maximum time to wait in seconds
-    min_wait_time = 1  # Minimum time to wait for additional requests
-    last_rpc_time = time.time()
+    if is_sender_alive(executions_dir):
+        return
+    if sender_process is not None and sender_process.is_alive():
+        return  # Spawned by this process and still starting up
+    if not claim_spawn(executions_dir):
+        return
+    logger.debug("No live sender found. Starting sender loop process.")
+    # The spawn time lets the sender report its cold start latency
+    sender_process = Process(target=spawn_detached_sender, args=(time.time(),))
+    sender_process.start()
+
+
+def spawn_detached_sender(spawn_requested_at):
+    # A sender in standby outlives its producer. multiprocessing joins a
+    # process's children at exit, so the producer only starts this short-lived
+    # launcher, which starts the sender and leaves without joining it. The
+    # sender logs to its file and must not hold the producer's stdio or any
+    # other inherited descriptor open, so it is a fresh "spawn" interpreter.
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    multiprocessing.get_context("spawn").Process(
+        target=run_sender_loop_process, args=(spawn_requested_at,)
+    ).start()
+    os._exit(0)
+
+
+async def dispatch_batch(dispatcher, keys, send, on_success, on_failure=None):
+    # With a dispatcher the batch is sent in the background and this returns as
+    # soon as it is in flight; without one it is sent inline as before.
+    if dispatcher is None:
+        email_sent = await send()
+        if email_sent:
+            await on_success()
+        elif on_failure is not None:
+            await on_failure()
+        return email_sent
+    await dispatcher.submit(keys, send, on_success, on_failure)
+    return True
+
+
+async def send_measured(batching, send, records, size):
+    # Feeds the lane's batch controller with the outcome of one send
+    started = time.monotonic()
+    email_sent = await send()
+    batching.record_send(time.monotonic() - started, email_sent, records, size)
+    return email_sent
+
+
+async def process_rpc_requests(dispatcher=None):
+    # Sends whatever is staged right now; waiting for more work is the
+    # scheduler's job, so a send slot is never held up by a linger loop.
+    batching = get_batch_controller("rpc")
+
+    rpc_files = sorted(
+        (
+            f
+            for f in os.listdir(staged_dir)
+            if f.endswith(".json")
+            and not (dispatcher and dispatcher.is_claimed(os.path.join(staged_dir, f)))
+        ),
+        key=lambda f: os.path.getmtime(os.path.join(staged_dir, f)),
+    )
+    limits = batching.get_limits(len(rpc_files))
 
     batched_rpc_data = []
-    while True:
-        current_time = time.time()
-        rpc_files = [f for f in os.listdir(staged_dir) if f.endswith(".json")]
-
-        if not rpc_files:
-            break
-
-        for filename in rpc_files:
-            filepath = os.path.join(staged_dir, filename)
-            with open(filepath, "r") as file:
-                rpc_data = json.load(file)
-                batched_rpc_data.append(rpc_data)
-                print(f"Added {filename} to batch.")
-
-            if len(batched_rpc_data) >= batch_size_limit:
-                print("Batch size limit reached.")
-                break
-
-        # Check if it's time to process the batch
-        if len(batched_rpc_data) > 0 and (
-            current_time - last_rpc_time >= max_wait_time
-        ):
-            print("Max wait time reached, processing batch.")
-            break
-        elif current_time - last_rpc_time >= min_wait_time and not rpc_files:
-            print("Min wait time reached with no new RPCs, processing batch.")
+    batched_filenames = []
+    batch_bytes = 0
+    trace = BatchTrace("rpc_")
+    for filename in rpc_files[: limits.count]:
+        filepath = os.path.join(staged_dir, filename)
+        try:
+            if os.path.getsize(filepath) > message_part_size:
+                # Too large for one email: sent alone, in parts
+                if batched_rpc_data:
+                    break
+                return await process_multipart_rpc_request(filepath, dispatcher)
+            rpc_data, created, spooled = read_traced_record(filepath)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            logger.warning(f"Skipping staged RPC {filename}: {e}")
+            continue
+        size = len(json.dumps(rpc_data)) + 2
+        if batched_rpc_data and batch_bytes + size > limits.max_bytes:
             break
+        batched_rpc_data.append(rpc_data)
+        batched_filenames.append(filename)
+        batch_bytes += size
+        trace.add(created, spooled)
 
-        await asyncio.sleep(0.1)
+    if not batched_rpc_data:
+        return False
+    trace.mark_batched()
 
     rpc_email_address = get_rpc_email_address()
-
-    default_email_account = await get_default_email_account()
-
-    # Process the batched RPC requests
-    if batched_rpc_data:
-        email_content = json.dumps(batched_rpc_data)
-        email_sent = await send_email(
-            "Batched RPC Requests",
-            email_content,
-            rpc_email_address,
-            get_smtp_server_from_email_account(default_email_account),
-            int(get_smtp_port_from_email_account(default_email_account)),
-            get_email_address_from_email_account(default_email_account),
-            get_email_address_password_from_email_account(default_email_account),
+    default_email_account = await get_cached_default_email_account()
+    email_content = json.dumps(batched_rpc_data)
+
+    async def send():
+        email_sent = await send_measured(
+            batching,
+            lambda: send_email(
+                "Batched RPC Requests",
+                email_content,
+                rpc_email_address,
+                get_smtp_server_from_email_account(default_email_account),
+                int(get_smtp_port_from_email_account(default_email_account)),
+                get_email_address_from_email_account(default_email_account),
+                get_email_address_password_from_email_account(default_email_account),
+            ),
+            len(batched_rpc_data),
+            len(email_content),
         )
-
         if email_sent:
-            # Move processed files to awaiting_response
-            for data in batched_rpc_data:
-                source_path = os.path.join(staged_dir, f"{data['uuid']}.json")
-                destination_path = os.path.join(
-                    awaiting_response_dir, f"{data['uuid']}.json"
-                )
-                os.rename(source_path, destination_path)
+            trace.mark_emailed()
+        return email_sent
+
+    async def on_success():
+        # Move processed files to awaiting_response
+        for filename in batched_filenames:
+            move_to_awaiting(os.path.join(staged_dir, filename))
+        trace.mark_recorded()
+
+    keys = [os.path.join(staged_dir, filename) for filename in batched_filenames]
+    send, on_success = track_sent_batch("rpc", keys, [], send, on_success)
+    return await dispatch_batch(dispatcher, keys, send, on_success)
+
+
+def move_to_awaiting(filepath):
+    os.rename(filepath, os.path.join(awaiting_response_dir, os.path.basename(filepath)))
+    request_uuid = os.path.basename(filepath)[: -len(".json")]
+    if rpc_deadlines is not None:
+        rpc_deadlines.track(request_uuid)  # Also journals it in the manifest
+    elif spool_manifest is not None:
+        track_awaited_rpc(spool_manifest, request_uuid)
+
+
+def track_sent_batch(lane, paths, rows, send, on_success, **details):
+    # Only a process that opened a manifest (the sender) journals its batches
+    if spool_manifest is None:
+        return send, on_success
+    return track_batch(spool_manifest, lane, paths, rows, send, on_success, **details)
+
+
+async def send_rpc_email(subject, content):
+    default_email_account = await get_cached_default_email_account()
+    return await send_email(
+        subject,
+        json.dumps(content),
+        get_rpc_email_address(),
+        get_smtp_server_from_email_account(default_email_account),
+        int(get_smtp_port_from_email_account(default_email_account)),
+        get_email_address_from_email_account(default_email_account),
+        get_email_address_password_from_email_account(default_email_account),
+    )
 
-    return len(batched_rpc_data) > 0  # Return True if any requests were processed
 
+async def send_rpc_part(part):
+    info = part["part"]
+    return await send_rpc_email(f"RPC Request Part {info['index'] + 1}/{info['count']}", part)
 
-async def process_execution_requests(execution_files):
-    batch_size_limit = 200
-    batched_execution_data = []
 
-    for filename in execution_files[:batch_size_limit]:
-        filepath = os.path.join(executions_dir, filename)
-        with open(filepath, "r") as file:
-            execution_data = json.load(file)
-            batched_execution_data.append(execution_data)
+async def process_multipart_rpc_request(filepath, dispatcher=None):
+    # The body is the one a batch of this single request would have, so the
+    # receiver handles the reassembled payload like any batch email. The
+    # request_uuid names the set, so a retry reuses the parts.
+    rpc_data, created, spooled = read_traced_record(filepath)
+    trace = BatchTrace("rpc_")
+    trace.add(created, spooled)
+    trace.mark_batched()
+    parts = split_into_parts(json.dumps([rpc_data]).encode("utf-8"), rpc_data["request_uuid"])
+    save_sent_parts(parts)  # Kept for resend requests
+    logger.info(f"Sending RPC {rpc_data['request_uuid']} in {len(parts)} parts.")
 
-        if len(batched_execution_data) >= batch_size_limit:
+    async def send():
+        email_sent = await send_parts(parts, send_rpc_part)
+        if email_sent:
+            trace.mark_emailed()
+        return email_sent
+
+    async def on_success():
+        move_to_awaiting(filepath)
+        trace.mark_recorded()
+
+    send, on_success = track_sent_batch("rpc", [filepath], [], send, on_success)
+    return await dispatch_batch(dispatcher, [filepath], send, on_success)
+
+
+async def process_execution_requests(execution_paths, dispatcher=None, limits=None):
+    # execution_paths are spool file paths, oldest first (see SpoolCursor).
+    # Records are encoded into the email as they are read; only their small
+    # database rows are kept, so memory does not grow with the batch size.
+    batching = get_batch_controller("executions")
+    limits = limits or batching.get_limits()
+    default_email_account = await get_cached_default_email_account()
+    message = StreamingBatchMessage(
+        "Batched Executions",
+        get_email_address_from_email_account(default_email_account or {}),
+        get_execution_email_address(),
+    )
+    rows = []
+    batched_paths = []
+    trace = BatchTrace()
+
+    for filepath in execution_paths:
+        if dispatcher is not None and dispatcher.is_claimed(filepath):
+            continue  # Already part of a batch in flight
+        try:
+            execution_data, created, spooled = read_traced_record(filepath)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            logger.warning(f"Skipping execution file {filepath}: {e}")
+            continue
+        message.add(execution_data)
+        rows.append(get_execution_row(execution_data))
+        batched_paths.append(filepath)
+        trace.add(created, spooled)
+
+        if len(rows) >= limits.count or message.body_bytes >= limits.max_bytes:
             break
 
-    if batched_execution_data:
-        email_content = json.dumps(batched_execution_data)
-        default_email_account = await get_default_email_account()
-        execution_email_address = get_execution_email_address()
-
-        email_sent = await send_email(
-            "Batched Executions",
-            email_content,
-            execution_email_address,
-            get_smtp_server_from_email_account(default_email_account),  # SMTP server
-            int(get_smtp_port_from_email_account(default_email_account)),  # SMTP port
-            get_email_address_from_email_account(
-                default_email_account
-            ),  # Email (same as 'From' address)
-            get_email_address_password_from_email_account(
-                default_email_account
-            ),  # Password
+    if not rows:
+        message.close()
+        return False
+    trace.mark_batched()
+
+    async def send():
+        email_sent = await send_measured(
+            batching,
+            lambda: send_execution_batch(message, default_email_account),
+            len(rows),
+            message.body_bytes,
         )
-
-        logger.info(f"Email sent: {email_sent}")
         if email_sent:
-            for data in batched_execution_data:
-                os.remove(
-                    os.path.join(executions_dir, f"{data['execution_uuid']}.json")
-                )
-                record_execution_in_db(
-                    data["execution_uuid"], data["customer_program_uuid"], True
-                )
+            trace.mark_emailed()
+        return email_sent
+
+    async def on_success():
+        message.close()
+        # Record before removing, so a failed insert leaves the spool files
+        await record_executions_in_db(rows)
+        for filepath in batched_paths:
+            os.remove(filepath)
+        trace.mark_recorded()
+
+    async def on_failure():
+        # Kept with its encoded message and retried with backoff
+        try:
+            get_retry_queue("executions").add(batched_paths, rows, message)
+        finally:
+            message.close()
 
-    return len(batched_execution_data) > 0
+    send, on_success = track_sent_batch("executions", batched_paths, rows, send, on_success)
+    return await dispatch_batch(dispatcher, batched_paths, send, on_success, on_failure)
 
 
-def run_sender_loop_process():
+async def send_execution_batch(message, email_account):
+    return await send_batch_message(
+        message,
+        get_smtp_server_from_email_account(email_account),  # SMTP server
+        int(get_smtp_port_from_email_account(email_account)),  # SMTP port
+        get_email_address_from_email_account(email_account),  # Login
+        get_email_address_password_from_email_account(email_account),  # Password
+    )
+
+
+async def retry_batch(retries, entry, send_message, dispatcher=None, batching=None):
+    """
+    Sends a queued batch again, reusing its encoded message.
+
+    :param retries: The lane's RetryQueue.
+    :param entry: The due entry, see RetryQueue.next_due.
+    :param send_message: Coroutine function sending a message, returning True if sent.
+    """
+    message = retries.open_message(entry)
+
+    async def send():
+        try:
+            if batching is None:
+                return await send_message(message)
+            return await send_measured(
+                batching, lambda: send_message(message), entry["records"], entry["body_bytes"]
+            )
+        finally:
+            message.close()
+
+    async def on_success():
+        await record_executions_in_db(entry["rows"])
+        for path in entry["paths"]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        retries.remove(entry)
+        logger.info(f"Batch {entry['batch_id']} sent after {entry['attempts']} failed attempts.")
+
+    async def on_failure():
+        retries.record_failure(entry)
+
+    send, on_success = track_sent_batch(
+        retries.lane, entry["paths"], entry["rows"], send, on_success, retry_id=entry["batch_id"]
+    )
+    return await dispatch_batch(dispatcher, [retries.get_key(entry)], send, on_success, on_failure)
+
+
+async def open_spool_manifest(name):
+    """
+    Loads the manifest of a sending process and finishes what its previous
+    run left: a batch that was emailed but not yet recorded is recorded now
+    instead of being sent twice, a batch still in flight simply stays in the
+    spool, and RPCs that were answered meanwhile stop being awaited.
+
+    :param name: "sender" or "file_watcher".
+    """
+    global spool_manifest
+    manifest = spool_manifest = get_spool_manifest(name)
+    if spool_manifest_observer not in reply_observers:
+        reply_observers.append(spool_manifest_observer)
+    for key, entry in manifest.items("batch:"):
+        if entry["state"] == "emailed":
+            logger.info(f"Completing {entry['lane']} batch {key} sent before a restart.")
+            if entry["lane"] == "rpc":
+                for path in entry["paths"]:
+                    try:
+                        move_to_awaiting(path)
+                    except FileNotFoundError:
+                        pass
+            else:
+                await record_executions_in_db(entry["rows"])
+                for path in entry["paths"]:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                retries = get_retry_queue(entry["lane"])
+                retry = retries.entries.get(entry.get("retry_id"))
+                if retry is not None:
+                    retries.remove(retry)
+        manifest.remove(key)
+    for request_uuid in get_awaited_rpcs(manifest):
+        if not os.path.exists(get_rpc_request_path(awaiting_response_dir, request_uuid)):
+            manifest.remove(f"rpc:{request_uuid}")
+    return manifest
+
+
+def spool_manifest_observer(request_uuid):
+    if rpc_deadlines is not None:
+        rpc_deadlines.answered(request_uuid)
+    elif spool_manifest is not None:
+        spool_manifest.remove(f"rpc:{request_uuid}")
+
+
+def start_rpc_expiry():
+    # Reply deadlines of the sent RPCs, reloaded from the manifest
+    global rpc_deadlines
+    rpc_deadlines = RPCDeadlines(spool_manifest)
+    logger.info(f"Tracking reply deadlines of {rpc_deadlines.load()} awaited RPC requests.")
+    return asyncio.create_task(rpc_expiry_loop(rpc_deadlines))
+
+
+def run_sender_loop_process(spawn_requested_at=None):
+    logger.debug("Process started, trying to become the sender...")
+    leader_lock = try_acquire_leadership(executions_dir)
+    if leader_lock is None:
+        release_spawn_claim(executions_dir)
+        logger.warning("Another sender holds the leader lock, exiting.")
+        return
     try:
-        logger.debug("Process started, reacquiring lock...")
-        with portalocker.Lock(lockfile_path, mode="w", timeout=5):  # Consistent timeout
-            logger.debug("Lock reacquired by process. Running sender loop.")
-            asyncio.run(sender_loop())
-    except portalocker.exceptions.LockException:
-        logger.warning("Unable to reacquire lock in process, exiting.")
+        write_heartbeat(directory=executions_dir)
+        release_spawn_claim(executions_dir)
+        logger.debug("Leader lock acquired. Running sender loop.")
+        asyncio.run(sender_loop(spawn_requested_at))
     finally:
-        logger.debug("Sender loop process ending, releasing lock.")
+        clear_heartbeat(executions_dir)
+        leader_lock.release()
+        logger.debug("Sender loop process ending, releasing leader lock.")
+
+
+# Default account cached by the sender, so a warm sender skips the database
+default_email_account_cache_ttl = 60  # Seconds
+_default_email_account_cache = {"loaded_at": 0.0, "account": None}
+
+
+async def get_cached_default_email_account():
+    now = time.monotonic()
+    if (
+        _default_email_account_cache["account"] is None
+        or now - _default_email_account_cache["loaded_at"] > default_email_account_cache_ttl
+    ):
+        _default_email_account_cache.update(
+            loaded_at=now, account=await get_default_email_account()
+        )
+    return _default_email_account_cache["account"]
+
+
+def get_time_since_last_change(directories):
+    # A directory's mtime is the time its newest file was added or removed
+    mtimes = []
+    for directory in directories:
+        try:
+            mtimes.append(os.stat(directory).st_mtime)
+        except FileNotFoundError:
+            continue
+    if not mtimes:
+        return 0.0
+    return max(0.0, time.time() - max(mtimes))
 
 
-async def sender_loop():
-    wait_time = 10  # Shorter wait time for quicker checks
+async def sender_loop(spawn_requested_at=None):
+    wait_time = 10  # Longest wait for new work when all lanes are idle or failing
     idle_timeout = 120  # Timeout duration in seconds
     last_activity_time = time.time()
+    scheduler = create_default_scheduler()
+    spool_cursor = SpoolCursor(executions_dir)
+    migrate_flat_spool(executions_dir)
+    lifecycle = SenderLifecycle(spawn_requested_at)
+    execution_retries = get_retry_queue("executions")
+
+    def get_heartbeat_details():
+        return dict(
+            lifecycle.as_dict(),
+            latency=get_stage_percentiles(),
+            batching=get_batching_stats(),
+        )
 
     logger.info("Sender loop started.")
+    config = await load_or_request_config()
+    try:
+        await get_cached_default_email_account()  # Warm before the first slot
+    except Exception as e:
+        logger.warning(f"Unable to load the default email account yet: {e}")
+    await open_spool_manifest("sender")
+    expiry_task = start_rpc_expiry()
+    retention_task = asyncio.create_task(retention_loop(config=config))
+    instrumentation_task = asyncio.create_task(instrumentation_loop())
+    reply_task = asyncio.create_task(rpc_reply_listener(get_cached_default_email_account))
+    parts_task = asyncio.create_task(
+        message_parts_loop(send_rpc_part, lambda content: send_rpc_email("RPC Resend Parts", content))
+    )
+    lifecycle.mark_ready()
+    heartbeat_task = asyncio.create_task(
+        heartbeat_loop(get_heartbeat_details, directory=executions_dir)
+    )
 
     while True:
         try:
             current_time = time.time()
-
-            # Check if the idle timeout has been exceeded
-            if current_time - last_activity_time > idle_timeout:
-                logger.info("Idle timeout exceeded, stopping sender loop.")
-                break
-
-            rpc_requests_processed = await process_rpc_requests()
-            execution_files_processed = False
-
-            if not rpc_requests_processed:
-                execution_files = [
-                    f for f in os.listdir(executions_dir) if f.endswith(".json")
-                ]
-                if execution_files:
+            watched_dirs = [
+                staged_dir,
+                executions_dir,
+                os.path.join(executions_dir, get_spool_bucket()),
+                awaiting_response_dir,
+            ]
+
+            # Past the idle timeout the sender either stays warm in standby
+            # (still heartbeating, so producers do not spawn a new one) or exits.
+            stop = lifecycle.standby_expired()
+            if (
+                not stop
+                and lifecycle.state != "standby"
+                and current_time - last_activity_time > idle_timeout
+            ):
+                if lifecycle.policy == "standby":
+                    lifecycle.enter_standby()
+                else:
+                    stop = True
+
+            if stop:
+                # Stop advertising first, then give producers that still saw the
+                # old heartbeat time to finish; their work keeps this sender up.
+                heartbeat_task.cancel()
+                clear_heartbeat(executions_dir)
+                await asyncio.sleep(liveness_cache_ttl + heartbeat_interval)
+                if (
+                    get_oldest_pending_age(staged_dir) is None
+                    and spool_cursor.get_oldest_pending_age() is None
+                ):
+                    logger.info("Idle timeout exceeded, stopping sender loop.")
+                    break
+                last_activity_time = time.time()
+                lifecycle.state = "active"
+                heartbeat_task = asyncio.create_task(
+                    heartbeat_loop(get_heartbeat_details, directory=executions_dir)
+                )
+                continue
+
+            # Spilled summaries go back into the spool once it has room
+            drain_overflow_summaries(save_execution_data)
+
+            # Lanes only compete for a slot while the account has room in flight
+            dispatcher = get_dispatcher_for_email_account(
+                await get_cached_default_email_account()
+            )
+            rpc_age = get_oldest_pending_age(staged_dir)
+            execution_age = spool_cursor.get_oldest_pending_age()
+            execution_limits = get_batch_controller("executions").get_limits(
+                get_spool_depth()["records"], urgent=rpc_age is not None
+            )
+            lingering = execution_age is not None and execution_age < execution_limits.linger
+            if lingering:
+                execution_age = None  # Let the batch fill up a little longer
+            if dispatcher.can_submit():
+                lane = scheduler.choose({"rpc": rpc_age, "executions": execution_age})
+            else:
+                lane = None
+
+            if lane is not None and lifecycle.state == "standby":
+                # The heartbeat also lives in executions_dir, so only the
+                # staging area and the current bucket date the new work.
+                lifecycle.wake(get_time_since_last_change([staged_dir, watched_dirs[2]]))
+
+            sent = False
+            if lane == "rpc":
+                sent = await process_rpc_requests(dispatcher)
+            elif lane == "executions":
+                retry = execution_retries.next_due(skip=dispatcher.is_claimed)
+                if retry is not None:
+                    account = await get_cached_default_email_account()
+                    sent = await retry_batch(
+                        execution_retries,
+                        retry,
+                        lambda message: send_execution_batch(message, account),
+                        dispatcher,
+                        get_batch_controller("executions"),
+                    )
+                else:
                     logger.debug("Processing execution requests.")
-                    await process_execution_requests(execution_files)
-                    execution_files_processed = True
-
-            # Update last_activity_time if there was activity
-            if rpc_requests_processed or execution_files_processed:
+                    execution_paths = spool_cursor.next_batch(
+                        execution_limits.count,
+                        skip=lambda path: dispatcher.is_claimed(path)
+                        or execution_retries.is_held(path),
+                    )
+                    sent = await process_execution_requests(
+                        execution_paths, dispatcher, execution_limits
+                    )
+
+            if sent or dispatcher.inflight:
                 last_activity_time = time.time()
-
-            await asyncio.sleep(wait_time)
+            if sent:
+                continue  # Next send slot right away
+
+            # Nothing to send, or the send failed: wait, but wake up as soon as
+            # new work is staged so an urgent RPC takes the next slot.
+            # A finished batch removes its files, which also counts as a change.
+            retry_wait = execution_retries.get_seconds_until_due()
+            idle_wait = wait_time if retry_wait is None else min(wait_time, max(retry_wait, 0.1))
+            await wait_for_new_work(
+                watched_dirs,
+                execution_limits.linger if lingering else 1 if dispatcher.inflight else idle_wait,
+                standby_poll_interval if lifecycle.state == "standby" else None,
+            )
 
         except asyncio.CancelledError:
             logger.info("Sender loop cancelled, stopping.")
             break
         except Exception as e:
             logger.error(f"Error in sender loop: {e}\n{traceback.format_exc()}")
+            await asyncio.sleep(wait_time)
 
-    logger.info("Sender loop stopped.")
+    for dispatcher in dispatchers.values():
+        await dispatcher.drain()
+    retention_task.cancel()
+    instrumentation_task.cancel()
+    reply_task.cancel()
+    parts_task.cancel()
+    expiry_task.cancel()
+    heartbeat_task.cancel()
+    logger.info(f"Sender loop stopped. Lane stats: {scheduler.get_stats()}")
 
 
 def calculate_size(data):
@@ -1,5 +1,6 @@
 import os
-import sqlite3
+import time
+import uuid
 import aiosmtplib
 from email.mime.text import MIMEText
 import logging
@@ -7,10 +8,13 @@ import traceback
 
 from typing import Optional
 import re
-import aiosqlite
 import tkinter as tk
 from tkinter import simpledialog
 
+from .nadoo_mime import StoredBatchMessage, StreamingBatchMessage
+from .nadoo_pop3 import POP3Error, sync_pop3_mailbox
+from .nadoo_storage import get_storage
+
 # Create 'logs' directory if it doesn't exist
 logs_dir = "logs"
 if not os.path.exists(logs_dir):
@@ -75,6 +79,35 @@ def get_email_account_db_name() -> str:
     return "email_account.db"
 
 
+# Transport settings. NADOO_<NAME> environment variables take precedence, so a
+# sender process started by a producer uses the same transport.
+email_transport = "smtp"  # "smtp", or "directory" to drop messages into email_drop_dir
+email_drop_dir = "outbox"
+smtp_use_tls = True
+
+
+def get_email_setting(name):
+    value = os.getenv(f"NADOO_{name.upper()}")
+    if value is None:
+        return globals()[name]
+    if isinstance(globals()[name], bool):
+        return value.strip().lower() in ("1", "true", "yes")
+    return value
+
+
+def drop_email(msg, directory):
+    # Published under a temporary name first, so readers never see a partial file
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.time():.6f}-{uuid.uuid4().hex}.eml"
+    tmp_path = os.path.join(directory, f".{name}.tmp")
+    if isinstance(msg, (StreamingBatchMessage, StoredBatchMessage)):
+        msg.write_to(tmp_path)
+    else:
+        with open(tmp_path, "wb") as file:
+            file.write(msg.as_bytes())
+    os.rename(tmp_path, os.path.join(directory, name))
+
+
 import functools
 import asyncio
 
@@ -98,24 +131,28 @@ def email_account_db_name(func):
         return sync_wrapper
 
 
+def setup_email_accounts_table(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS email_accounts (
+            email TEXT PRIMARY KEY,
+            pop_server TEXT,    -- POP3 server address
+            pop_port INTEGER,   -- POP3 server port, typically 995 for SSL/TLS
+            smtp_server TEXT,   -- SMTP server address for sending emails
+            smtp_port INTEGER,  -- SMTP server port, typically 465 for SSL/TLS
+            password TEXT,      -- Password for the email account
+            is_default BOOLEAN DEFAULT 0
+        );
+        """
+    )
+
+
 @log_errors
 @email_account_db_name
 def setup_database(*, email_account_db_name: str):
-    with sqlite3.connect(email_account_db_name) as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS email_accounts (
-                email TEXT PRIMARY KEY,
-                pop_server TEXT,    -- POP3 server address
-                pop_port INTEGER,   -- POP3 server port, typically 995 for SSL/TLS
-                smtp_server TEXT,   -- SMTP server address for sending emails
-                smtp_port INTEGER,  -- SMTP server port, typically 465 for SSL/TLS
-                password TEXT,      -- Password for the email account
-                is_default BOOLEAN DEFAULT 0
-            );
-            """
-        )
-        conn.commit()
+    get_storage(email_account_db_name).submit(
+        lambda conn: None, setup=setup_email_accounts_table
+    ).result()
 
 
 # Helper function to get the email address from email account details
@@ -182,36 +219,37 @@ def is_default_email_account(email_account):
 @log_errors
 @email_account_db_name
 async def set_default_email_address(email_address: str, email_account_db_name: str):
-    async with aiosqlite.connect(email_account_db_name) as conn:
-        await conn.execute("UPDATE email_accounts SET is_default = 0")
-        await conn.execute(
-            "UPDATE email_accounts SET is_default = 1 WHERE email = ?", (email_address,)
-        )
-        await conn.commit()
+    await get_storage(email_account_db_name).write(mark_default_email_address, email_address)
+
+
+def mark_default_email_address(conn, email_address):
+    conn.execute("UPDATE email_accounts SET is_default = 0")
+    conn.execute("UPDATE email_accounts SET is_default = 1 WHERE email = ?", (email_address,))
+
+
+email_account_keys = [
+    "email",
+    "pop_server",
+    "pop_port",
+    "smtp_server",
+    "smtp_port",
+    "password",
+    "is_default",
+]
+
+
+def select_email_account(conn, where, params=()):
+    row = conn.execute(f"SELECT * FROM email_accounts WHERE {where}", params).fetchone()
+    return dict(zip(email_account_keys, row)) if row else None
 
 
 @log_errors
 @email_account_db_name
 async def get_default_email_account(email_account_db_name: str):
-    async with aiosqlite.connect(email_account_db_name) as conn:
-        cursor = await conn.execute("SELECT * FROM email_accounts WHERE is_default = 1")
-        result = await cursor.fetchone()
-        await cursor.close()
-
-        if result:
-            keys = [
-                "email",
-                "pop_server",
-                "pop_port",
-                "smtp_server",
-                "smtp_port",
-                "password",
-                "is_default",
-            ]
-            return dict(zip(keys, result))
-
-        # Return None if no default email account is found
-        return None
+    # None if no default email account is found
+    return await get_storage(email_account_db_name).read(
+        select_email_account, "is_default = 1"
+    )
 
 
 @log_errors
@@ -219,25 +257,9 @@ async def get_default_email_account(email_account_db_name: str):
 async def get_email_account_for_email_address(
     email_account_db_name: str, email_address: Optional[str] = None
 ):
-    async with aiosqlite.connect(email_account_db_name) as conn:
-        cursor = await conn.execute(
-            "SELECT * FROM email_accounts WHERE email = ?", (email_address,)
-        )
-        result = await cursor.fetchone()
-        await cursor.close()
-
-        if result:
-            keys = [
-                "email",
-                "pop_server",
-                "pop_port",
-                "smtp_server",
-                "smtp_port",
-                "password",
-                "is_default",
-            ]
-            return dict(zip(keys, result))
-        return None
+    return await get_storage(email_account_db_name).read(
+        select_email_account, "email = ?", (email_address,)
+    )
 
 
 # Async function to save or update email account details in the database
@@ -253,16 +275,15 @@ async def save_email_account(*, email_account_db_name: str, email_account):
     password = get_email_address_password_from_email_account(email_account)
     is_default = is_default_email_account(email_account)
 
-    async with aiosqlite.connect(email_account_db_name) as conn:
+    def upsert(conn):
         # Check if a record with the given email already exists
-        async with conn.execute(
+        existing_email = conn.execute(
             "SELECT email FROM email_accounts WHERE email = ?", (email_address,)
-        ) as cursor:
-            existing_email = await cursor.fetchone()
+        ).fetchone()
 
         # If the email exists, update the record
         if existing_email:
-            await conn.execute(
+            conn.execute(
                 """
                 UPDATE email_accounts
                 SET pop_server = ?, pop_port = ?, smtp_server = ?, smtp_port = ?, password = ?, is_default = ?
@@ -280,7 +301,7 @@ async def save_email_account(*, email_account_db_name: str, email_account):
             )
         else:
             # Insert new record
-            await conn.execute(
+            conn.execute(
                 """
                 INSERT INTO email_accounts (email, pop_server, pop_port, smtp_server, smtp_port, password, is_default)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
@@ -296,13 +317,11 @@ async def save_email_account(*, email_account_db_name: str, email_account):
                 ),
             )
 
-        await conn.commit()
-
-        # Set as default email account if applicable
+        # Set as default email account if applicable, in the same transaction
         if is_default:
-            await set_default_email_address(
-                email_address, email_account_db_name=email_account_db_name
-            )
+            mark_default_email_address(conn, email_address)
+
+    await get_storage(email_account_db_name).write(upsert)
 
 
 # Async function to send email
@@ -316,8 +335,14 @@ async def send_email(
         msg["From"] = email
         msg["To"] = to_email
 
+        if get_email_setting("email_transport") == "directory":
+            drop_email(msg, get_email_setting("email_drop_dir"))
+            return True
+
         async with aiosmtplib.SMTP(
-            hostname=smtp_server, port=smtp_port, use_tls=True
+            hostname=smtp_server,
+            port=smtp_port,
+            use_tls=get_email_setting("smtp_use_tls"),
         ) as smtp:
             await smtp.login(email, password)
             await smtp.send_message(msg)
@@ -328,50 +353,84 @@ async def send_email(
         return False
 
 
+async def stream_smtp_data(smtp, chunks):
+    """
+    Sends a prepared message as SMTP DATA, chunk by chunk.
+
+    aiosmtplib's data() normalizes and dot-stuffs a full copy of the message,
+    so the DATA command is driven here. The chunks must already use CRLF line
+    endings with no line starting with a dot, as StreamingBatchMessage does.
+    """
+    response = await smtp.execute_command(b"DATA")
+    if response.code != aiosmtplib.SMTPStatus.start_input:
+        raise aiosmtplib.SMTPDataError(response.code, response.message)
+    for chunk in chunks:
+        smtp.protocol.write(chunk)
+        await smtp.protocol._drain_helper()  # Waits while the transport buffer is full
+    smtp.protocol.write(b".\r\n")
+    response = await smtp.protocol.read_response(timeout=smtp.timeout)
+    if response.code != aiosmtplib.SMTPStatus.completed:
+        raise aiosmtplib.SMTPDataError(response.code, response.message)
+
+
+# Async function to send a batch email built by StreamingBatchMessage
+@log_errors
+async def send_batch_message(message, smtp_server, smtp_port, email, password) -> bool:
+    try:
+        if get_email_setting("email_transport") == "directory":
+            drop_email(message, get_email_setting("email_drop_dir"))
+            return True
+
+        async with aiosmtplib.SMTP(
+            hostname=smtp_server,
+            port=smtp_port,
+            use_tls=get_email_setting("smtp_use_tls"),
+        ) as smtp:
+            await smtp.login(email, password)
+            await smtp.mail(message.from_email)
+            await smtp.rcpt(message.to_email)
+            await stream_smtp_data(smtp, message.iter_chunks())
+
+        return True
+    except Exception as e:
+        print(f"Error sending email: {e}")
+        return False
+
+
 # Function to validate email address format
 def is_valid_email(email):
     pattern = r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)"
     return re.match(pattern, email) is not None
 
 
-""" 
-# Async function to get emails for an email address
+# Async function to get new emails for an email address
 @log_errors
 @email_account_db_name
 async def get_emails_for_email_address(email_address, email_account_db_name: str):
+    """
+    Downloads the emails that arrived since the last call (POP3, by UIDL).
+
+    :return: Paths of the new messages in inbox/<email address>, oldest first.
+    """
     if not is_valid_email(email_address):
         logging.error(f"Invalid email address: {email_address}")
         return []
 
     email_account = await get_email_account_for_email_address(
-        email_address=email_address
+        email_address=email_address, email_account_db_name=email_account_db_name
     )
 
-    # If some details are missing, request them from the user
     if not (
-        check_pop_server_in_email_account(email_account)
+        email_account
+        and check_pop_server_in_email_account(email_account)
         and check_pop_port_in_email_account(email_account)
         and check_password_in_email_account(email_account)
     ):
-        email_account = await get_email_account_from_user(email_account)
+        logging.error(f"POP3 details missing for email address: {email_address}")
+        return []
 
-    # Retrieve emails using the provided details
-    emails = []
     try:
-        async with aiopop3.POP3_SSL(
-            host=email_account["pop_server"],
-            port=email_account["pop_port"],
-        ) as client:
-            await client.login(email_address, email_account["password"])
-
-            # Fetch emails. Adapt this part based on how the library works
-            messages = await client.list_messages()  # This method might vary
-            for msg_id in messages:
-                email_content = await client.retrieve_message(msg_id)
-                emails.append(email_content)
-
-    except Exception as e:
+        return await sync_pop3_mailbox(email_account, email_account_db_name)
+    except (POP3Error, OSError, asyncio.TimeoutError) as e:
         logging.error(f"Error retrieving emails: {e}")
-
-    return emails
- """
+        return []
@@ -0,0 +1,336 @@
+import os
+import csv
+import gzip
+import json
+import sqlite3
+import argparse
+import logging
+from datetime import datetime
+
+from .nadoo_retention import timestamp_format, unknown_partition
+from .nadoo_storage import get_storage
+
+
+logger = logging.getLogger(__name__)
+
+# Export settings
+execution_db_path = "executions.db"
+export_dir = "exports"
+export_chunk_size = 5000  # Rows read per query; each chunk is its own short read
+export_formats = ("csv", "parquet")
+execution_columns = (
+    "execution_uuid",
+    "customer_program_uuid",
+    "is_sent",
+    "timestamp",
+    "execution_count",
+)
+rollup_columns = ("day", "customer_program_uuid", "execution_count")
+
+
+class ExportError(Exception):
+    pass
+
+
+def setup_export_state_table(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS export_state
+           (name TEXT PRIMARY KEY, last_rowid INTEGER, exported_at TEXT)"""
+    )
+
+
+def save_export_watermark(conn, name, last_rowid, exported_at):
+    conn.execute(
+        "INSERT OR REPLACE INTO export_state VALUES (?, ?, ?)", (name, last_rowid, exported_at)
+    )
+
+
+def connect_readonly(db_path):
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+
+
+def has_table(conn, table):
+    return (
+        conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        is not None
+    )
+
+
+def get_export_watermark(conn, name):
+    """
+    :return: The highest rowid exported under name, 0 if none yet.
+    """
+    if not has_table(conn, "export_state"):
+        return 0
+    row = conn.execute("SELECT last_rowid FROM export_state WHERE name = ?", (name,)).fetchone()
+    if row is None:
+        return 0
+    # Row ids start over once the table was emptied; everything left is new then
+    max_rowid = conn.execute("SELECT MAX(rowid) FROM execution_records").fetchone()[0] or 0
+    return row[0] if row[0] <= max_rowid else 0
+
+
+def get_filter(start=None, end=None, customers=None):
+    clauses, params = [], []
+    if start:
+        clauses.append("timestamp >= ?")
+        params.append(start)
+    if end:
+        clauses.append("timestamp < ?")
+        params.append(end)
+    if customers:
+        clauses.append(f"customer_program_uuid IN ({', '.join('?' * len(customers))})")
+        params.extend(customers)
+    return clauses, params
+
+
+def iter_execution_chunks(conn, start=None, end=None, customers=None, after_rowid=None):
+    """
+    Reads matching execution rows in chunks of export_chunk_size.
+
+    Every chunk is one keyset query, so no read transaction stays open while
+    the caller writes a chunk out and memory does not grow with the range.
+    Incremental exports (after_rowid) page by rowid; date ranges page by
+    (timestamp, rowid) along the timestamp index.
+
+    :param start: First timestamp to include, e.g. "2024-01-01".
+    :param end: First timestamp to leave out.
+    :param customers: Customer program UUIDs to include, all if empty.
+    :param after_rowid: Only rows inserted after this rowid.
+    :return: Iterator of row lists: (rowid, *execution_columns).
+    """
+    clauses, params = get_filter(start, end, customers)
+    columns = ", ".join(
+        "COALESCE(execution_count, 1)" if column == "execution_count" else column
+        for column in execution_columns
+    )
+    by_rowid = after_rowid is not None
+    last = (after_rowid or 0,) if by_rowid else None
+    while True:
+        if by_rowid:
+            keyset, order = ["rowid > ?"], "rowid"
+        elif last is None:
+            keyset, order = [], "timestamp, rowid"
+        else:
+            keyset, order = ["(timestamp > ? OR (timestamp = ? AND rowid > ?))"], "timestamp, rowid"
+        keyset_params = [] if last is None else [last[0]] if by_rowid else [last[0], last[0], last[1]]
+        where = " AND ".join(clauses + keyset) or "1"
+        rows = conn.execute(
+            f"""SELECT rowid, {columns} FROM execution_records
+                WHERE {where} ORDER BY {order} LIMIT ?""",
+            (*params, *keyset_params, export_chunk_size),
+        ).fetchall()
+        if not rows:
+            return
+        yield rows
+        last = (rows[-1][0],) if by_rowid else (rows[-1][4], rows[-1][0])
+        if len(rows) < export_chunk_size:
+            return
+
+
+def iter_archived_rollups(conn, start=None, end=None, customers=None):
+    # Rows moved to the archive by retention only survive in the database as rollups
+    if not has_table(conn, "execution_rollups"):
+        return iter(())
+    clauses, params = get_filter(customers=customers)
+    if start:
+        clauses.append("day >= ?")
+        params.append(start[:10])
+    if end:
+        clauses.append("day < ?")
+        params.append(end[:10])
+    where = " AND ".join(clauses) or "1"
+    return conn.execute(
+        f"SELECT day, customer_program_uuid, execution_count FROM execution_rollups WHERE {where}",
+        params,
+    )
+
+
+class CsvWriter:
+    def __init__(self, path, columns):
+        self.file = gzip.open(path, "wt", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    # One row group per chunk, so memory stays at one chunk
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportError("The parquet format needs pyarrow: pip install pyarrow")
+        self.pyarrow = pyarrow
+        self.columns = columns
+        types = {"is_sent": pyarrow.bool_(), "execution_count": pyarrow.int64()}
+        self.schema = pyarrow.schema(
+            [(column, types.get(column, pyarrow.string())) for column in columns]
+        )
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, rows):
+        columns = list(zip(*rows)) or [[] for _ in self.columns]
+        arrays = [
+            self.pyarrow.array(
+                [None if value is None else bool(value) for value in values]
+                if column == "is_sent"
+                else values,
+                type=self.schema.field(column).type,
+            )
+            for column, values in zip(self.columns, columns)
+        ]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+writers = {"csv": (CsvWriter, ".csv.gz"), "parquet": (ParquetWriter, ".parquet")}
+
+
+def export_executions(
+    start=None,
+    end=None,
+    customers=None,
+    formats=("csv",),
+    watermark=None,
+    output_dir=None,
+    db_path=None,
+):
+    """
+    Streams execution rows and their daily rollups into export files.
+
+    Files are written under temporary names and renamed when complete; an
+    incremental export moves its watermark only after that, so a failed run
+    is simply repeated. Rollups count spilled summaries by their
+    execution_count. A full export adds the rollups of rows retention has
+    archived; an incremental one only covers the new rows.
+
+    :param start: First timestamp to include, e.g. "2024-01-01".
+    :param end: First timestamp to leave out.
+    :param customers: Customer program UUIDs to include, all if empty.
+    :param formats: Any of export_formats; "parquet" needs pyarrow.
+    :param watermark: Name of an incremental export: only rows inserted since
+        its last run are exported.
+    :return: {"rows", "files", "watermark"}.
+    """
+    db_path = db_path or execution_db_path
+    output_dir = output_dir or export_dir
+    unknown = set(formats) - set(export_formats)
+    if unknown:
+        raise ExportError(f"Unknown export formats: {sorted(unknown)}")
+    if not os.path.exists(db_path):
+        raise ExportError(f"No execution database at {db_path}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    conn = connect_readonly(db_path)
+    after_rowid = get_export_watermark(conn, watermark) if watermark else None
+    label = "_".join(
+        part
+        for part in (
+            watermark,
+            (start or "begin")[:10],
+            (end or "now")[:10],
+            f"after{after_rowid}" if watermark else None,
+        )
+        if part
+    )
+    paths = {
+        "executions": {
+            kind: os.path.join(output_dir, f"executions-{label}{writers[kind][1]}")
+            for kind in formats
+        },
+        "rollups": os.path.join(output_dir, f"rollups-{label}.csv.gz"),
+    }
+    open_writers = {}
+    rows_exported = 0
+    last_rowid = after_rowid
+    rollups = {}  # (day, customer) -> count; grows with days and customers, not rows
+    try:
+        for kind, path in paths["executions"].items():
+            open_writers[kind] = writers[kind][0](f"{path}.tmp", execution_columns)
+        for chunk in iter_execution_chunks(conn, start, end, customers, after_rowid):
+            records = [row[1:] for row in chunk]
+            for writer in open_writers.values():
+                writer.write(records)
+            for record in records:
+                key = ((record[3] or unknown_partition)[:10], record[1])
+                rollups[key] = rollups.get(key, 0) + record[4]
+            rows_exported += len(chunk)
+            if watermark:
+                last_rowid = max(last_rowid, max(row[0] for row in chunk))
+        if not watermark:
+            for day, customer_program_uuid, count in iter_archived_rollups(
+                conn, start, end, customers
+            ):
+                key = (day, customer_program_uuid)
+                rollups[key] = rollups.get(key, 0) + count
+        rollup_writer = CsvWriter(f"{paths['rollups']}.tmp", rollup_columns)
+        rollup_writer.write((*key, count) for key, count in sorted(rollups.items()))
+        rollup_writer.close()
+    except BaseException:
+        for writer in open_writers.values():
+            writer.close()
+        for path in [*paths["executions"].values(), paths["rollups"]]:
+            if os.path.exists(f"{path}.tmp"):
+                os.remove(f"{path}.tmp")
+        raise
+    finally:
+        conn.close()
+
+    for writer in open_writers.values():
+        writer.close()
+    files = [*paths["executions"].values(), paths["rollups"]]
+    for path in files:
+        os.replace(f"{path}.tmp", path)
+    if watermark and last_rowid != after_rowid:
+        get_storage(db_path).submit(
+            save_export_watermark,
+            watermark,
+            last_rowid,
+            datetime.now().strftime(timestamp_format),
+            setup=setup_export_state_table,
+        ).result()
+    logger.info(f"Exported {rows_exported} execution rows to {files}.")
+    return {"rows": rows_exported, "files": files, "watermark": last_rowid}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m nadoo_connect.nadoo_export",
+        description="Export execution records and daily rollups for billing.",
+    )
+    parser.add_argument("--start", help="First timestamp to include, e.g. 2024-01-01")
+    parser.add_argument("--end", help="First timestamp to leave out, e.g. 2024-02-01")
+    parser.add_argument("--customer", action="append", help="Customer program UUID, repeatable")
+    parser.add_argument("--format", action="append", choices=export_formats)
+    parser.add_argument("--watermark", help="Name of an incremental export")
+    parser.add_argument("--output-dir")
+    parser.add_argument("--db")
+    args = parser.parse_args(argv)
+    try:
+        summary = export_executions(
+            start=args.start,
+            end=args.end,
+            customers=args.customer,
+            formats=args.format or ["csv"],
+            watermark=args.watermark,
+            output_dir=args.output_dir,
+            db_path=args.db,
+        )
+    except ExportError as e:
+        parser.exit(1, f"{e}\n")
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
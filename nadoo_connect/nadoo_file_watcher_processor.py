@@ -11,7 +11,7 @@ from datetime import datetime
 import logging
 
 
-from .nadoo_email import send_email
+from .nadoo_email import send_batch_message, send_email
 from .nadoo_connect import *
 
 # Define directories
@@ -61,7 +61,8 @@ class RPCEventHandler(FileSystemEventHandler):
 
 class ExecutionEventHandler(FileSystemEventHandler):
     def on_created(self, event):
-        if not event.is_directory:
+        # Spool files live in time buckets; skip bucket directories and lock files
+        if not event.is_directory and event.src_path.endswith(".json"):
             execution_file_queue.put(event.src_path)
             logger.debug(f"Execution file added to queue: {event.src_path}")
 
@@ -73,67 +74,143 @@ async def process_rpc_files(config):
         # TODO: Implement the actual file processing logic here
 
 
-async def process_execution_files(config, batch_size_limit=2000):
-    batched_execution_data = []
-    file_paths_to_requeue = []
+async def process_execution_files(config, batch_size_limit=None, dispatcher=None):
+    # Without an explicit limit the batch size adapts, see nadoo_batching
+    batching = get_batch_controller("file_watcher")
+    limits = batching.get_limits(execution_file_queue.qsize())
+    batch_size_limit = batch_size_limit or limits.count
+    # Encoded into the email while reading, see StreamingBatchMessage
+    message = StreamingBatchMessage(
+        "Batched Executions", config["EMAIL"], config["DESTINATION_EMAIL"]
+    )
+    rows = []
+    batched_file_paths = []
+    trace = BatchTrace()
 
-    while (
-        len(batched_execution_data) < batch_size_limit
-        and not execution_file_queue.empty()
-    ):
+    while len(rows) < batch_size_limit and not execution_file_queue.empty():
         file_path = execution_file_queue.get()
+        if dispatcher is not None and dispatcher.is_claimed(file_path):
+            continue  # Already part of a batch in flight
+        if get_retry_queue("file_watcher").is_held(file_path):
+            continue  # Sent with its queued batch
 
         try:
-            with open(file_path, "r") as file:
-                execution_data = json.load(file)
-            batched_execution_data.append(execution_data)
-            file_paths_to_requeue.append(file_path)
+            execution_data, created, spooled = read_traced_record(file_path)
+        except FileNotFoundError:
+            logger.debug(f"Execution file already processed: {file_path}")
+            continue
         except json.JSONDecodeError:
             logger.error(f"Invalid JSON in file: {file_path}")
-
-    if batched_execution_data:
-        email_content = json.dumps(batched_execution_data)
-        email_sent = await send_email(
-            "Batched Executions",
-            email_content,
-            config["DESTINATION_EMAIL"],
-            config["SMTP_SERVER"],
-            int(config["SMTP_PORT"]),
-            config["EMAIL"],
-            config["PASSWORD"],
+            continue
+        message.add(execution_data)
+        rows.append(get_execution_row(execution_data))
+        batched_file_paths.append(file_path)
+        trace.add(created, spooled)
+        if message.body_bytes >= limits.max_bytes:
+            break
+
+    if not rows:
+        message.close()
+        return False
+    trace.mark_batched()
+
+    async def send():
+        email_sent = await send_measured(
+            batching, lambda: send_config_batch(message, config), len(rows), message.body_bytes
         )
-
         if email_sent:
-            for data in batched_execution_data:
-                file_path = os.path.join(
-                    executions_dir, f"{data['execution_uuid']}.json"
-                )
-                os.remove(file_path)
-                record_execution_in_db(
-                    data["execution_uuid"], data["customer_program_uuid"], True
-                )
-            logger.info(
-                f"Batched email sent with {len(batched_execution_data)} execution files."
-            )
-        else:
-            # Re-queue the files for future processing
-            for file_path in file_paths_to_requeue:
-                execution_file_queue.put(file_path)
-            logger.warning(
-                "Failed to send batched email, re-queued the execution files for later processing."
-            )
+            trace.mark_emailed()
+        return email_sent
+
+    async def on_success():
+        message.close()
+        # Record before removing, so a failed insert leaves the spool files
+        await record_executions_in_db(rows)
+        for file_path in batched_file_paths:
+            os.remove(file_path)
+        trace.mark_recorded()
+        logger.info(
+            f"Batched email sent with {len(rows)} execution files."
+        )
+
+    async def on_failure():
+        # Kept with its encoded message and retried with backoff, see retry_due_batches
+        try:
+            get_retry_queue("file_watcher").add(batched_file_paths, rows, message)
+        finally:
+            message.close()
+
+    send, on_success = track_sent_batch("file_watcher", batched_file_paths, rows, send, on_success)
+    await dispatch_batch(dispatcher, batched_file_paths, send, on_success, on_failure)
+    return True
+
+
+async def send_config_batch(message, config):
+    return await send_batch_message(
+        message,
+        config["SMTP_SERVER"],
+        int(config["SMTP_PORT"]),
+        config["EMAIL"],
+        config["PASSWORD"],
+    )
+
+
+async def retry_due_batches(config, dispatcher):
+    retries = get_retry_queue("file_watcher")
+    while dispatcher.can_submit():
+        entry = retries.next_due(skip=dispatcher.is_claimed)
+        if entry is None:
+            return
+        await retry_batch(
+            retries,
+            entry,
+            lambda message: send_config_batch(message, config),
+            dispatcher,
+            get_batch_controller("file_watcher"),
+        )
 
 
 async def processing_loop(config):
+    dispatcher = get_dispatcher_for_email_account(
+        {
+            "email": config.get("EMAIL"),
+            "max_inflight_batches": config.get("MAX_INFLIGHT_BATCHES"),
+        }
+    )
     while True:
         await process_rpc_files(config)
-        await process_execution_files(config)
+        await retry_due_batches(config, dispatcher)
+        # Fill the free in-flight slots, then pause briefly
+        while dispatcher.can_submit() and not execution_file_queue.empty():
+            if not await process_execution_files(config, dispatcher=dispatcher):
+                break
         await asyncio.sleep(1)  # Brief pause to prevent constant looping
 
 
-def clear_rpc_directory():
-    for filename in os.listdir(staged_dir):
-        os.remove(os.path.join(staged_dir, filename))
+def resume_rpc_requests():
+    # Staged and awaited RPCs belong to callers that may still wait for them,
+    # so they are left for the sender, which sends them and receives replies.
+    # Only temporary files of writes cut short are removed.
+    pending = 0
+    cutoff = time.time() - 60  # Younger ones may still be renamed into place
+    for directory in (staged_dir, awaiting_response_dir):
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            continue
+        for filename in names:
+            path = os.path.join(directory, filename)
+            if filename.endswith(".tmp"):
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+            elif filename.endswith(".json"):
+                pending += 1
+    if pending:
+        logger.info(f"Resuming {pending} staged or awaited RPC requests.")
+        start_sender_loop_if_not_running()
 
 
 def start_watchers():
@@ -141,28 +218,33 @@ def start_watchers():
     execution_event_handler = ExecutionEventHandler()
     observer = Observer()
     observer.schedule(rpc_event_handler, path=staged_dir, recursive=False)
-    observer.schedule(execution_event_handler, path=executions_dir, recursive=False)
+    observer.schedule(execution_event_handler, path=executions_dir, recursive=True)
     observer.start()
     return observer
 
 
 def queue_existing_execution_files():
-    for filename in os.listdir(executions_dir):
-        if filename.endswith(".json"):
-            file_path = os.path.join(executions_dir, filename)
-            execution_file_queue.put(file_path)
+    # Oldest buckets first, so a backlog drains in creation order
+    migrate_flat_spool(executions_dir)
+    for file_path in iter_spool_files(executions_dir):
+        execution_file_queue.put(file_path)
 
 
 async def main():
-    clear_rpc_directory()
+    resume_rpc_requests()
+    await open_spool_manifest("file_watcher")
     queue_existing_execution_files()  # Queue existing execution files
     config = await load_or_request_config()
     observer = start_watchers()
     processing_task = asyncio.create_task(processing_loop(config))
+    retention_task = asyncio.create_task(retention_loop(config=config))
+    instrumentation_task = asyncio.create_task(instrumentation_loop())
 
     try:
         await processing_task
     finally:
+        retention_task.cancel()
+        instrumentation_task.cancel()
         observer.stop()
         observer.join()
 
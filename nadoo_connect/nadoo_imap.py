@@ -0,0 +1,354 @@
+import re
+import ssl
+import time
+import asyncio
+import logging
+
+from .nadoo_email import email_account_db_name, log_errors
+from .nadoo_storage import get_storage
+
+
+logger = logging.getLogger(__name__)
+
+# IMAP settings
+imap_timeout = 30  # Seconds to wait for any server response outside of IDLE
+imap_idle_timeout = 300  # Seconds before IDLE is renewed (servers drop it after 30 minutes)
+imap_poll_interval = 5  # Seconds between checks on servers without IDLE
+imap_fetch_chunk = 50  # Messages per UID FETCH
+
+literal_pattern = re.compile(rb"\{(\d+)\}\r\n$")
+uid_pattern = re.compile(rb"UID (\d+)")
+
+
+class IMAPError(Exception):
+    """Raised when the IMAP server answers NO or BAD."""
+
+
+def quote_imap_string(value):
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class AsyncIMAPClient:
+    """
+    Small asyncio IMAP4rev1 client for following one mailbox by UID.
+
+    Only what reply delivery needs: LOGIN, SELECT, UID SEARCH, UID FETCH of
+    whole messages and IDLE (RFC 2177), which pushes new mail to the client.
+    """
+
+    def __init__(self, host, port, use_ssl=True, timeout=None):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout or imap_timeout
+        self.reader = None
+        self.writer = None
+        self.capabilities = set()
+        self._tag = 0
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.logout()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                self.host,
+                self.port,
+                ssl=ssl.create_default_context() if self.use_ssl else None,
+            ),
+            self.timeout,
+        )
+        await self.read_line()  # Greeting
+        await self.refresh_capabilities()
+
+    async def read_line(self, timeout=None):
+        line = await asyncio.wait_for(self.reader.readline(), timeout or self.timeout)
+        if not line:
+            raise ConnectionError("Connection closed by the IMAP server.")
+        return line
+
+    async def send(self, command):
+        self._tag += 1
+        tag = f"N{self._tag:04d}"
+        self.writer.write(f"{tag} {command}\r\n".encode("utf-8"))
+        await self.writer.drain()
+        return tag
+
+    async def read_response(self, tag):
+        """
+        Reads untagged responses until the tagged completion.
+
+        :return: A list of (line, literals) per untagged response, where the
+            line includes the text around any literals.
+        """
+        responses = []
+        while True:
+            line = await self.read_line()
+            literals = []
+            while literal_pattern.search(line):
+                size = int(literal_pattern.search(line).group(1))
+                literals.append(
+                    await asyncio.wait_for(self.reader.readexactly(size), self.timeout)
+                )
+                line += await self.read_line()
+            if line.startswith(tag.encode("ascii") + b" "):
+                if line.split()[1].upper() != b"OK":
+                    raise IMAPError(line.decode("utf-8", "replace").strip())
+                return responses
+            responses.append((line, literals))
+
+    async def command(self, command):
+        return await self.read_response(await self.send(command))
+
+    async def refresh_capabilities(self):
+        self.capabilities = set()
+        for line, _ in await self.command("CAPABILITY"):
+            if line.startswith(b"* CAPABILITY"):
+                self.capabilities.update(
+                    word.upper() for word in line.decode("utf-8", "replace").split()[2:]
+                )
+        return self.capabilities
+
+    async def login(self, user, password):
+        await self.command(f"LOGIN {quote_imap_string(user)} {quote_imap_string(password)}")
+        await self.refresh_capabilities()  # Servers may announce more after login
+
+    async def select(self, mailbox="INBOX"):
+        """
+        :return: (UIDVALIDITY, UIDNEXT); UIDNEXT may be None.
+        """
+        uidvalidity = None
+        uidnext = None
+        for line, _ in await self.command(f"SELECT {quote_imap_string(mailbox)}"):
+            match = re.search(rb"\[UIDVALIDITY (\d+)\]", line)
+            if match:
+                uidvalidity = int(match.group(1))
+            match = re.search(rb"\[UIDNEXT (\d+)\]", line)
+            if match:
+                uidnext = int(match.group(1))
+        return uidvalidity, uidnext
+
+    async def uid_search(self, criteria):
+        uids = []
+        for line, _ in await self.command(f"UID SEARCH {criteria}"):
+            if line.startswith(b"* SEARCH"):
+                uids.extend(int(word) for word in line.split()[2:])
+        return sorted(uids)
+
+    async def uid_fetch_messages(self, uids):
+        """
+        Fetches whole messages without setting the seen flag.
+
+        :return: A list of (uid, message bytes), in UID order.
+        """
+        if not uids:
+            return []
+        uid_set = ",".join(str(uid) for uid in uids)
+        messages = []
+        for line, literals in await self.command(f"UID FETCH {uid_set} (UID BODY.PEEK[])"):
+            match = uid_pattern.search(line)
+            if match and literals:
+                messages.append((int(match.group(1)), literals[0]))
+        return sorted(messages)
+
+    async def idle(self, timeout=None):
+        """
+        Waits in IDLE until the server reports new mail or the timeout passes.
+
+        :return: True if new mail was announced.
+        """
+        timeout = timeout or imap_idle_timeout
+        tag = await self.send("IDLE")
+        line = await self.read_line()
+        if not line.startswith(b"+"):
+            raise IMAPError(line.decode("utf-8", "replace").strip())
+
+        new_mail = False
+        deadline = time.monotonic() + timeout
+        try:
+            while not new_mail:
+                line = await self.read_line(max(0.001, deadline - time.monotonic()))
+                new_mail = line.startswith(b"*") and line.rstrip().upper().endswith(b"EXISTS")
+        except asyncio.TimeoutError:
+            pass
+        self.writer.write(b"DONE\r\n")
+        await self.writer.drain()
+        await self.read_response(tag)
+        return new_mail
+
+    async def noop(self):
+        await self.command("NOOP")
+
+    async def logout(self):
+        if self.writer is None:
+            return
+        try:
+            await self.command("LOGOUT")
+        except (IMAPError, OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.writer.close()
+            self.writer = None
+
+
+def setup_imap_tables(conn):
+    # Kept apart from email_accounts, which only knows POP3 and SMTP
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS imap_accounts (
+            email TEXT PRIMARY KEY,
+            imap_server TEXT,
+            imap_port INTEGER,  -- Typically 993 for SSL/TLS
+            use_ssl BOOLEAN DEFAULT 1,
+            mailbox TEXT DEFAULT 'INBOX',
+            password TEXT       -- NULL uses the password in email_accounts
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS imap_state (
+            email TEXT,
+            mailbox TEXT,
+            uidvalidity INTEGER,
+            last_uid INTEGER,   -- Highest UID handed to on_message
+            PRIMARY KEY (email, mailbox)
+        );
+        """
+    )
+
+
+@log_errors
+@email_account_db_name
+async def save_imap_account(*, email_account_db_name: str, imap_account):
+    await get_storage(email_account_db_name).write(
+        lambda conn: conn.execute(
+            """
+            INSERT OR REPLACE INTO imap_accounts (email, imap_server, imap_port, use_ssl, mailbox, password)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                imap_account["email"],
+                imap_account["imap_server"],
+                imap_account["imap_port"],
+                imap_account.get("use_ssl", True),
+                imap_account.get("mailbox") or "INBOX",
+                imap_account.get("password"),
+            ),
+        ),
+        setup=setup_imap_tables,
+    )
+
+
+@log_errors
+@email_account_db_name
+async def get_imap_account_for_email_address(email_address, email_account_db_name: str):
+    """
+    :return: The IMAP account dict, with the password from email_accounts if
+        it has none of its own, or None if the address has no IMAP account.
+    """
+    row = await get_storage(email_account_db_name).read(
+        lambda conn: conn.execute(
+            """
+            SELECT imap_accounts.email, imap_server, imap_port, use_ssl, mailbox,
+                   COALESCE(imap_accounts.password, email_accounts.password)
+            FROM imap_accounts
+            LEFT JOIN email_accounts ON email_accounts.email = imap_accounts.email
+            WHERE imap_accounts.email = ?
+            """,
+            (email_address,),
+        ).fetchone(),
+        setup=setup_imap_tables,
+    )
+    if row is None:
+        return None
+    keys = ["email", "imap_server", "imap_port", "use_ssl", "mailbox", "password"]
+    return dict(zip(keys, row))
+
+
+async def load_imap_state(storage, email_address, mailbox):
+    return await storage.read(
+        lambda conn: conn.execute(
+            "SELECT uidvalidity, last_uid FROM imap_state WHERE email = ? AND mailbox = ?",
+            (email_address, mailbox),
+        ).fetchone(),
+        setup=setup_imap_tables,
+    )
+
+
+async def save_imap_state(storage, email_address, mailbox, uidvalidity, last_uid):
+    await storage.write(
+        lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO imap_state (email, mailbox, uidvalidity, last_uid) VALUES (?, ?, ?, ?)",
+            (email_address, mailbox, uidvalidity, last_uid),
+        ),
+        setup=setup_imap_tables,
+    )
+
+
+async def watch_mailbox(
+    imap_account, on_message, should_stop, email_account_db_name, resync_since=None
+):
+    """
+    Hands every new message of the account's mailbox to on_message.
+
+    New mail is pushed with IDLE where the server supports it, otherwise the
+    mailbox is polled every imap_poll_interval seconds. The last handled UID
+    is stored per mailbox, so a reconnect continues where the last session
+    stopped. Without state, or when UIDVALIDITY changed, the mailbox is
+    resynced from the date of resync_since (a timestamp) instead.
+
+    :param on_message: Callable taking the message bytes.
+    :param should_stop: Callable; the watch ends once it returns True.
+    """
+    email_address = imap_account["email"]
+    mailbox = imap_account.get("mailbox") or "INBOX"
+    storage = get_storage(email_account_db_name)
+    async with AsyncIMAPClient(
+        imap_account["imap_server"],
+        int(imap_account["imap_port"]),
+        use_ssl=bool(imap_account.get("use_ssl", True)),
+    ) as client:
+        await client.login(email_address, imap_account["password"])
+        uidvalidity, uidnext = await client.select(mailbox)
+        state = await load_imap_state(storage, email_address, mailbox)
+
+        if state is not None and state[0] == uidvalidity:
+            last_uid = state[1]
+            resync_baseline = None
+            pending = await client.uid_search(f"UID {last_uid + 1}:*")
+        else:
+            logger.info(f"Resyncing {email_address}/{mailbox} (UIDVALIDITY {uidvalidity}).")
+            since = time.strftime("%d-%b-%Y", time.localtime(resync_since or time.time()))
+            pending = await client.uid_search(f"SINCE {since}")
+            # Everything older than UIDNEXT is covered by the search
+            last_uid = 0
+            resync_baseline = (uidnext or 1) - 1
+
+        use_idle = "IDLE" in client.capabilities
+        while True:
+            # "UID n:*" always matches the newest message, even below n
+            pending = [uid for uid in pending if uid > last_uid]
+            for start in range(0, len(pending), imap_fetch_chunk):
+                chunk = pending[start : start + imap_fetch_chunk]
+                for uid, message in await client.uid_fetch_messages(chunk):
+                    on_message(message)
+                last_uid = max(last_uid, chunk[-1])
+                await save_imap_state(storage, email_address, mailbox, uidvalidity, last_uid)
+            if resync_baseline is not None:
+                last_uid = max(last_uid, resync_baseline)
+                resync_baseline = None
+                await save_imap_state(storage, email_address, mailbox, uidvalidity, last_uid)
+
+            if should_stop():
+                return
+            if use_idle:
+                await client.idle()
+            else:
+                await asyncio.sleep(imap_poll_interval)
+                await client.noop()
+            pending = await client.uid_search(f"UID {last_uid + 1}:*")
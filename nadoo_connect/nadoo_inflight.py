@@ -0,0 +1,138 @@
+import time
+import asyncio
+import logging
+import traceback
+
+
+logger = logging.getLogger(__name__)
+
+default_max_inflight_batches = 4  # Batches sent at the same time per account
+max_inflight_batches_per_account = {}  # Email address -> limit, overrides the default
+failure_backoff = 10  # Seconds before a failing dispatcher accepts new batches
+
+
+# Helper function to get the in-flight batch limit for an email account
+def get_max_inflight_batches_for_email_account(email_account):
+    email_account = email_account or {}
+    email_address = email_account.get("email")
+    if email_address in max_inflight_batches_per_account:
+        return max_inflight_batches_per_account[email_address]
+    return int(email_account.get("max_inflight_batches") or default_max_inflight_batches)
+
+
+class InflightBatch:
+    def __init__(self, seq, keys):
+        self.seq = seq
+        self.keys = keys
+        self.started = time.monotonic()
+        self.task = None
+
+
+class InflightDispatcher:
+    """
+    Runs up to `limit` batch sends at the same time.
+
+    Every batch claims its keys (spool file names or journal offsets) so the
+    next scan does not pick them up again. A successful batch runs its
+    on_success callback (remove and record); a failed batch releases its keys
+    so they return to the queue, without holding up the other batches.
+
+    Batches get increasing sequence numbers; acked_through is the highest
+    sequence number up to which every batch has completed, for callers that
+    need ordered acknowledgement of a journal range.
+    """
+
+    def __init__(self, limit=None, name="default"):
+        self.limit = limit or default_max_inflight_batches
+        self.name = name
+        self.claimed = set()
+        self.inflight = {}
+        self.acked_through = -1
+        self.retry_after = 0
+        self._next_seq = 0
+        self._completed = set()
+        self._slot_freed = asyncio.Event()
+
+    def is_claimed(self, key):
+        return key in self.claimed
+
+    def available_slots(self):
+        return self.limit - len(self.inflight)
+
+    def can_submit(self):
+        return self.available_slots() > 0 and time.monotonic() >= self.retry_after
+
+    async def wait_for_slot(self):
+        while self.available_slots() <= 0:
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+
+    async def submit(self, keys, send, on_success=None, on_failure=None):
+        """
+        Starts sending a batch in the background once a slot is free.
+
+        :param keys: The keys this batch claims.
+        :param send: Coroutine function returning True if the batch was accepted.
+        :param on_success: Coroutine function run after a successful send.
+        :param on_failure: Coroutine function run after a failed send, once the
+            keys have been released.
+        :return: The InflightBatch.
+        """
+        await self.wait_for_slot()
+        batch = InflightBatch(self._next_seq, list(keys))
+        self._next_seq += 1
+        self.claimed.update(batch.keys)
+        self.inflight[batch.seq] = batch
+        batch.task = asyncio.create_task(
+            self._run(batch, send, on_success, on_failure)
+        )
+        return batch
+
+    async def _run(self, batch, send, on_success, on_failure):
+        try:
+            try:
+                sent = await send()
+            except Exception as e:
+                logger.error(f"Error sending batch {batch.seq}: {e}\n{traceback.format_exc()}")
+                sent = False
+
+            if sent and on_success is not None:
+                await on_success()
+            if sent:
+                logger.debug(
+                    f"{self.name}: batch {batch.seq} acknowledged after "
+                    f"{time.monotonic() - batch.started:.2f}s"
+                )
+            else:
+                self.retry_after = time.monotonic() + failure_backoff
+                self.claimed.difference_update(batch.keys)
+                if on_failure is not None:
+                    await on_failure()
+            return sent
+        finally:
+            self.claimed.difference_update(batch.keys)
+            del self.inflight[batch.seq]
+            self._completed.add(batch.seq)
+            while self.acked_through + 1 in self._completed:
+                self.acked_through += 1
+                self._completed.discard(self.acked_through)
+            self._slot_freed.set()
+
+    async def drain(self):
+        tasks = [batch.task for batch in self.inflight.values()]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+dispatchers = {}  # Email address -> InflightDispatcher
+
+
+def get_dispatcher_for_email_account(email_account):
+    email_address = (email_account or {}).get("email")
+    limit = get_max_inflight_batches_for_email_account(email_account)
+    dispatcher = dispatchers.get(email_address)
+    if dispatcher is None:
+        dispatcher = InflightDispatcher(limit, name=email_address or "default")
+        dispatchers[email_address] = dispatcher
+    dispatcher.limit = limit
+    return dispatcher
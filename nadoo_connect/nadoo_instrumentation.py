@@ -0,0 +1,268 @@
+import os
+import sys
+import time
+import signal
+import asyncio
+import cProfile
+import logging
+import threading
+import traceback
+from collections import Counter
+
+
+logger = logging.getLogger(__name__)
+
+# Instrumentation settings
+diagnostics_dir = "logs"  # Trigger files are looked for here, dumps and profiles go here
+loop_lag_interval = 0.5  # Seconds between event loop lag probes
+loop_lag_warn = 0.1  # Lag in seconds that is logged as a warning
+slow_callback_duration = 0.25  # A loop stalled this long gets the blocking stack logged
+dump_trigger_name = "dump_stacks"  # Touch this file to dump all task stacks
+profile_trigger_name = "profile"  # Touch this file (content: seconds, format) to profile
+profile_default_seconds = 10
+profile_sample_interval = 0.005  # Seconds between stack samples of the collapsed profiler
+trigger_check_interval = 2  # Seconds between checks for trigger files
+
+loop_lag_stats = {"samples": 0, "last": 0.0, "max": 0.0, "over_warn": 0, "stalls": 0}
+
+
+def format_frame_stack(frame):
+    return "".join(traceback.format_stack(frame))
+
+
+def dump_all_task_stacks(file=None):
+    """
+    Writes the stack of every asyncio task of the running loop.
+
+    :param file: Text file to write to; a timestamped file in diagnostics_dir
+        when None.
+    :return: The path written to, or None when a file object was given.
+    """
+    path = None
+    if file is None:
+        os.makedirs(diagnostics_dir, exist_ok=True)
+        path = os.path.join(
+            diagnostics_dir, f"task-stacks-{os.getpid()}-{int(time.time())}.txt"
+        )
+        file = open(path, "w")
+    try:
+        tasks = asyncio.all_tasks()
+        file.write(f"{len(tasks)} tasks in process {os.getpid()}\n")
+        for task in tasks:
+            file.write(f"\n{task!r}\n")
+            task.print_stack(file=file)
+    finally:
+        if path is not None:
+            file.close()
+            logger.info(f"Dumped task stacks to {path}.")
+    return path
+
+
+class StallWatchdog(threading.Thread):
+    """
+    Logs what the event loop thread is running while the loop is blocked.
+
+    loop_lag_monitor ticks the watchdog on every probe. When no tick arrived for
+    slow_callback_duration seconds, a callback is blocking the loop, and the
+    watchdog logs the loop thread's current stack once per stall. This costs
+    nothing while the loop is healthy, unlike asyncio's debug mode.
+    """
+
+    def __init__(self, loop_thread_id, threshold=None):
+        super().__init__(name="nadoo-stall-watchdog", daemon=True)
+        self.loop_thread_id = loop_thread_id
+        self.threshold = threshold or slow_callback_duration
+        self.last_tick = time.monotonic()
+        self.stopped = threading.Event()
+
+    def tick(self):
+        self.last_tick = time.monotonic()
+
+    def run(self):
+        reported_tick = None
+        while not self.stopped.wait(self.threshold / 2):
+            stalled_for = time.monotonic() - self.last_tick
+            if stalled_for < self.threshold + loop_lag_interval:
+                continue
+            if reported_tick == self.last_tick:
+                continue  # Already reported this stall
+            reported_tick = self.last_tick
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            loop_lag_stats["stalls"] += 1
+            logger.warning(
+                f"Event loop blocked for {stalled_for:.2f}s, currently running:\n"
+                f"{format_frame_stack(frame)}"
+            )
+
+    def stop(self):
+        self.stopped.set()
+
+
+async def loop_lag_monitor(interval=None, warn_after=None, watchdog=None):
+    # A sleep that wakes up late measures how long other callbacks held the loop
+    interval = interval or loop_lag_interval
+    warn_after = loop_lag_warn if warn_after is None else warn_after
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.monotonic() - started - interval)
+        if watchdog is not None:
+            watchdog.tick()
+        loop_lag_stats["samples"] += 1
+        loop_lag_stats["last"] = lag
+        loop_lag_stats["max"] = max(loop_lag_stats["max"], lag)
+        if lag >= warn_after:
+            loop_lag_stats["over_warn"] += 1
+            logger.warning(f"Event loop lag of {lag:.3f}s.")
+
+
+def get_loop_lag_stats():
+    return dict(loop_lag_stats)
+
+
+def sample_collapsed_stacks(thread_id, seconds, interval=None):
+    """
+    Samples one thread's stack and counts identical stacks.
+
+    :return: A Counter of "file:function;file:function" stacks, root first.
+    """
+    interval = interval or profile_sample_interval
+    samples = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        if stack:
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return samples
+
+
+def write_collapsed_stacks(samples, path):
+    with open(path, "w") as file:
+        for stack, count in samples.most_common():
+            file.write(f"{stack} {count}\n")
+
+
+async def profile_for(seconds=None, output_format="collapsed", path=None):
+    """
+    Profiles the event loop thread for a number of seconds while it keeps running.
+
+    :param seconds: Duration; profile_default_seconds by default.
+    :param output_format: "collapsed" samples stacks from a helper thread and
+        writes one "stack count" line per distinct stack (flame graph input);
+        "pstats" runs cProfile on the loop thread and writes a pstats file.
+    :return: The path of the written profile.
+    """
+    seconds = seconds or profile_default_seconds
+    if output_format not in ("collapsed", "pstats"):
+        raise ValueError(f"Unknown profile format: {output_format}")
+    os.makedirs(diagnostics_dir, exist_ok=True)
+    extension = "folded" if output_format == "collapsed" else "pstats"
+    path = path or os.path.join(
+        diagnostics_dir, f"profile-{os.getpid()}-{int(time.time())}.{extension}"
+    )
+
+    logger.info(f"Profiling for {seconds}s ({output_format}).")
+    if output_format == "collapsed":
+        samples = await asyncio.get_running_loop().run_in_executor(
+            None, sample_collapsed_stacks, threading.get_ident(), seconds
+        )
+        write_collapsed_stacks(samples, path)
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        profiler.dump_stats(path)
+    logger.info(f"Wrote profile to {path}.")
+    return path
+
+
+def read_profile_trigger(path):
+    # The trigger file may hold "<seconds> [collapsed|pstats]"
+    try:
+        with open(path, "r") as file:
+            words = file.read().split()
+        os.remove(path)
+    except FileNotFoundError:
+        return None
+    seconds = profile_default_seconds
+    output_format = "collapsed"
+    try:
+        if words:
+            seconds = float(words[0])
+        if len(words) > 1:
+            output_format = words[1]
+    except ValueError:
+        logger.warning(f"Ignoring malformed profile trigger: {words}")
+    return seconds, output_format
+
+
+async def check_triggers(directory=None):
+    directory = directory or diagnostics_dir
+    dump_trigger = os.path.join(directory, dump_trigger_name)
+    if os.path.exists(dump_trigger):
+        try:
+            os.remove(dump_trigger)
+        except FileNotFoundError:
+            pass
+        dump_all_task_stacks()
+
+    trigger = read_profile_trigger(os.path.join(directory, profile_trigger_name))
+    if trigger is not None:
+        seconds, output_format = trigger
+        try:
+            await profile_for(seconds, output_format)
+        except ValueError as e:
+            logger.warning(str(e))
+
+
+async def instrumentation_loop(directory=None):
+    """
+    Runs the lag monitor, the stall watchdog and the trigger file checks.
+
+    Stacks can also be dumped with SIGUSR1 where signals are available. Start
+    it as a task next to the process's main loop and cancel it on shutdown.
+    """
+    loop = asyncio.get_running_loop()
+    watchdog = StallWatchdog(threading.get_ident())
+    watchdog.start()
+    lag_task = asyncio.create_task(loop_lag_monitor(watchdog=watchdog))
+    signal_installed = False
+    if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+        loop.add_signal_handler(signal.SIGUSR1, dump_all_task_stacks)
+        signal_installed = True
+    try:
+        while True:
+            try:
+                await check_triggers(directory)
+            except OSError as e:
+                logger.warning(f"Unable to handle diagnostics trigger: {e}")
+            await asyncio.sleep(trigger_check_interval)
+    finally:
+        lag_task.cancel()
+        watchdog.stop()
+        if signal_installed:
+            loop.remove_signal_handler(signal.SIGUSR1)
+
+
+if __name__ == "__main__":
+    # Sends the triggers to a running process: dump, or profile [seconds] [format]
+    args = sys.argv[1:]
+    os.makedirs(diagnostics_dir, exist_ok=True)
+    if args[:1] == ["dump"]:
+        open(os.path.join(diagnostics_dir, dump_trigger_name), "w").close()
+    elif args[:1] == ["profile"]:
+        with open(os.path.join(diagnostics_dir, profile_trigger_name), "w") as file:
+            file.write(" ".join(args[1:]))
+    else:
+        print("Usage: python -m nadoo_connect.nadoo_instrumentation [dump|profile [seconds] [collapsed|pstats]]")
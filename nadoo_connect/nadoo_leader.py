@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import portalocker
+
+
+logger = logging.getLogger(__name__)
+
+executions_dir = "executions"
+leader_lock_name = "leader.lock"  # Held by the one running sender for its lifetime
+heartbeat_name = "sender.heartbeat"  # Touched by the running sender
+spawn_claim_name = "sender.spawning"  # Created by the producer that spawns a sender
+heartbeat_interval = 2  # Seconds between heartbeats
+heartbeat_stale_after = 3 * heartbeat_interval  # A sender is considered dead after this
+spawn_claim_timeout = 15  # Seconds a spawn claim blocks other producers from spawning
+liveness_cache_ttl = 0.5  # Seconds a liveness check is reused within one process
+
+_liveness_cache = {"checked_at": 0.0, "alive": False}
+
+
+def get_leader_path(name, directory=None):
+    return os.path.join(directory or executions_dir, name)
+
+
+def write_file_exclusive(path, content):
+    """
+    Publishes a file atomically without any shared lock.
+
+    The content goes to a temporary file created with O_EXCL, so no two writers
+    ever share it, and is then renamed into place. Readers never see a partial
+    file, and the temporary name does not end in .json, so scans skip it.
+    """
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+    fd = os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(content)
+        os.rename(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def read_heartbeat(directory=None):
+    try:
+        with open(get_leader_path(heartbeat_name, directory), "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def is_sender_alive(directory=None, max_age=None):
+    """
+    Cheap liveness check used on every create_execution.
+
+    One stat of the heartbeat file, reused for liveness_cache_ttl seconds, so
+    the producer path never touches the sender's lock.
+    """
+    max_age = liveness_cache_ttl if max_age is None else max_age
+    now = time.monotonic()
+    if now - _liveness_cache["checked_at"] <= max_age:
+        return _liveness_cache["alive"]
+    try:
+        age = time.time() - os.stat(get_leader_path(heartbeat_name, directory)).st_mtime
+        alive = age < heartbeat_stale_after
+    except FileNotFoundError:
+        alive = False
+    _liveness_cache.update(checked_at=now, alive=alive)
+    return alive
+
+
+def claim_spawn(directory=None):
+    """
+    Lets exactly one producer spawn a sender when none is alive.
+
+    :return: True if this process should spawn the sender.
+    """
+    path = get_leader_path(spawn_claim_name, directory)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        os.write(fd, str(os.getpid()).encode("utf-8"))
+        os.close(fd)
+        return True
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(path) > spawn_claim_timeout:
+                # The spawning producer or its sender died; take over the claim
+                os.remove(path)
+                return claim_spawn(directory)
+        except FileNotFoundError:
+            return claim_spawn(directory)
+        return False
+
+
+def release_spawn_claim(directory=None):
+    try:
+        os.remove(get_leader_path(spawn_claim_name, directory))
+    except FileNotFoundError:
+        pass
+
+
+def try_acquire_leadership(directory=None):
+    """
+    Tries to become the single sender without waiting.
+
+    :return: The acquired portalocker.Lock, or None if another sender leads.
+    """
+    lock = portalocker.Lock(
+        get_leader_path(leader_lock_name, directory),
+        mode="a",
+        timeout=0,
+        fail_when_locked=True,
+    )
+    try:
+        lock.acquire()
+        return lock
+    except (portalocker.exceptions.LockException, portalocker.exceptions.AlreadyLocked):
+        return None
+
+
+def write_heartbeat(state="active", directory=None, **details):
+    heartbeat = {"pid": os.getpid(), "heartbeat": time.time(), "state": state}
+    heartbeat.update(details)
+    write_file_exclusive(get_leader_path(heartbeat_name, directory), json.dumps(heartbeat))
+
+
+def clear_heartbeat(directory=None):
+    try:
+        os.remove(get_leader_path(heartbeat_name, directory))
+    except FileNotFoundError:
+        pass
+
+
+async def heartbeat_loop(get_details=None, directory=None):
+    # get_details returns extra fields (state, latencies) for the heartbeat file
+    while True:
+        details = get_details() if get_details else {}
+        try:
+            write_heartbeat(directory=directory, **details)
+        except OSError as e:
+            logger.warning(f"Unable to write heartbeat: {e}")
+        await asyncio.sleep(heartbeat_interval)
@@ -0,0 +1,83 @@
+import time
+import logging
+from collections import deque
+
+from .nadoo_leader import read_heartbeat
+
+
+logger = logging.getLogger(__name__)
+
+# Sender lifecycle settings
+sender_lifecycle_policy = "standby"  # "standby" keeps an idle sender warm, "exit" stops it
+standby_timeout = None  # Seconds in standby before the sender exits, None stays forever
+standby_poll_interval = 0.5  # Seconds between checks for new work while in standby
+lifecycle_policies = ("standby", "exit")
+
+
+class SenderLifecycle:
+    """
+    Tracks the sender state (starting, active, standby) and its start latencies.
+
+    cold_start_latency is the time from a producer requesting a sender process
+    until that sender is ready to send. Warm start latency is the age of the
+    oldest waiting item when a sender in standby picks up work again.
+    """
+
+    def __init__(self, spawn_requested_at=None, policy=None):
+        self.policy = policy or sender_lifecycle_policy
+        if self.policy not in lifecycle_policies:
+            raise ValueError(f"Unknown sender lifecycle policy: {self.policy}")
+        self.spawn_requested_at = spawn_requested_at
+        self.state = "starting"
+        self.cold_start_latency = None
+        self.warm_start_latencies = deque(maxlen=100)
+        self.standby_since = None
+
+    def mark_ready(self):
+        self.state = "active"
+        if self.spawn_requested_at is not None:
+            self.cold_start_latency = time.time() - self.spawn_requested_at
+            logger.info(f"Sender cold start took {self.cold_start_latency:.3f}s.")
+
+    def enter_standby(self):
+        self.state = "standby"
+        self.standby_since = time.monotonic()
+        logger.info("Sender idle, entering standby.")
+
+    def wake(self, waiting_for):
+        """
+        :param waiting_for: Seconds the oldest item has been waiting.
+        """
+        self.state = "active"
+        self.standby_since = None
+        self.warm_start_latencies.append(waiting_for)
+        logger.info(f"Sender woke from standby, warm start took {waiting_for:.3f}s.")
+
+    def standby_expired(self):
+        return (
+            self.state == "standby"
+            and standby_timeout is not None
+            and time.monotonic() - self.standby_since > standby_timeout
+        )
+
+    def as_dict(self):
+        warm = sorted(self.warm_start_latencies)
+        return {
+            "state": self.state,
+            "policy": self.policy,
+            "cold_start_latency": self.cold_start_latency,
+            "warm_start_count": len(warm),
+            "last_warm_start_latency": (
+                self.warm_start_latencies[-1] if self.warm_start_latencies else None
+            ),
+            "median_warm_start_latency": warm[len(warm) // 2] if warm else None,
+        }
+
+
+def get_sender_lifecycle_stats(directory=None):
+    """
+    Reports the running sender's state and start latencies from its heartbeat.
+
+    :return: The heartbeat dict, or None if no sender is running.
+    """
+    return read_heartbeat(directory)
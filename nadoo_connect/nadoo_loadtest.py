@@ -0,0 +1,455 @@
+import os
+import sys
+import json
+import time
+import email
+import random
+import signal
+import asyncio
+import argparse
+import tempfile
+import multiprocessing
+from datetime import datetime
+
+
+# Load test settings
+sample_interval = 1.0  # Seconds between backlog and sender resource samples
+drain_timeout = 60  # Seconds to wait for the backlog to drain after producing
+burst_shapes = ("steady", "poisson", "burst")
+transports = ("smtp", "directory")
+timestamp_format = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def get_percentiles(values, quantiles=(0.5, 0.95, 0.99)):
+    # Nearest rank on the sorted samples
+    if not values:
+        return {f"p{int(q * 100)}": None for q in quantiles}
+    values = sorted(values)
+    return {
+        f"p{int(q * 100)}": round(values[min(len(values) - 1, int(q * len(values)))], 4)
+        for q in quantiles
+    }
+
+
+class DeliveryStats:
+    """Counts delivered records and their end-to-end latency (created -> delivered)."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.executions = 0
+        self.rpcs = 0
+        self.latencies = []
+        self.first_at = None
+        self.last_at = None
+
+    def add_message(self, data, received_at=None):
+        received_at = received_at or time.time()
+        self.messages += 1
+        self.bytes += len(data)
+        self.first_at = self.first_at or received_at
+        self.last_at = received_at
+        message = email.message_from_bytes(data)
+        try:
+            records = json.loads(message.get_payload(decode=True))
+        except (TypeError, ValueError):
+            return
+        for record in records:
+            if "request_uuid" in record:
+                self.rpcs += 1
+            else:
+                self.executions += record.get("execution_count", 1)
+            try:
+                created = datetime.strptime(record["timestamp"], timestamp_format).timestamp()
+                self.latencies.append(received_at - created)
+            except (KeyError, TypeError, ValueError):
+                pass
+
+
+class SmtpSink:
+    """
+    Minimal local SMTP server that accepts everything and counts deliveries.
+
+    Speaks just enough ESMTP (EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA) for
+    send_email with smtp_use_tls off.
+    """
+
+    def __init__(self, stats, host="127.0.0.1", port=0):
+        self.stats = stats
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        writer.write(b"220 nadoo-loadtest ESMTP\r\n")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line[:4].upper()
+                if command == b"EHLO":
+                    writer.write(b"250-nadoo-loadtest\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+                elif command == b"AUTH":
+                    if line.split()[1].upper() == b"LOGIN":
+                        # Username and password prompts, answers are not checked
+                        for prompt in (b"334 VXNlcm5hbWU6\r\n", b"334 UGFzc3dvcmQ6\r\n"):
+                            writer.write(prompt)
+                            await writer.drain()
+                            await reader.readline()
+                    writer.write(b"235 2.7.0 Authentication successful\r\n")
+                elif command == b"DATA":
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    await writer.drain()
+                    lines = []
+                    while True:
+                        data_line = await reader.readline()
+                        if data_line in (b".\r\n", b""):
+                            break
+                        if data_line.startswith(b".."):
+                            data_line = data_line[1:]
+                        lines.append(data_line)
+                    self.stats.add_message(b"".join(lines))
+                    writer.write(b"250 2.0.0 Queued\r\n")
+                elif command == b"QUIT":
+                    writer.write(b"221 2.0.0 Bye\r\n")
+                    break
+                elif command in (b"HELO", b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+                    writer.write(b"250 OK\r\n")
+                else:
+                    writer.write(b"502 5.5.2 Command not implemented\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def collect_dropped_messages(directory, stats, seen):
+    # Directory transport: every .eml dropped by the sender is one batch
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith(".eml")]
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name in seen:
+            continue
+        seen.add(name)
+        path = os.path.join(directory, name)
+        with open(path, "rb") as file:
+            stats.add_message(file.read(), os.path.getmtime(path))
+
+
+def get_process_usage(pid):
+    """
+    Reads CPU seconds and resident memory of a process from /proc.
+
+    :return: (cpu_seconds, rss_bytes), or None if the process is gone or /proc
+        is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "r") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status", "r") as file:
+            rss_kb = next(
+                int(line.split()[1]) for line in file if line.startswith("VmRSS:")
+            )
+    except (FileNotFoundError, ProcessLookupError, StopIteration, IndexError):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    # utime and stime are fields 14 and 15 of stat, 12 and 13 after the name
+    return (int(fields[11]) + int(fields[12])) / ticks, rss_kb * 1024
+
+
+def get_next_delays(shape, rate, burst_size):
+    """
+    Yields (delay, count): wait delay seconds, then produce count operations.
+    """
+    while True:
+        if shape == "poisson":
+            yield random.expovariate(rate), 1
+        elif shape == "burst":
+            yield burst_size / rate, burst_size
+        else:
+            yield 1 / rate, 1
+
+
+async def produce(rate, duration, shape, burst_size, rpc_ratio):
+    # Imported here: nadoo_connect sets up its log file relative to the
+    # working directory, which the load test chooses first.
+    from .nadoo_connect import (
+        SpoolFullError,
+        create_execution,
+        stage_rpc_request,
+        start_sender_loop_if_not_running,
+    )
+
+    stats = {"executions": 0, "rpcs": 0, "rejected": 0, "call_latencies": []}
+    deadline = time.monotonic() + duration
+    next_at = time.monotonic()
+    for delay, count in get_next_delays(shape, rate, burst_size):
+        if next_at >= deadline:
+            break
+        await asyncio.sleep(max(0, next_at - time.monotonic()))
+        for _ in range(count):
+            started = time.monotonic()
+            try:
+                if random.random() < rpc_ratio:
+                    stage_rpc_request("loadtest", {})
+                    start_sender_loop_if_not_running()
+                    stats["rpcs"] += 1
+                else:
+                    await create_execution("loadtest")
+                    stats["executions"] += 1
+            except SpoolFullError:
+                stats["rejected"] += 1
+            stats["call_latencies"].append(time.monotonic() - started)
+        next_at += delay
+    return stats
+
+
+def run_producer(rate, duration, shape, burst_size, rpc_ratio, results):
+    results.put(asyncio.run(produce(rate, duration, shape, burst_size, rpc_ratio)))
+
+
+def prepare_workdir(workdir, transport, smtp_port):
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    from .nadoo_email import save_email_account, setup_database
+
+    setup_database()
+    asyncio.run(
+        save_email_account(
+            email_account={
+                "email": "loadtest@localhost",
+                "pop_server": None,
+                "pop_port": None,
+                "smtp_server": "127.0.0.1",
+                "smtp_port": smtp_port,
+                "password": "loadtest",
+                "is_default": True,
+            }
+        )
+    )
+    os.environ["NADOO_EMAIL_TRANSPORT"] = transport
+    os.environ["NADOO_EMAIL_DROP_DIR"] = os.path.join(workdir, "outbox")
+    os.environ["NADOO_SMTP_USE_TLS"] = "0"
+
+
+def get_backlog(executions_dir, staged_dir):
+    from .nadoo_spool import scan_spool_depth
+
+    records, _ = scan_spool_depth(executions_dir)
+    try:
+        staged = len([name for name in os.listdir(staged_dir) if name.endswith(".json")])
+    except FileNotFoundError:
+        staged = 0
+    return records + staged
+
+
+async def run_load_test(
+    producers=2,
+    rate=100.0,
+    duration=10.0,
+    shape="steady",
+    burst_size=50,
+    rpc_ratio=0.0,
+    transport="smtp",
+    workdir=None,
+):
+    """
+    Drives the producer -> spool -> sender -> transport pipeline and measures it.
+
+    :param producers: Number of producer processes.
+    :param rate: Target operations per second over all producers.
+    :param duration: Seconds to produce for.
+    :param shape: "steady", "poisson" (random arrivals) or "burst" (burst_size
+        operations at once).
+    :param rpc_ratio: Share of operations that are RPCs instead of executions.
+    :param transport: "smtp" (local sink) or "directory" (messages dropped as files).
+    :param workdir: Working directory for spool and databases; a temporary
+        directory by default. The load test changes into it.
+    :return: The report dict.
+    """
+    if shape not in burst_shapes:
+        raise ValueError(f"Unknown burst shape: {shape}")
+    if transport not in transports:
+        raise ValueError(f"Unknown transport: {transport}")
+
+    delivered = DeliveryStats()
+    sink = SmtpSink(delivered)
+    smtp_port = await sink.start() if transport == "smtp" else 0
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix="nadoo-loadtest-"))
+    await asyncio.get_running_loop().run_in_executor(
+        None, prepare_workdir, workdir, transport, smtp_port
+    )
+
+    from .nadoo_connect import executions_dir, setup_directories_async, staged_dir
+    from .nadoo_leader import read_heartbeat
+
+    await setup_directories_async()
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=run_producer,
+            args=(rate / producers, duration, shape, burst_size, rpc_ratio, results),
+        )
+        for _ in range(producers)
+    ]
+    started = time.time()
+    for process in processes:
+        process.start()
+
+    samples = []
+    seen_drops = set()
+    sender_pid = None
+    first_usage = None
+    last_usage = None
+    drain_deadline = None
+    while True:
+        await asyncio.sleep(sample_interval)
+        if transport == "directory":
+            collect_dropped_messages(os.environ["NADOO_EMAIL_DROP_DIR"], delivered, seen_drops)
+        heartbeat = read_heartbeat(executions_dir) or {}
+        if heartbeat.get("pid"):
+            sender_pid = heartbeat["pid"]
+        usage = get_process_usage(sender_pid) if sender_pid else None
+        if usage is not None:
+            first_usage = first_usage or (time.time(), usage)
+            last_usage = (time.time(), usage)
+        backlog = get_backlog(executions_dir, staged_dir)
+        samples.append(
+            {
+                "t": round(time.time() - started, 2),
+                "backlog": backlog,
+                "delivered": delivered.executions + delivered.rpcs,
+                "sender_rss": usage[1] if usage else None,
+            }
+        )
+
+        if any(process.is_alive() for process in processes):
+            continue
+        drain_deadline = drain_deadline or time.monotonic() + drain_timeout
+        if backlog == 0 or time.monotonic() > drain_deadline:
+            break
+    finished = time.time()
+
+    produced = {"executions": 0, "rpcs": 0, "rejected": 0, "call_latencies": []}
+    for _ in processes:
+        result = results.get()
+        for key in produced:
+            produced[key] += result[key]
+    for process in processes:
+        process.join()
+
+    sender_stats = read_heartbeat(executions_dir) or {}
+    if sender_pid:
+        try:
+            os.kill(sender_pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    if transport == "smtp":
+        await sink.stop()
+
+    cpu_percent = None
+    if first_usage and last_usage and last_usage[0] > first_usage[0]:
+        cpu_percent = round(
+            100 * (last_usage[1][0] - first_usage[1][0]) / (last_usage[0] - first_usage[0]), 1
+        )
+    backlogs = [sample["backlog"] for sample in samples]
+    produce_samples = [sample for sample in samples if sample["t"] <= duration] or samples
+    return {
+        "workdir": workdir,
+        "settings": {
+            "producers": producers,
+            "rate": rate,
+            "duration": duration,
+            "shape": shape,
+            "rpc_ratio": rpc_ratio,
+            "transport": transport,
+        },
+        "produced": {
+            "executions": produced["executions"],
+            "rpcs": produced["rpcs"],
+            "rejected": produced["rejected"],
+            "rate": round((produced["executions"] + produced["rpcs"]) / duration, 1),
+            "call_latency": get_percentiles(produced["call_latencies"]),
+        },
+        "delivered": {
+            "executions": delivered.executions,
+            "rpcs": delivered.rpcs,
+            "messages": delivered.messages,
+            "bytes": delivered.bytes,
+            "throughput": round(
+                (delivered.executions + delivered.rpcs) / max(finished - started, 1e-9), 1
+            ),
+            "latency": get_percentiles(delivered.latencies),
+        },
+        "backlog": {
+            "max": max(backlogs, default=0),
+            "final": backlogs[-1] if backlogs else 0,
+            # Records per second the backlog grew while producing
+            "growth": round(
+                (produce_samples[-1]["backlog"] - produce_samples[0]["backlog"])
+                / max(produce_samples[-1]["t"] - produce_samples[0]["t"], 1e-9),
+                1,
+            )
+            if len(produce_samples) > 1
+            else 0.0,
+            "samples": samples,
+        },
+        "sender": {
+            "pid": sender_pid,
+            "cpu_percent": cpu_percent,
+            "max_rss": max((s["sender_rss"] or 0 for s in samples), default=0),
+            "stages": sender_stats.get("latency"),
+            "cold_start_latency": sender_stats.get("cold_start_latency"),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m nadoo_connect.nadoo_loadtest",
+        description="Load test the NADOO-Connect sender pipeline.",
+    )
+    parser.add_argument("--producers", type=int, default=2)
+    parser.add_argument("--rate", type=float, default=100.0, help="Operations per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to produce")
+    parser.add_argument("--shape", choices=burst_shapes, default="steady")
+    parser.add_argument("--burst-size", type=int, default=50)
+    parser.add_argument("--rpc-ratio", type=float, default=0.0)
+    parser.add_argument("--transport", choices=transports, default="smtp")
+    parser.add_argument("--workdir")
+    parser.add_argument("--samples", action="store_true", help="Include backlog samples")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(
+        run_load_test(
+            producers=args.producers,
+            rate=args.rate,
+            duration=args.duration,
+            shape=args.shape,
+            burst_size=args.burst_size,
+            rpc_ratio=args.rpc_ratio,
+            transport=args.transport,
+            workdir=args.workdir,
+        )
+    )
+    if not args.samples:
+        report["backlog"].pop("samples")
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import uuid
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Manifest settings. The manifest is a journal of one sending process's
+# outstanding work: batches in flight and RPCs awaiting a reply. Only the
+# process that sends (the leader) writes it.
+manifest_dir = "manifests"
+manifest_fsync = True  # Sync every event; events are per batch, not per record
+manifest_compact_min_lines = 1000  # Journal lines before compaction is considered
+manifest_compact_ratio = 4  # Compact once the journal holds this many lines per live entry
+
+
+class SpoolManifest:
+    """
+    The outstanding work of a sender, kept in an append-only journal.
+
+    Each line is {"op": "put", "key": ..., "entry": {...}} or
+    {"op": "remove", "key": ...}. Loading replays the journal and rewrites it
+    with only the live entries, so a restart costs time proportional to the
+    work that is still outstanding, not to the size of the spool or of
+    rpc_done. A torn last line (a crash mid-write) is ignored.
+
+    Entries:
+        "batch:<id>"  {"lane", "state": "inflight" | "emailed", "paths", "rows"}
+        "rpc:<uuid>"  {"state": "awaiting", "sent_at", "resends"}
+    """
+
+    def __init__(self, name, directory=None):
+        self.path = os.path.join(directory or manifest_dir, f"{name}.manifest")
+        self.entries = {}
+        self.lines = 0
+        self.file = None
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        try:
+            with open(self.path, "r") as file:
+                for line in file:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Skipping a torn line in {self.path}.")
+                        continue
+                    if event["op"] == "put":
+                        self.entries[event["key"]] = event["entry"]
+                    else:
+                        self.entries.pop(event["key"], None)
+        except FileNotFoundError:
+            pass
+        self.compact()
+
+    def compact(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            for key, entry in self.entries.items():
+                file.write(json.dumps({"op": "put", "key": key, "entry": entry}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        if self.file is not None:
+            self.file.close()
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "a")
+        self.lines = len(self.entries)
+
+    def append(self, event):
+        self.file.write(json.dumps(event) + "\n")
+        self.file.flush()
+        if manifest_fsync:
+            os.fsync(self.file.fileno())
+        self.lines += 1
+        if (
+            self.lines > manifest_compact_min_lines
+            and self.lines > manifest_compact_ratio * len(self.entries)
+        ):
+            self.compact()
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.append({"op": "put", "key": key, "entry": entry})
+
+    def remove(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.append({"op": "remove", "key": key})
+
+    def items(self, prefix=""):
+        return [(key, entry) for key, entry in self.entries.items() if key.startswith(prefix)]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def track_batch(manifest, lane, paths, rows, send, on_success, **details):
+    """
+    Wraps a batch's callbacks so the manifest shows it in flight, and as
+    emailed between a successful send and the end of on_success.
+
+    :param lane: "executions", "file_watcher" or "rpc".
+    :param paths: The spool or staged files of the batch.
+    :param rows: Database rows recorded by on_success, if any.
+    :param details: Stored with the entry, e.g. the retry_id of a retried batch.
+    :return: (send, on_success) to dispatch instead.
+    """
+    key = f"batch:{uuid.uuid4().hex}"
+    entry = dict(details, lane=lane, paths=list(paths), rows=[list(row) for row in rows])
+
+    async def tracked_send():
+        manifest.put(key, dict(entry, state="inflight"))
+        try:
+            email_sent = await send()
+        except BaseException:
+            manifest.remove(key)
+            raise
+        if email_sent:
+            manifest.put(key, dict(entry, state="emailed"))
+        else:
+            manifest.remove(key)
+        return email_sent
+
+    async def tracked_success():
+        await on_success()
+        manifest.remove(key)
+
+    return tracked_send, tracked_success
+
+
+def track_awaited_rpc(manifest, request_uuid, sent_at=None, resends=0):
+    manifest.put(
+        f"rpc:{request_uuid}",
+        {"state": "awaiting", "sent_at": sent_at or time.time(), "resends": resends},
+    )
+
+
+def get_awaited_rpcs(manifest):
+    """
+    :return: {request_uuid: sent_at} of the RPCs sent and still awaiting a reply.
+    """
+    return {key[4:]: entry["sent_at"] for key, entry in manifest.items("rpc:")}
+
+
+spool_manifests = {}
+
+
+def get_spool_manifest(name):
+    """
+    :param name: "sender" or "file_watcher".
+    :return: The process's SpoolManifest, loaded on first use.
+    """
+    manifest = spool_manifests.get(name)
+    if manifest is None:
+        manifest = spool_manifests[name] = SpoolManifest(name)
+    return manifest
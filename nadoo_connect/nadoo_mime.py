@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import base64
+import shutil
+import tempfile
+from email import policy
+from email.message import Message
+
+
+# Streaming encoder settings
+mime_memory_limit = 1024 * 1024  # Encoded bytes kept in memory before the message spills to disk
+mime_chunk_size = 64 * 1024  # Bytes per read or write while streaming a message
+base64_line_bytes = 57  # Raw bytes per 76 character base64 line
+
+
+class StreamingBatchMessage:
+    """
+    A batch email whose JSON body is encoded while the records are added.
+
+    The message is the one MIMEText(json.dumps(records), "plain", "utf-8")
+    would produce: a text/plain body, base64 encoded in lines of 76
+    characters. Each record is serialized on its own and encoded right away
+    into a buffer that spills to a temporary file above mime_memory_limit,
+    so working memory stays bounded whatever the batch size, and the SMTP
+    layer streams the buffer out in chunks.
+
+    Base64 lines never start with a dot and all line endings are CRLF, so the
+    buffer can go out as SMTP DATA unchanged.
+    """
+
+    def __init__(self, subject, from_email, to_email):
+        self.from_email = from_email
+        self.to_email = to_email
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=mime_memory_limit)
+        self.pending = bytearray()  # Body bytes not yet filling a whole base64 line
+        self.records = 0
+        self.body_bytes = 0
+        self.closed = False
+        headers = Message(policy=policy.SMTP)
+        headers["Content-Type"] = 'text/plain; charset="utf-8"'
+        headers["MIME-Version"] = "1.0"
+        headers["Content-Transfer-Encoding"] = "base64"
+        headers["Subject"] = subject
+        headers["From"] = from_email
+        headers["To"] = to_email
+        # Ends with the blank line that separates headers and body
+        self.buffer.write(headers.as_bytes(policy=policy.SMTP))
+
+    def add(self, record):
+        self.write_body((b", " if self.records else b"[") + json.dumps(record).encode("utf-8"))
+        self.records += 1
+
+    def write_body(self, data):
+        self.body_bytes += len(data)
+        self.pending += data
+        if len(self.pending) >= mime_chunk_size:
+            self.encode_pending(final=False)
+
+    def encode_pending(self, final):
+        length = len(self.pending) if final else len(self.pending) // base64_line_bytes * base64_line_bytes
+        if length:
+            encoded = base64.encodebytes(bytes(self.pending[:length]))
+            self.buffer.write(encoded.replace(b"\n", b"\r\n"))
+            del self.pending[:length]
+
+    def finish(self):
+        """
+        Closes the JSON array and the encoding; the message is then ready to send.
+        """
+        if not self.closed:
+            self.write_body(b"]" if self.records else b"[]")
+            self.encode_pending(final=True)
+            self.closed = True
+        self.buffer.seek(0)
+        return self
+
+    def size(self):
+        return self.buffer.seek(0, os.SEEK_END)
+
+    def iter_chunks(self):
+        self.finish()
+        while chunk := self.buffer.read(mime_chunk_size):
+            yield chunk
+
+    def write_to(self, path):
+        self.finish()
+        with open(path, "wb") as file:
+            shutil.copyfileobj(self.buffer, file, mime_chunk_size)
+
+    def close(self):
+        self.buffer.close()
+
+
+class StoredBatchMessage:
+    """
+    A batch message encoded earlier and kept in a file, sent again as is.
+    Has the interface of StreamingBatchMessage that the senders use.
+    """
+
+    def __init__(self, path, from_email, to_email, records=0, body_bytes=0):
+        self.path = path
+        self.from_email = from_email
+        self.to_email = to_email
+        self.records = records
+        self.body_bytes = body_bytes
+        self.buffer = None
+
+    def finish(self):
+        if self.buffer is None:
+            self.buffer = open(self.path, "rb")
+        self.buffer.seek(0)
+        return self
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def iter_chunks(self):
+        self.finish()
+        while chunk := self.buffer.read(mime_chunk_size):
+            yield chunk
+
+    def write_to(self, path):
+        shutil.copyfile(self.path, path)
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+
+
+def measure_encoding(mode, directory, result_queue):
+    # Runs in a fresh process, so ru_maxrss is the peak of this encoding alone
+    import resource
+    from email.mime.text import MIMEText
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+    if mode == "buffered":
+        records = []
+        for path in paths:
+            with open(path, "r") as file:
+                records.append(json.load(file))
+        msg = MIMEText(json.dumps(records), _subtype="plain", _charset="utf-8")
+        msg["Subject"] = "Batched Executions"
+        size = len(msg.as_bytes())  # What aiosmtplib sends
+    else:
+        message = StreamingBatchMessage("Batched Executions", "from", "to")
+        for path in paths:
+            with open(path, "r") as file:
+                message.add(json.load(file))
+        size = sum(len(chunk) for chunk in message.iter_chunks())
+        message.close()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result_queue.put({"peak_rss_kb": peak, "encoding_rss_kb": peak - baseline, "message_bytes": size})
+
+
+def run_memory_benchmark(record_counts=(2000, 50000)):
+    """
+    Compares peak RSS of the buffered and the streaming batch encoder.
+
+    :return: {records: {mode: {"peak_rss_kb", "encoding_rss_kb", "message_bytes"}}}
+    """
+    import multiprocessing
+    import uuid
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for count in record_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            for i in range(count):
+                record = {
+                    "execution_uuid": str(uuid.uuid4()),
+                    "customer_program_uuid": "benchmark",
+                    "timestamp": "2024-01-01 10:00:00.000000",
+                }
+                with open(os.path.join(directory, f"{i:08d}.json"), "w") as file:
+                    json.dump(record, file)
+            results[count] = {}
+            for mode in ("buffered", "streaming"):
+                result_queue = context.Queue()
+                process = context.Process(
+                    target=measure_encoding, args=(mode, directory, result_queue)
+                )
+                process.start()
+                results[count][mode] = result_queue.get()
+                process.join()
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        counts = [int(arg) for arg in sys.argv[2:]] or [2000, 50000]
+        print(json.dumps(run_memory_benchmark(counts), indent=2))
+    else:
+        print("Usage: python -m nadoo_connect.nadoo_mime benchmark [record counts...]")
@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import base64
+import shutil
+import asyncio
+import hashlib
+import logging
+
+from .nadoo_leader import write_file_exclusive
+
+
+logger = logging.getLogger(__name__)
+
+# A payload too large for one email is sent as numbered parts, one email each:
+#   {"part": {"message_id", "index", "count", "checksum", "part_checksum"}, "data": <base64>}
+# checksum is the SHA-256 of the whole payload, part_checksum that of the part.
+# A receiver still missing parts after part_assembly_timeout asks for just those:
+#   {"resend_parts": {"message_id": ..., "missing": [indices]}}
+parts_outbox_dir = "rpc_parts_outbox"  # Sent parts, kept for retransmission
+parts_inbox_dir = "rpc_parts_inbox"  # Received parts until their set is complete
+parts_resend_dir = "rpc_parts_resend"  # Retransmissions asked for by the other side
+message_part_size = 36 * 1024  # Payload bytes per part; base64 twice keeps a part email under 72 KB
+part_send_concurrency = 4  # Part emails sent at the same time
+part_assembly_timeout = 300  # Seconds without a new part before missing parts are requested
+part_resend_attempts = 3  # Requests for missing parts before an incomplete set is dropped
+sent_parts_retention = 24 * 3600  # Seconds sent parts are kept for retransmission
+parts_check_interval = 10  # Seconds between checks for resend requests and stalled sets
+meta_name = "meta.json"
+
+
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_part_set_dir(directory, message_id):
+    # Message ids come from emails, so the directory name is a hash
+    return os.path.join(directory, sha256_hex(str(message_id).encode("utf-8"))[:32])
+
+
+def split_into_parts(payload, message_id):
+    """
+    :param payload: The bytes to send.
+    :param message_id: Identifies the set; reused when the payload is sent again.
+    :return: The part dicts, in order.
+    """
+    chunks = [
+        payload[start : start + message_part_size]
+        for start in range(0, len(payload), message_part_size)
+    ] or [b""]
+    checksum = sha256_hex(payload)
+    return [
+        {
+            "part": {
+                "message_id": message_id,
+                "index": index,
+                "count": len(chunks),
+                "checksum": checksum,
+                "part_checksum": sha256_hex(chunk),
+            },
+            "data": base64.b64encode(chunk).decode("ascii"),
+        }
+        for index, chunk in enumerate(chunks)
+    ]
+
+
+def is_message_part(content):
+    return isinstance(content, dict) and "part" in content and "data" in content
+
+
+def is_resend_request(content):
+    return isinstance(content, dict) and "resend_parts" in content
+
+
+def write_json(path, content):
+    try:
+        write_file_exclusive(path, json.dumps(content))
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file_exclusive(path, json.dumps(content))
+
+
+def read_json(path):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_sent_parts(parts):
+    for part in parts:
+        set_dir = get_part_set_dir(parts_outbox_dir, part["part"]["message_id"])
+        write_json(os.path.join(set_dir, f"{part['part']['index']}.json"), part)
+
+
+def load_sent_parts(message_id, indices):
+    set_dir = get_part_set_dir(parts_outbox_dir, message_id)
+    parts = [read_json(os.path.join(set_dir, f"{int(index)}.json")) for index in indices]
+    return [part for part in parts if part is not None]
+
+
+async def send_parts(parts, send_part):
+    """
+    Sends parts concurrently, at most part_send_concurrency at a time.
+
+    :param send_part: Coroutine function taking a part dict, returning True if sent.
+    :return: True if every part was sent.
+    """
+    semaphore = asyncio.Semaphore(part_send_concurrency)
+
+    async def send(part):
+        async with semaphore:
+            return await send_part(part)
+
+    return all(await asyncio.gather(*(send(part) for part in parts)))
+
+
+def queue_resend_request(request):
+    # Handled by the sender, see resend_requested_parts
+    request = request["resend_parts"]
+    path = get_part_set_dir(parts_resend_dir, request["message_id"]) + ".json"
+    write_json(path, {"message_id": request["message_id"], "missing": request["missing"]})
+
+
+async def resend_requested_parts(send_part):
+    """
+    Sends the parts the other side asked for again.
+
+    :return: The number of parts sent.
+    """
+    try:
+        names = [name for name in os.listdir(parts_resend_dir) if name.endswith(".json")]
+    except FileNotFoundError:
+        return 0
+    sent = 0
+    for name in names:
+        path = os.path.join(parts_resend_dir, name)
+        request = read_json(path)
+        if request is None:
+            continue
+        parts = load_sent_parts(request["message_id"], request["missing"])
+        if not parts:
+            logger.warning(f"Parts of {request['message_id']} asked for again are no longer kept.")
+        elif not await send_parts(parts, send_part):
+            continue  # Retried on the next check
+        else:
+            sent += len(parts)
+            logger.info(f"Sent {len(parts)} missing parts of {request['message_id']} again.")
+        os.remove(path)
+    return sent
+
+
+def add_received_part(part):
+    """
+    Stores a received part.
+
+    :return: The reassembled payload once all parts arrived and its checksum
+        matches, otherwise None.
+    """
+    info = part["part"]
+    data = base64.b64decode(part["data"])
+    if sha256_hex(data) != info["part_checksum"]:
+        logger.warning(f"Dropping corrupt part {info['index']} of {info['message_id']}.")
+        return None
+    set_dir = get_part_set_dir(parts_inbox_dir, info["message_id"])
+    meta_path = os.path.join(set_dir, meta_name)
+    if read_json(meta_path) is None:
+        write_json(
+            meta_path,
+            {
+                "message_id": info["message_id"],
+                "count": info["count"],
+                "checksum": info["checksum"],
+                "resend_requests": 0,
+            },
+        )
+    # A duplicate (a part sent again) simply replaces the first copy
+    write_json(os.path.join(set_dir, f"{int(info['index'])}.part"), part["data"])
+    if get_missing_parts(set_dir, info["count"]):
+        return None
+
+    chunks = []
+    for index in range(info["count"]):
+        chunks.append(base64.b64decode(read_json(os.path.join(set_dir, f"{index}.part")) or ""))
+    payload = b"".join(chunks)
+    shutil.rmtree(set_dir, ignore_errors=True)
+    if sha256_hex(payload) != info["checksum"]:
+        logger.error(f"Checksum mismatch in the reassembled {info['message_id']}, dropped.")
+        return None
+    return payload
+
+
+def get_missing_parts(set_dir, count):
+    try:
+        present = {name for name in os.listdir(set_dir) if name.endswith(".part")}
+    except FileNotFoundError:
+        present = set()
+    return [index for index in range(count) if f"{index}.part" not in present]
+
+
+def expire_incomplete_sets(now=None):
+    """
+    Finds sets that got no new part for part_assembly_timeout seconds.
+
+    :return: A resend request for the missing parts of each such set. Sets
+        already asked for part_resend_attempts times are dropped instead.
+    """
+    now = now or time.time()
+    requests = []
+    try:
+        set_names = os.listdir(parts_inbox_dir)
+    except FileNotFoundError:
+        return requests
+    for name in set_names:
+        set_dir = os.path.join(parts_inbox_dir, name)
+        meta = read_json(os.path.join(set_dir, meta_name))
+        try:
+            # Every stored part (and meta update) renews the directory's mtime
+            stalled = now - os.path.getmtime(set_dir) > part_assembly_timeout
+        except FileNotFoundError:
+            continue
+        if meta is None or not stalled:
+            continue
+        missing = get_missing_parts(set_dir, meta["count"])
+        if meta["resend_requests"] >= part_resend_attempts:
+            logger.error(
+                f"Giving up on {meta['message_id']}: {len(missing)} of {meta['count']} parts missing."
+            )
+            shutil.rmtree(set_dir, ignore_errors=True)
+            continue
+        meta["resend_requests"] += 1
+        write_json(os.path.join(set_dir, meta_name), meta)
+        requests.append({"resend_parts": {"message_id": meta["message_id"], "missing": missing}})
+    return requests
+
+
+def prune_sent_parts(now=None):
+    now = now or time.time()
+    try:
+        set_names = os.listdir(parts_outbox_dir)
+    except FileNotFoundError:
+        return
+    for name in set_names:
+        set_dir = os.path.join(parts_outbox_dir, name)
+        try:
+            if now - os.path.getmtime(set_dir) > sent_parts_retention:
+                shutil.rmtree(set_dir, ignore_errors=True)
+        except FileNotFoundError:
+            continue
+
+
+async def message_parts_loop(send_part, send_message):
+    """
+    Runs in the sender: answers resend requests and asks for missing parts.
+
+    :param send_part: Coroutine function sending one part dict.
+    :param send_message: Coroutine function sending any other JSON-able dict.
+    """
+    while True:
+        try:
+            await resend_requested_parts(send_part)
+            for request in expire_incomplete_sets():
+                await send_message(request)
+            prune_sent_parts()
+        except OSError as e:
+            logger.warning(f"Unable to check message parts: {e}")
+        await asyncio.sleep(parts_check_interval)
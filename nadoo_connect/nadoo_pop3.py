@@ -0,0 +1,244 @@
+import os
+import ssl
+import time
+import asyncio
+import hashlib
+import logging
+
+from .nadoo_storage import get_storage
+
+
+logger = logging.getLogger(__name__)
+
+# POP3 settings
+inbox_dir = "inbox"  # Downloaded messages go to inbox/<email address>/<uidl hash>.eml
+pop3_use_ssl = True  # POP3 over TLS, typically port 995
+pop3_timeout = 30  # Seconds to wait for any server response
+pop3_pipeline_window = 16  # RETR commands sent ahead of their responses
+
+
+class POP3Error(Exception):
+    """Raised when the POP3 server answers -ERR."""
+
+
+class AsyncPOP3Client:
+    """
+    Small asyncio POP3 client for incremental mailbox sync.
+
+    Multi-line responses are read line by line, so a message is streamed to
+    disk and never held in memory as a whole. With the PIPELINING capability
+    (RFC 2449) several RETR commands are sent before their responses are read.
+    """
+
+    def __init__(self, host, port, use_ssl=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.use_ssl = pop3_use_ssl if use_ssl is None else use_ssl
+        self.timeout = timeout or pop3_timeout
+        self.reader = None
+        self.writer = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.quit()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                self.host,
+                self.port,
+                ssl=ssl.create_default_context() if self.use_ssl else None,
+            ),
+            self.timeout,
+        )
+        await self.read_status()
+
+    async def read_line(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise ConnectionError("Connection closed by the POP3 server.")
+        return line
+
+    async def read_status(self):
+        line = await self.read_line()
+        if not line.startswith(b"+OK"):
+            raise POP3Error(line.decode("utf-8", "replace").strip())
+        return line
+
+    async def send(self, command):
+        self.writer.write(command.encode("utf-8") + b"\r\n")
+        await self.writer.drain()
+
+    async def command(self, command):
+        await self.send(command)
+        return await self.read_status()
+
+    async def read_multiline(self):
+        # Yields the lines of a multi-line response with dot-stuffing removed
+        while True:
+            line = await self.read_line()
+            if line in (b".\r\n", b".\n"):
+                return
+            if line.startswith(b".."):
+                line = line[1:]
+            yield line
+
+    async def capabilities(self):
+        try:
+            await self.command("CAPA")
+        except POP3Error:
+            return set()  # CAPA is optional
+        return {
+            line.decode("utf-8", "replace").split()[0].upper()
+            async for line in self.read_multiline()
+            if line.strip()
+        }
+
+    async def login(self, user, password):
+        await self.command(f"USER {user}")
+        await self.command(f"PASS {password}")
+
+    async def uidl(self):
+        """
+        :return: A list of (message number, unique id) pairs.
+        """
+        await self.command("UIDL")
+        listing = []
+        async for line in self.read_multiline():
+            number, unique_id = line.decode("utf-8", "replace").split()[:2]
+            listing.append((int(number), unique_id))
+        return listing
+
+    async def retrieve_to_file(self, path):
+        # Reads one RETR response into path, published only once complete
+        tmp_path = f"{path}.part"
+        await self.read_status()
+        with open(tmp_path, "wb") as file:
+            async for line in self.read_multiline():
+                file.write(line)
+        os.replace(tmp_path, path)
+
+    async def retrieve_many(self, messages, pipelining=False, window=None):
+        """
+        Downloads messages to files, pipelining the RETR commands if allowed.
+
+        :param messages: (message number, path) pairs.
+        :param pipelining: Whether the server announced PIPELINING.
+        :param window: Maximum RETR commands in flight; pop3_pipeline_window by default.
+        :return: The path written per message, None where the server refused it.
+        """
+        window = (window or pop3_pipeline_window) if pipelining else 1
+        written = []
+        sent = 0
+        while len(written) < len(messages):
+            while sent < len(messages) and sent - len(written) < window:
+                await self.send(f"RETR {messages[sent][0]}")
+                sent += 1
+            number, path = messages[len(written)]
+            try:
+                await self.retrieve_to_file(path)
+            except POP3Error as e:
+                # e.g. deleted by another client meanwhile; the rest still follows
+                logger.warning(f"Unable to retrieve message {number}: {e}")
+                path = None
+            written.append(path)
+        return written
+
+    async def quit(self):
+        if self.writer is None:
+            return
+        try:
+            await self.command("QUIT")
+        except (POP3Error, OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.writer.close()
+            self.writer = None
+
+
+def setup_uidl_table(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pop3_uidl (
+            email TEXT,
+            uidl TEXT,
+            path TEXT,           -- Where the message was downloaded to
+            downloaded_at REAL,
+            PRIMARY KEY (email, uidl)
+        );
+        """
+    )
+
+
+def select_seen_uidls(conn, email_address):
+    rows = conn.execute("SELECT uidl FROM pop3_uidl WHERE email = ?", (email_address,))
+    return {row[0] for row in rows}
+
+
+def save_uidls(conn, downloaded, gone):
+    conn.executemany(
+        "INSERT OR REPLACE INTO pop3_uidl (email, uidl, path, downloaded_at) VALUES (?, ?, ?, ?)",
+        downloaded,
+    )
+    conn.executemany("DELETE FROM pop3_uidl WHERE email = ? AND uidl = ?", gone)
+
+
+def get_message_path(directory, unique_id):
+    # UIDLs may hold any printable character, so the file name is a hash
+    name = hashlib.sha256(unique_id.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(directory, f"{name}.eml")
+
+
+async def sync_pop3_mailbox(email_account, email_account_db_name, directory=None):
+    """
+    Downloads the messages not seen by an earlier sync.
+
+    Seen UIDLs are kept per account in the pop3_uidl table, so the cost of a
+    poll grows with the new mail, not the mailbox size. UIDLs no longer on the
+    server are forgotten. A message file is named after its UIDL, so a sync
+    interrupted before its state was saved rewrites the same files.
+
+    :param email_account: Account dict with email, pop_server, pop_port and password.
+    :return: Paths of the newly downloaded messages, oldest first.
+    """
+    email_address = email_account["email"]
+    directory = directory or os.path.join(inbox_dir, email_address)
+    os.makedirs(directory, exist_ok=True)
+
+    storage = get_storage(email_account_db_name)
+    seen = await storage.read(select_seen_uidls, email_address, setup=setup_uidl_table)
+
+    async with AsyncPOP3Client(
+        email_account["pop_server"], int(email_account["pop_port"])
+    ) as client:
+        pipelining = "PIPELINING" in await client.capabilities()
+        await client.login(email_address, email_account["password"])
+        listing = await client.uidl()
+        new_messages = [
+            (number, unique_id) for number, unique_id in listing if unique_id not in seen
+        ]
+        paths = await client.retrieve_many(
+            [
+                (number, get_message_path(directory, unique_id))
+                for number, unique_id in new_messages
+            ],
+            pipelining=pipelining,
+        )
+
+    now = time.time()
+    downloaded = [
+        (email_address, unique_id, path, now)
+        for (_, unique_id), path in zip(new_messages, paths)
+        if path is not None
+    ]
+    present = {unique_id for _, unique_id in listing}
+    gone = [(email_address, unique_id) for unique_id in seen - present]
+    await storage.write(save_uidls, downloaded, gone)
+
+    logger.info(
+        f"POP3 sync of {email_address}: {len(downloaded)} new of {len(listing)} messages."
+    )
+    return [path for _, _, path, _ in downloaded]
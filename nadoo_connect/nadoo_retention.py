@@ -0,0 +1,570 @@
+import os
+import gzip
+import json
+import sqlite3
+import time
+import asyncio
+import logging
+import traceback
+import uuid
+from datetime import datetime, timedelta
+from .nadoo_config import get_config_snapshot
+
+
+logger = logging.getLogger(__name__)
+
+# Retention settings. Each one can be overridden per call, through the config
+# dict, or through the environment/.env as NADOO_<NAME IN UPPER CASE>.
+execution_db_path = "executions.db"
+done_dir = "rpc_done"
+archive_dir = "archive"
+execution_retention_days = 90  # Raw execution rows older than this are archived
+execution_db_size_limit = 50 * 1024 * 1024  # Archive oldest rows above 50 MB
+size_limit_min_age_days = 7  # The size limit never archives rows newer than this
+rpc_done_retention_days = 7  # rpc_done files older than this are compacted
+rpc_done_max_files = 10000  # Compact the oldest files beyond this count
+archive_retention_days = None  # Delete archive files older than this, None keeps them
+retention_interval = 3600  # Seconds between background retention passes
+retention_chunk_size = 5000  # Rows moved per transaction
+incremental_vacuum_pages = 2000  # Free pages returned to the OS per vacuum step
+timestamp_format = "%Y-%m-%d %H:%M:%S.%f"
+unknown_partition = "unknown"  # Partition and rollup day for rows without a timestamp
+
+
+def get_retention_setting(name, value=None, config=None):
+    """
+    Resolves a retention setting at call time.
+
+    :param name: The name of the module level setting, e.g. "execution_retention_days".
+    :param value: An explicit value, used as is when not None.
+    :param config: Optional config dict, checked for NADOO_<NAME> and <NAME>.
+    :return: The explicit value, the configured value, or the module default.
+    """
+    if value is not None:
+        return value
+
+    default = globals()[name]
+    for key in (f"NADOO_{name.upper()}", name.upper()):
+        configured = (config or {}).get(key)
+        if configured is None:
+            configured = os.environ.get(key)
+        if configured is None or configured == "":
+            continue
+        if str(configured).lower() == "none":
+            return None
+        if isinstance(default, str):
+            return configured
+        return float(configured) if "." in str(configured) else int(configured)
+    return default
+
+
+def connect_execution_db(db_path):
+    # Autocommit mode, so transactions are opened explicitly with BEGIN IMMEDIATE
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    # Only takes effect before the first table is created
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS execution_rollups
+           (day TEXT, customer_program_uuid TEXT, execution_count INTEGER,
+            PRIMARY KEY (day, customer_program_uuid))"""
+    )
+    # Rows already removed from execution_records but not yet written to an
+    # archive file. Filling it is part of the delete transaction, writing the
+    # files happens afterwards, without holding the database lock.
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS execution_archive_pending
+           (batch_id TEXT, claimed_at REAL, execution_uuid TEXT,
+            customer_program_uuid TEXT, is_sent BOOLEAN, timestamp TEXT,
+            execution_count INTEGER)"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS retention_state
+           (key TEXT PRIMARY KEY, value REAL)"""
+    )
+    return conn
+
+
+def get_execution_columns(conn):
+    return [row[1] for row in conn.execute("PRAGMA table_info(execution_records)")]
+
+
+def has_timestamp_column(conn):
+    return "timestamp" in get_execution_columns(conn)
+
+
+def convert_to_incremental_vacuum(db_path=None):
+    """
+    Switches an existing database to incremental auto_vacuum.
+
+    This needs one full VACUUM, which locks the database for its whole duration,
+    so it only runs when requested explicitly and never from the background loop.
+    Databases created by record_execution_in_db are incremental from the start.
+    """
+    db_path = get_retention_setting("execution_db_path", db_path)
+    conn = connect_execution_db(db_path)
+    try:
+        (mode,) = conn.execute("PRAGMA auto_vacuum").fetchone()
+        if mode != 2:
+            logger.info("Switching database to incremental auto_vacuum.")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def incremental_vacuum(conn, pages=None):
+    # A no-op unless the database uses incremental auto_vacuum. Run through
+    # executescript: stepping the pragma via execute() frees only one page.
+    pages = get_retention_setting("incremental_vacuum_pages", pages)
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+
+
+def get_used_database_bytes(conn):
+    # Bytes in use by live pages; free pages count as reclaimable, not as used.
+    (page_count,) = conn.execute("PRAGMA page_count").fetchone()
+    (freelist_count,) = conn.execute("PRAGMA freelist_count").fetchone()
+    (page_size,) = conn.execute("PRAGMA page_size").fetchone()
+    return (page_count - freelist_count) * page_size
+
+
+def get_archive_partition_path(archive_root, kind, timestamp):
+    # Archives are partitioned by month, e.g. archive/executions/executions-2024-01.jsonl.gz
+    partition = timestamp[:7] if timestamp else unknown_partition
+    partition_dir = os.path.join(archive_root, kind)
+    os.makedirs(partition_dir, exist_ok=True)
+    return os.path.join(partition_dir, f"{kind}-{partition}.jsonl.gz")
+
+
+def write_archive_lines(path, records):
+    # Appending to a gzip file adds a new member; readers see one continuous stream.
+    with gzip.open(path, "at", encoding="utf-8") as archive_file:
+        for record in records:
+            archive_file.write(json.dumps(record) + "\n")
+        archive_file.flush()
+        os.fsync(archive_file.fileno())
+
+
+def archive_execution_rows(conn, where_clause, params, archive_root, max_rows=None):
+    """
+    Moves matching execution rows into the archive and folds them into the rollups.
+
+    Each chunk is selected, deleted, rolled up and copied into
+    execution_archive_pending inside one short BEGIN IMMEDIATE transaction, so
+    two processes running retention at the same time never archive or count the
+    same rows. The archive files are written after the commit, so no file I/O
+    happens while the database is locked.
+
+    :return: The number of rows moved.
+    """
+    moved = 0
+    chunk_size_setting = get_retention_setting("retention_chunk_size")
+    # Spilled overflow summaries carry an execution_count; plain rows count once
+    count_column = (
+        "COALESCE(execution_count, 1)"
+        if "execution_count" in get_execution_columns(conn)
+        else "1"
+    )
+    while max_rows is None or moved < max_rows:
+        chunk_size = chunk_size_setting
+        if max_rows is not None:
+            chunk_size = min(chunk_size, max_rows - moved)
+
+        batch_id = uuid.uuid4().hex
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"""SELECT rowid, execution_uuid, customer_program_uuid, is_sent, timestamp,
+                           {count_column}
+                    FROM execution_records WHERE {where_clause}
+                    ORDER BY timestamp LIMIT ?""",
+                (*params, chunk_size),
+            ).fetchall()
+            if not rows:
+                conn.execute("ROLLBACK")
+                break
+
+            rollups = {}
+            for row in rows:
+                customer_program_uuid, timestamp, execution_count = row[2], row[4], row[5]
+                day = timestamp[:10] if timestamp else unknown_partition
+                rollups[(day, customer_program_uuid)] = (
+                    rollups.get((day, customer_program_uuid), 0) + execution_count
+                )
+
+            for (day, customer_program_uuid), count in rollups.items():
+                conn.execute(
+                    """INSERT OR IGNORE INTO execution_rollups
+                       VALUES (?, ?, 0)""",
+                    (day, customer_program_uuid),
+                )
+                conn.execute(
+                    """UPDATE execution_rollups SET execution_count = execution_count + ?
+                       WHERE day = ? AND customer_program_uuid = ?""",
+                    (count, day, customer_program_uuid),
+                )
+            conn.executemany(
+                """INSERT INTO execution_archive_pending VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                [(batch_id, time.time(), *row[1:]) for row in rows],
+            )
+            conn.executemany(
+                "DELETE FROM execution_records WHERE rowid = ?",
+                [(row[0],) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        flush_archive_batch(conn, batch_id, archive_root)
+        moved += len(rows)
+
+    return moved
+
+
+def flush_archive_batch(conn, batch_id, archive_root):
+    rows = conn.execute(
+        """SELECT execution_uuid, customer_program_uuid, is_sent, timestamp, execution_count
+           FROM execution_archive_pending WHERE batch_id = ?""",
+        (batch_id,),
+    ).fetchall()
+    partitions = {}
+    for execution_uuid, customer_program_uuid, is_sent, timestamp, execution_count in rows:
+        record = {
+            "execution_uuid": execution_uuid,
+            "customer_program_uuid": customer_program_uuid,
+            "is_sent": bool(is_sent),
+            "timestamp": timestamp,
+            "execution_count": execution_count,
+        }
+        path = get_archive_partition_path(archive_root, "executions", timestamp)
+        partitions.setdefault(path, []).append(record)
+
+    for path, records in partitions.items():
+        write_archive_lines(path, records)
+
+    conn.execute("DELETE FROM execution_archive_pending WHERE batch_id = ?", (batch_id,))
+
+
+def recover_pending_archive_batches(conn, archive_root, max_age):
+    # Batches left behind by a process that died between commit and file write.
+    # A crash during recovery itself can at worst duplicate archive lines
+    # (execution_uuid is the key); rollups are never touched again.
+    cutoff = time.time() - max_age
+    batch_ids = [
+        row[0]
+        for row in conn.execute(
+            """SELECT DISTINCT batch_id FROM execution_archive_pending
+               WHERE claimed_at < ?""",
+            (cutoff,),
+        )
+    ]
+    for batch_id in batch_ids:
+        flush_archive_batch(conn, batch_id, archive_root)
+    return len(batch_ids)
+
+
+def archive_old_execution_records(
+    db_path=None,
+    archive_root=None,
+    retention_days=None,
+    config=None,
+):
+    db_path = get_retention_setting("execution_db_path", db_path, config)
+    archive_root = get_retention_setting("archive_dir", archive_root, config)
+    retention_days = get_retention_setting(
+        "execution_retention_days", retention_days, config
+    )
+    if not os.path.exists(db_path):
+        return 0
+
+    conn = connect_execution_db(db_path)
+    try:
+        if not has_timestamp_column(conn):
+            logger.debug("execution_records has no timestamp column yet, skipping.")
+            return 0
+        recover_pending_archive_batches(
+            conn, archive_root, get_retention_setting("retention_interval", None, config)
+        )
+        cutoff = (datetime.now() - timedelta(days=retention_days)).strftime(
+            timestamp_format
+        )
+        moved = archive_execution_rows(
+            conn, "timestamp < ?", (cutoff,), archive_root
+        )
+        if moved:
+            logger.info(f"Archived {moved} execution records older than {cutoff}.")
+        return moved
+    finally:
+        conn.close()
+
+
+def enforce_execution_db_size_limit(
+    db_path=None,
+    archive_root=None,
+    size_limit=None,
+    min_age_days=None,
+    config=None,
+):
+    """
+    Archives the oldest execution rows while the database is above size_limit.
+
+    Progress is measured in live pages (page_count - freelist_count), so the
+    loop stops once enough space is freed even before the file has shrunk.
+    Rows newer than min_age_days are never archived.
+
+    :return: The number of rows moved.
+    """
+    db_path = get_retention_setting("execution_db_path", db_path, config)
+    archive_root = get_retention_setting("archive_dir", archive_root, config)
+    size_limit = get_retention_setting("execution_db_size_limit", size_limit, config)
+    min_age_days = get_retention_setting("size_limit_min_age_days", min_age_days, config)
+    if not os.path.exists(db_path) or os.path.getsize(db_path) <= size_limit:
+        return 0
+
+    conn = connect_execution_db(db_path)
+    moved = 0
+    try:
+        if not has_timestamp_column(conn):
+            return 0
+        floor = (datetime.now() - timedelta(days=min_age_days)).strftime(
+            timestamp_format
+        )
+        while get_used_database_bytes(conn) > size_limit:
+            (row_count,) = conn.execute(
+                "SELECT COUNT(*) FROM execution_records"
+            ).fetchone()
+            # Archive the oldest tenth per round
+            batch = max(1, row_count // 10)
+            moved_in_round = archive_execution_rows(
+                conn, "timestamp < ?", (floor,), archive_root, max_rows=batch
+            )
+            if moved_in_round == 0:
+                break
+            moved += moved_in_round
+        # Hand the freed pages back to the file system
+        incremental_vacuum(conn, pages=(1 << 31) - 1)
+        if moved:
+            logger.info(f"Archived {moved} execution records to enforce size limit.")
+        used = get_used_database_bytes(conn)
+        if used > size_limit:
+            logger.warning(
+                f"executions.db still uses {used} bytes, above the limit of {size_limit}."
+            )
+        return moved
+    finally:
+        conn.close()
+
+
+def vacuum_execution_db(db_path=None, pages=None, config=None):
+    db_path = get_retention_setting("execution_db_path", db_path, config)
+    if not os.path.exists(db_path):
+        return
+    conn = connect_execution_db(db_path)
+    try:
+        incremental_vacuum(conn, get_retention_setting("incremental_vacuum_pages", pages, config))
+    finally:
+        conn.close()
+
+
+def claim_rpc_done_files(directory, selected):
+    # Moving files into a per-pass staging directory makes each file belong to
+    # exactly one retention pass, even with several processes compacting.
+    staging_dir = os.path.join(
+        directory, f".compacting-{os.getpid()}-{int(time.time() * 1000)}"
+    )
+    os.makedirs(staging_dir)
+    claimed = []
+    for mtime, name, path in selected:
+        staged_path = os.path.join(staging_dir, name)
+        try:
+            os.rename(path, staged_path)
+        except FileNotFoundError:
+            continue  # Already claimed by another process
+        claimed.append((mtime, name, staged_path))
+    return staging_dir, claimed
+
+
+def recover_stale_staging_dirs(directory, max_age):
+    # A pass that crashed after claiming leaves its staging directory behind;
+    # its files are moved back so the next pass archives them.
+    cutoff = time.time() - max_age
+    with os.scandir(directory) as it:
+        stale = [
+            entry.path
+            for entry in it
+            if entry.is_dir()
+            and entry.name.startswith(".compacting-")
+            and entry.stat().st_mtime < cutoff
+        ]
+    for staging_dir in stale:
+        for name in os.listdir(staging_dir):
+            try:
+                os.rename(os.path.join(staging_dir, name), os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(staging_dir)
+        except OSError:
+            pass
+
+
+def compact_rpc_done(
+    directory=None,
+    archive_root=None,
+    retention_days=None,
+    max_files=None,
+    config=None,
+):
+    """
+    Packs old rpc_done files into a single compressed archive segment.
+
+    Files older than retention_days are compacted, as are the oldest files
+    beyond max_files.
+
+    :return: The number of files compacted.
+    """
+    directory = get_retention_setting("done_dir", directory, config)
+    archive_root = get_retention_setting("archive_dir", archive_root, config)
+    retention_days = get_retention_setting("rpc_done_retention_days", retention_days, config)
+    max_files = get_retention_setting("rpc_done_max_files", max_files, config)
+    if not os.path.isdir(directory):
+        return 0
+
+    recover_stale_staging_dirs(directory, get_retention_setting("retention_interval"))
+
+    entries = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.endswith(".json"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.name, entry.path))
+                except FileNotFoundError:
+                    continue
+    entries.sort()
+
+    cutoff = time.time() - retention_days * 86400
+    overflow = max(0, len(entries) - max_files)
+    selected = [
+        entry
+        for index, entry in enumerate(entries)
+        if entry[0] < cutoff or index < overflow
+    ]
+    if not selected:
+        return 0
+
+    staging_dir, claimed = claim_rpc_done_files(directory, selected)
+    if not claimed:
+        os.rmdir(staging_dir)
+        return 0
+
+    segment_dir = os.path.join(archive_root, "rpc_done")
+    os.makedirs(segment_dir, exist_ok=True)
+    segment_name = os.path.basename(staging_dir).replace(".compacting", "rpc_done")
+    records = []
+    for mtime, name, path in claimed:
+        with open(path, "r", encoding="utf-8") as file:
+            content = file.read()
+        try:
+            content = json.loads(content)
+        except json.JSONDecodeError:
+            pass
+        records.append({"name": name, "mtime": mtime, "content": content})
+    write_archive_lines(os.path.join(segment_dir, f"{segment_name}.jsonl.gz"), records)
+
+    for mtime, name, path in claimed:
+        os.remove(path)
+    os.rmdir(staging_dir)
+
+    logger.info(f"Compacted {len(claimed)} rpc_done files into {segment_name}.")
+    return len(claimed)
+
+
+def purge_expired_archives(archive_root=None, retention_days=None, config=None):
+    archive_root = get_retention_setting("archive_dir", archive_root, config)
+    retention_days = get_retention_setting("archive_retention_days", retention_days, config)
+    if retention_days is None or not os.path.isdir(archive_root):
+        return 0
+
+    cutoff = time.time() - retention_days * 86400
+    removed = 0
+    for dirpath, _, filenames in os.walk(archive_root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+    return removed
+
+
+def claim_retention_pass(config=None):
+    """
+    Records the start of a retention pass unless one ran within retention_interval.
+
+    The check and the update share one transaction, so of several processes
+    (sender, watcher, respawned senders) only one runs a pass per interval.
+
+    :return: True if the caller should run the pass.
+    """
+    db_path = get_retention_setting("execution_db_path", None, config)
+    interval = get_retention_setting("retention_interval", None, config)
+    conn = connect_execution_db(db_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT value FROM retention_state WHERE key = 'last_pass'"
+        ).fetchone()
+        now = time.time()
+        if row is not None and now - row[0] < interval:
+            conn.execute("ROLLBACK")
+            return False
+        conn.execute(
+            "INSERT OR REPLACE INTO retention_state VALUES ('last_pass', ?)", (now,)
+        )
+        conn.execute("COMMIT")
+        return True
+    finally:
+        conn.close()
+
+
+def run_retention_pass(config=None, force=False):
+    if not force and not claim_retention_pass(config):
+        logger.debug("Retention pass skipped, the last one is recent enough.")
+        return None
+    start = time.time()
+    summary = {
+        "archived_by_age": archive_old_execution_records(config=config),
+        "archived_by_size": enforce_execution_db_size_limit(config=config),
+        "rpc_done_compacted": compact_rpc_done(config=config),
+        "archives_purged": purge_expired_archives(config=config),
+    }
+    vacuum_execution_db(config=config)
+    summary["duration"] = time.time() - start
+    logger.debug(f"Retention pass finished: {summary}")
+    return summary
+
+
+async def retention_loop(config=None, check_interval=60):
+    # Runs the blocking retention work on a worker thread so the sender loop keeps
+    # going. The pass itself only runs once per retention_interval across all
+    # processes; check_interval is how often this process asks.
+    get_config_snapshot()  # Applies .env to the environment
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, run_retention_pass, config)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in retention pass: {e}\n{traceback.format_exc()}")
+        await asyncio.sleep(check_interval)
+
+
+if __name__ == "__main__":
+    # Explicit maintenance run: one full VACUUM to enable incremental vacuuming,
+    # followed by a regular retention pass.
+    get_config_snapshot()  # Applies .env to the environment
+    convert_to_incremental_vacuum()
+    print(run_retention_pass(force=True))
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import uuid
+import random
+import shutil
+import logging
+
+from .nadoo_leader import write_file_exclusive
+from .nadoo_mime import StoredBatchMessage
+
+
+logger = logging.getLogger(__name__)
+
+# Retry settings. A batch whose send failed is kept in retry_dir/<lane>/<batch_id>/
+# as batch.json (spool paths, database rows, attempts, next attempt time) and
+# message.eml (the encoded email, sent again unchanged). Its spool files stay in
+# place, so quotas still count them, but are held back from new batches.
+retry_dir = "retry_queue"
+dead_letter_dir = "retry_dead_letter"  # Batches that used up retry_max_attempts, with their records
+retry_base_delay = 10  # Seconds before the first retry
+retry_max_delay = 30 * 60  # Upper bound of the backoff
+retry_max_attempts = 12  # Failed sends before a batch is dead-lettered
+retry_jitter = 0.5  # Share of each delay that is randomized, so retries do not line up
+
+
+def get_retry_delay(attempts):
+    """
+    :param attempts: Failed sends so far, at least 1.
+    :return: Seconds until the next attempt: exponential backoff, capped,
+        with the top retry_jitter share of it random.
+    """
+    delay = min(retry_max_delay, retry_base_delay * 2 ** (attempts - 1))
+    return delay * (1 - retry_jitter) + random.uniform(0, delay * retry_jitter)
+
+
+class RetryQueue:
+    """
+    The failed batches of one lane, persisted so attempts and backoff survive
+    a restart. Only the process sending the lane should use it.
+    """
+
+    def __init__(self, lane, directory=None, dead_letters=None):
+        self.lane = lane
+        self.directory = os.path.join(directory or retry_dir, lane)
+        self.dead_letters = os.path.join(dead_letters or dead_letter_dir, lane)
+        self.entries = {}  # batch_id -> entry dict, as in batch.json
+        self.held = set()  # Spool paths that belong to a queued batch
+        self.load()
+
+    def load(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            batch_dir = os.path.join(self.directory, name)
+            if name.startswith("."):
+                shutil.rmtree(batch_dir, ignore_errors=True)  # Unfinished add
+                continue
+            try:
+                with open(os.path.join(batch_dir, "batch.json"), "r") as file:
+                    entry = json.load(file)
+            except (FileNotFoundError, ValueError) as e:
+                logger.warning(f"Dropping unreadable retry batch {name}: {e}")
+                shutil.rmtree(batch_dir, ignore_errors=True)
+                continue
+            self.entries[entry["batch_id"]] = entry
+            self.held.update(entry["paths"])
+        if self.entries:
+            logger.info(f"Loaded {len(self.entries)} batches to retry for {self.lane}.")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_held(self, path):
+        return path in self.held
+
+    def get_key(self, entry):
+        # Claims the batch in an InflightDispatcher while it is being sent
+        return os.path.join(self.directory, entry["batch_id"])
+
+    def add(self, paths, rows, message):
+        """
+        Queues a batch whose first send failed.
+
+        :param paths: The batch's spool files.
+        :param rows: Its database rows, see get_execution_row.
+        :param message: The encoded StreamingBatchMessage.
+        :return: The entry.
+        """
+        now = time.time()
+        entry = {
+            "batch_id": uuid.uuid4().hex,
+            "paths": list(paths),
+            "rows": [list(row) for row in rows],
+            "from_email": message.from_email,
+            "to_email": message.to_email,
+            "records": len(rows),
+            "body_bytes": message.body_bytes,
+            "attempts": 1,
+            "first_failed_at": now,
+            "next_attempt_at": now + get_retry_delay(1),
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_dir = os.path.join(self.directory, f".{entry['batch_id']}")
+        os.makedirs(tmp_dir)
+        message.write_to(os.path.join(tmp_dir, "message.eml"))
+        with open(os.path.join(tmp_dir, "batch.json"), "w") as file:
+            json.dump(entry, file)
+        os.rename(tmp_dir, self.get_key(entry))
+        self.entries[entry["batch_id"]] = entry
+        self.held.update(entry["paths"])
+        logger.warning(
+            f"Batch of {entry['records']} records failed, retrying in "
+            f"{entry['next_attempt_at'] - now:.0f}s."
+        )
+        return entry
+
+    def next_due(self, skip=None, now=None):
+        """
+        :param skip: Optional predicate on get_key(entry), e.g. is_claimed.
+        :return: The due entry that is waiting longest, or None.
+        """
+        now = now or time.time()
+        due = [
+            entry
+            for entry in self.entries.values()
+            if entry["next_attempt_at"] <= now and not (skip and skip(self.get_key(entry)))
+        ]
+        return min(due, key=lambda entry: entry["next_attempt_at"], default=None)
+
+    def get_seconds_until_due(self, now=None):
+        if not self.entries:
+            return None
+        now = now or time.time()
+        return max(0.0, min(entry["next_attempt_at"] for entry in self.entries.values()) - now)
+
+    def open_message(self, entry):
+        return StoredBatchMessage(
+            os.path.join(self.get_key(entry), "message.eml"),
+            entry["from_email"],
+            entry["to_email"],
+            entry["records"],
+            entry["body_bytes"],
+        )
+
+    def record_failure(self, entry, now=None):
+        now = now or time.time()
+        entry["attempts"] += 1
+        if entry["attempts"] >= retry_max_attempts:
+            self.dead_letter(entry)
+            return
+        entry["next_attempt_at"] = now + get_retry_delay(entry["attempts"])
+        write_file_exclusive(os.path.join(self.get_key(entry), "batch.json"), json.dumps(entry))
+
+    def dead_letter(self, entry):
+        # The records leave the spool with the batch, so they are not sent again
+        target = os.path.join(self.dead_letters, entry["batch_id"])
+        os.makedirs(self.dead_letters, exist_ok=True)
+        os.rename(self.get_key(entry), target)
+        records_dir = os.path.join(target, "records")
+        os.makedirs(records_dir, exist_ok=True)
+        for path in entry["paths"]:
+            try:
+                os.rename(path, os.path.join(records_dir, os.path.basename(path)))
+            except FileNotFoundError:
+                pass
+        self.forget(entry)
+        logger.error(
+            f"Batch {entry['batch_id']} failed {entry['attempts']} times, "
+            f"moved {entry['records']} records to {target}."
+        )
+
+    def remove(self, entry):
+        # After a successful send; the caller removes the spool files
+        shutil.rmtree(self.get_key(entry), ignore_errors=True)
+        self.forget(entry)
+
+    def forget(self, entry):
+        self.entries.pop(entry["batch_id"], None)
+        self.held.difference_update(entry["paths"])
+
+
+retry_queues = {}
+
+
+def get_retry_queue(lane):
+    """
+    :param lane: "executions" or "file_watcher".
+    :return: The process's RetryQueue for the lane, loaded from disk on first use.
+    """
+    queue = retry_queues.get(lane)
+    if queue is None:
+        queue = retry_queues[lane] = RetryQueue(lane)
+    return queue
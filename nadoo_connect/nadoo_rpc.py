@@ -0,0 +1,342 @@
+import os
+import json
+import time
+import uuid
+import email
+import asyncio
+import hashlib
+import logging
+from datetime import datetime
+
+from .nadoo_email import (
+    check_password_in_email_account,
+    check_pop_port_in_email_account,
+    check_pop_server_in_email_account,
+    get_email_account_db_name,
+    get_email_address_from_email_account,
+)
+from .nadoo_imap import IMAPError, get_imap_account_for_email_address, watch_mailbox
+from .nadoo_leader import write_file_exclusive
+from .nadoo_parts import (
+    add_received_part,
+    is_message_part,
+    is_resend_request,
+    queue_resend_request,
+)
+from .nadoo_pop3 import POP3Error, sync_pop3_mailbox
+from .nadoo_rpc_cache import get_rpc_cache_key
+from .nadoo_scheduler import wait_for_new_work
+
+
+logger = logging.getLogger(__name__)
+
+# An RPC request is rpc_staged/<request_uuid>.json until the sender emailed it,
+# then rpc_awaiting_response/<request_uuid>.json until the reply arrives as
+# rpc_done/<request_uuid>.json. Replies are JSON emails (one object or a list)
+# of the form {"request_uuid": ..., "result": ...}.
+# While a request is open, rpc_inflight/<hash of procedure and data>.json names
+# it, so identical calls from any process wait for it instead of sending more.
+staged_dir = "rpc_staged"
+awaiting_response_dir = "rpc_awaiting_response"
+done_dir = "rpc_done"
+failed_dir = "rpc_failed"  # Requests that got no reply in time, see nadoo_rpc_expiry
+inflight_dir = "rpc_inflight"
+rpc_reply_timeout = 300  # Seconds get_xyz_for_xyz_remote waits for a reply
+reply_listener_linger = 60  # Seconds the listener stays connected once nothing is awaited
+reply_reconnect_backoff = 5  # First wait before reconnecting, doubled up to the maximum
+reply_reconnect_backoff_max = 300
+pop3_reply_poll_interval = 10  # Seconds between POP3 polls when there is no IMAP account
+inflight_stale_after = rpc_reply_timeout  # Seconds before an in-flight marker is abandoned
+timestamp_format = "%Y-%m-%d %H:%M:%S.%f"
+
+inflight_calls = {}  # (procedure uuid, data hash) -> task shared by identical calls
+reply_observers = []  # Called with the request_uuid of every delivered reply
+
+
+def get_rpc_request_path(directory, request_uuid):
+    return os.path.join(directory, f"{request_uuid}.json")
+
+
+def stage_rpc_request(procedure_uuid, data, request_uuid=None):
+    """
+    Leaves an RPC request for the sender.
+
+    :return: The request_uuid the reply will carry.
+    """
+    request_uuid = request_uuid or str(uuid.uuid4())
+    rpc_data = {
+        "request_uuid": request_uuid,
+        "uuid": procedure_uuid,
+        "data": data,
+        "timestamp": datetime.now().strftime(timestamp_format),
+    }
+    write_file_exclusive(get_rpc_request_path(staged_dir, request_uuid), json.dumps(rpc_data))
+    return request_uuid
+
+
+def get_inflight_path(procedure_uuid, data):
+    name = hashlib.sha256("\0".join(get_rpc_cache_key(procedure_uuid, data)).encode("utf-8"))
+    return os.path.join(inflight_dir, f"{name.hexdigest()}.json")
+
+
+def read_inflight_request(path):
+    """
+    :return: The request_uuid of the in-flight request, or None if there is
+        none. Markers older than inflight_stale_after are removed.
+    """
+    try:
+        with open(path, "r") as file:
+            request_uuid = json.load(file)["request_uuid"]
+        if time.time() - os.path.getmtime(path) <= inflight_stale_after:
+            return request_uuid
+        logger.info(f"Abandoning in-flight RPC request {request_uuid}.")
+        os.remove(path)
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    return None
+
+
+def stage_or_join_rpc_request(procedure_uuid, data):
+    """
+    Stages a request unless an identical one is already in flight.
+
+    The marker naming the request is published with a hard link, which fails
+    if it exists, so of several processes staging at once exactly one wins and
+    the others join its request.
+
+    :return: (request_uuid, marker path if this call staged the request, else None)
+    """
+    path = get_inflight_path(procedure_uuid, data)
+    request_uuid = str(uuid.uuid4())
+    tmp_path = os.path.join(inflight_dir, f".{request_uuid}.tmp")
+    try:
+        file = open(tmp_path, "w")
+    except FileNotFoundError:
+        os.makedirs(inflight_dir, exist_ok=True)
+        file = open(tmp_path, "w")
+    with file:
+        json.dump({"request_uuid": request_uuid, "uuid": procedure_uuid}, file)
+    try:
+        while True:
+            try:
+                os.link(tmp_path, path)
+                break
+            except FileExistsError:
+                inflight_uuid = read_inflight_request(path)
+                if inflight_uuid is not None:
+                    return inflight_uuid, None
+    finally:
+        os.remove(tmp_path)
+    try:
+        stage_rpc_request(procedure_uuid, data, request_uuid)
+    except BaseException:
+        release_inflight_request(path, request_uuid)
+        raise
+    return request_uuid, path
+
+
+def release_inflight_request(path, request_uuid):
+    # Only our own marker: a stale one may have been taken over meanwhile
+    try:
+        with open(path, "r") as file:
+            if json.load(file).get("request_uuid") != request_uuid:
+                return
+        os.remove(path)
+    except (FileNotFoundError, ValueError):
+        pass
+
+
+async def coalesce_rpc_call(procedure_uuid, data, call):
+    """
+    Runs call() once for identical calls made while it is running.
+
+    :param call: Coroutine function making the request.
+    :return: The result of the shared call.
+    """
+    key = get_rpc_cache_key(procedure_uuid, data)
+    task = inflight_calls.get(key)
+    if task is None:
+        task = asyncio.ensure_future(call())
+        inflight_calls[key] = task
+        task.add_done_callback(lambda _: inflight_calls.pop(key, None))
+    # A cancelled caller must not cancel the call the others wait for
+    return await asyncio.shield(task)
+
+
+def parse_rpc_replies(message_bytes):
+    """
+    Parts of a multi-part reply are stored until the set is complete, and
+    requests for parts we sent are queued for the sender.
+
+    :return: The reply dicts carried by an email, empty for any other email.
+    """
+    replies = []
+    message = email.message_from_bytes(message_bytes)
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        try:
+            content = json.loads(part.get_payload(decode=True) or b"")
+        except ValueError:
+            continue
+        if is_resend_request(content):
+            queue_resend_request(content)
+            continue
+        if is_message_part(content):
+            # Replies too large for one email arrive in parts
+            payload = add_received_part(content)
+            if payload is None:
+                continue
+            try:
+                content = json.loads(payload)
+            except ValueError:
+                continue
+        for reply in content if isinstance(content, list) else [content]:
+            if isinstance(reply, dict) and "request_uuid" in reply:
+                replies.append(reply)
+    return replies
+
+
+def deliver_rpc_reply(reply):
+    """
+    Hands a reply to whoever waits for it, in this or another process.
+
+    :return: True if the reply was stored.
+    """
+    try:
+        request_uuid = str(uuid.UUID(str(reply["request_uuid"])))  # Also keeps paths safe
+    except ValueError:
+        logger.warning(f"Ignoring reply with invalid request_uuid: {reply['request_uuid']!r}")
+        return False
+    try:
+        write_file_exclusive(get_rpc_request_path(done_dir, request_uuid), json.dumps(reply))
+    except FileNotFoundError:
+        os.makedirs(done_dir, exist_ok=True)
+        write_file_exclusive(get_rpc_request_path(done_dir, request_uuid), json.dumps(reply))
+    try:
+        os.remove(get_rpc_request_path(awaiting_response_dir, request_uuid))
+    except FileNotFoundError:
+        pass
+    for observer in reply_observers:
+        observer(request_uuid)
+    return True
+
+
+def deliver_rpc_replies_from_message(message_bytes):
+    return sum(deliver_rpc_reply(reply) for reply in parse_rpc_replies(message_bytes))
+
+
+def read_rpc_reply(request_uuid):
+    try:
+        with open(get_rpc_request_path(done_dir, request_uuid), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+async def wait_for_rpc_reply(request_uuid, timeout=None):
+    """
+    :return: The reply dict, or None if none arrived within the timeout or
+        the sender gave the request up.
+    """
+    timeout = rpc_reply_timeout if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    while True:
+        reply = read_rpc_reply(request_uuid)
+        if reply is not None:
+            return reply
+        if os.path.exists(get_rpc_request_path(failed_dir, request_uuid)):
+            logger.warning(f"RPC request {request_uuid} expired without a reply.")
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        await wait_for_new_work([done_dir, failed_dir], remaining)
+
+
+def list_awaited_requests():
+    paths = []
+    for directory in (staged_dir, awaiting_response_dir):
+        try:
+            with os.scandir(directory) as it:
+                paths.extend(entry.path for entry in it if entry.name.endswith(".json"))
+        except FileNotFoundError:
+            continue
+    return paths
+
+
+def get_oldest_awaited_time():
+    mtimes = []
+    for path in list_awaited_requests():
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except FileNotFoundError:
+            continue
+    return min(mtimes, default=None)
+
+
+async def receive_rpc_replies(email_account, email_account_db_name=None):
+    """
+    Receives replies until nothing was awaited for reply_listener_linger seconds.
+
+    Uses IMAP (IDLE push, or polling without IDLE) if the account has an IMAP
+    account, otherwise POP3 polling.
+    """
+    email_account_db_name = email_account_db_name or get_email_account_db_name()
+    email_address = get_email_address_from_email_account(email_account or {})
+    last_awaited = time.monotonic()
+
+    def should_stop():
+        nonlocal last_awaited
+        if list_awaited_requests():
+            last_awaited = time.monotonic()
+            return False
+        return time.monotonic() - last_awaited > reply_listener_linger
+
+    imap_account = None
+    if email_address:
+        imap_account = await get_imap_account_for_email_address(
+            email_address, email_account_db_name=email_account_db_name
+        )
+    if imap_account is not None:
+        await watch_mailbox(
+            imap_account,
+            deliver_rpc_replies_from_message,
+            should_stop,
+            email_account_db_name,
+            resync_since=get_oldest_awaited_time(),
+        )
+    elif (
+        email_account
+        and check_pop_server_in_email_account(email_account)
+        and check_pop_port_in_email_account(email_account)
+        and check_password_in_email_account(email_account)
+    ):
+        while not should_stop():
+            for path in await sync_pop3_mailbox(email_account, email_account_db_name):
+                with open(path, "rb") as file:
+                    deliver_rpc_replies_from_message(file.read())
+            await asyncio.sleep(pop3_reply_poll_interval)
+    else:
+        logger.warning(f"No IMAP or POP3 account to receive RPC replies for {email_address}.")
+        await asyncio.sleep(reply_listener_linger)
+
+
+async def rpc_reply_listener(get_email_account):
+    """
+    Runs in the sender: receives replies while RPC requests are awaited.
+
+    :param get_email_account: Coroutine function returning the account to use.
+    """
+    backoff = reply_reconnect_backoff
+    while True:
+        if not list_awaited_requests():
+            await wait_for_new_work([staged_dir, awaiting_response_dir], reply_listener_linger)
+            continue
+        try:
+            await receive_rpc_replies(await get_email_account())
+            backoff = reply_reconnect_backoff
+        except (IMAPError, POP3Error, OSError, asyncio.TimeoutError) as e:
+            logger.warning(f"RPC reply listener disconnected: {e}, reconnecting in {backoff}s.")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, reply_reconnect_backoff_max)
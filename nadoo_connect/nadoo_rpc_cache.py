@@ -0,0 +1,148 @@
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+from .nadoo_storage import get_storage
+
+
+logger = logging.getLogger(__name__)
+
+# RPC result cache settings. Caching is opt-in: only procedures with a TTL
+# (here or passed as cache_ttl to get_xyz_for_xyz_remote) are cached.
+rpc_cache_ttls = {}  # Procedure uuid -> seconds a result stays fresh
+rpc_stale_while_revalidate = 0  # Seconds past the TTL a stale result is still served
+rpc_cache_max_entries = 1024  # Results kept in memory, least recently used dropped first
+rpc_cache_db_path = "rpc_cache.db"  # Persistent tier, None keeps the cache in memory only
+
+
+def get_rpc_cache_key(procedure_uuid, data):
+    # Canonical JSON, so equal data hashes equally whatever its key order
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return str(procedure_uuid), hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_rpc_cache_ttl(procedure_uuid, cache_ttl=None):
+    return cache_ttl if cache_ttl is not None else rpc_cache_ttls.get(procedure_uuid)
+
+
+def setup_rpc_cache_table(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rpc_cache (
+            procedure_uuid TEXT,
+            data_hash TEXT,
+            result TEXT,       -- JSON
+            stored_at REAL,
+            PRIMARY KEY (procedure_uuid, data_hash)
+        )
+        """
+    )
+
+
+def load_rpc_cache_entry(conn, key):
+    row = conn.execute(
+        "SELECT result, stored_at FROM rpc_cache WHERE procedure_uuid = ? AND data_hash = ?",
+        key,
+    ).fetchone()
+    return (json.loads(row[0]), row[1]) if row else None
+
+
+def save_rpc_cache_entry(conn, key, result, stored_at):
+    conn.execute(
+        "INSERT OR REPLACE INTO rpc_cache (procedure_uuid, data_hash, result, stored_at) VALUES (?, ?, ?, ?)",
+        (*key, json.dumps(result), stored_at),
+    )
+
+
+class RPCResultCache:
+    """
+    Two-tier cache of RPC results keyed by (procedure uuid, data hash).
+
+    Lookups go to an in-memory LRU first, then to sqlite, which survives
+    restarts and is shared by processes. A result older than its TTL but
+    within rpc_stale_while_revalidate is returned at once while one
+    background call refreshes it. None results (no reply) are not cached.
+    """
+
+    def __init__(self, db_path=None, max_entries=None, persistent=True):
+        self.db_path = (db_path or rpc_cache_db_path) if persistent else None
+        self.max_entries = max_entries or rpc_cache_max_entries
+        self.entries = OrderedDict()  # key -> (result, stored_at)
+        self.refreshing = {}  # key -> background refresh task
+
+    def remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def lookup(self, key):
+        """
+        :return: (result, stored_at), or None on a miss.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+        if self.db_path is None:
+            return None
+        entry = await get_storage(self.db_path).read(
+            load_rpc_cache_entry, key, setup=setup_rpc_cache_table
+        )
+        if entry is not None:
+            self.remember(key, entry)
+        return entry
+
+    async def store(self, key, result):
+        entry = (result, time.time())
+        self.remember(key, entry)
+        if self.db_path is not None:
+            await get_storage(self.db_path).write(
+                save_rpc_cache_entry, key, *entry, setup=setup_rpc_cache_table
+            )
+
+    async def fetch_and_store(self, key, fetch):
+        result = await fetch()
+        if result is not None:
+            await self.store(key, result)
+        return result
+
+    def refresh_in_background(self, key, fetch):
+        if key in self.refreshing:
+            return
+        task = asyncio.create_task(self.fetch_and_store(key, fetch))
+        self.refreshing[key] = task
+        task.add_done_callback(lambda _: self.refreshing.pop(key, None))
+
+    async def call(self, procedure_uuid, data, ttl, fetch):
+        """
+        :param ttl: Seconds a cached result is fresh.
+        :param fetch: Coroutine function making the actual call.
+        :return: The cached or fetched result.
+        """
+        key = get_rpc_cache_key(procedure_uuid, data)
+        entry = await self.lookup(key)
+        if entry is not None:
+            result, stored_at = entry
+            age = time.time() - stored_at
+            if age <= ttl:
+                return result
+            if age <= ttl + rpc_stale_while_revalidate:
+                logger.debug(f"Serving stale result of {procedure_uuid} ({age:.0f}s old), refreshing.")
+                self.refresh_in_background(key, fetch)
+                return result
+        return await self.fetch_and_store(key, fetch)
+
+
+rpc_result_cache = None
+
+
+def get_rpc_result_cache():
+    # Created on first use, so rpc_cache_db_path can be changed before
+    global rpc_result_cache
+    if rpc_result_cache is None:
+        rpc_result_cache = RPCResultCache()
+    return rpc_result_cache
@@ -0,0 +1,116 @@
+import os
+import time
+import asyncio
+import logging
+
+from . import nadoo_rpc
+from .nadoo_manifest import track_awaited_rpc
+from .nadoo_timers import TimerWheel
+
+
+logger = logging.getLogger(__name__)
+
+# Expiry settings. A request that gets no reply within rpc_response_deadline
+# of being sent is staged again up to rpc_resend_attempts times, then moved
+# to rpc_failed, which makes its waiters give up (see wait_for_rpc_reply).
+rpc_response_deadline = nadoo_rpc.rpc_reply_timeout  # Seconds a sent request waits for its reply
+rpc_resend_attempts = 0  # Times an unanswered request is sent again before it fails
+expiry_tick = 1.0  # Seconds per timer wheel tick
+
+
+class RPCDeadlines:
+    """
+    The reply deadlines of the RPCs in rpc_awaiting_response, in a TimerWheel.
+
+    Sent RPCs are tracked in the sender's manifest with their send time and
+    resend count, so a restart reloads the deadlines without reading the
+    request files. Replies cancel their timer through nadoo_rpc's reply
+    observers.
+    """
+
+    def __init__(self, manifest=None, now=None):
+        self.manifest = manifest
+        self.wheel = TimerWheel(expiry_tick, now=now)
+        self.resends = {}  # request_uuid -> times sent again
+
+    def load(self):
+        """
+        Tracks the RPCs already awaiting a reply: those in the manifest, and
+        any in rpc_awaiting_response it does not know (sent by an older version).
+        """
+        known = {}
+        if self.manifest is not None:
+            for key, entry in self.manifest.items("rpc:"):
+                known[key[4:]] = entry
+        try:
+            with os.scandir(nadoo_rpc.awaiting_response_dir) as it:
+                for file in it:
+                    request_uuid = file.name[: -len(".json")]
+                    if file.name.endswith(".json") and request_uuid not in known:
+                        known[request_uuid] = {"sent_at": file.stat().st_mtime}
+        except FileNotFoundError:
+            pass
+        for request_uuid, entry in known.items():
+            self.track(request_uuid, entry["sent_at"], entry.get("resends", 0))
+        return len(known)
+
+    def track(self, request_uuid, sent_at=None, resends=None):
+        sent_at = sent_at or time.time()
+        if resends is not None:
+            self.resends[request_uuid] = resends
+        if self.manifest is not None:
+            track_awaited_rpc(self.manifest, request_uuid, sent_at, self.resends.get(request_uuid, 0))
+        self.wheel.add(request_uuid, sent_at + rpc_response_deadline)
+
+    def answered(self, request_uuid):
+        self.wheel.cancel(request_uuid)
+        self.resends.pop(request_uuid, None)
+        if self.manifest is not None:
+            self.manifest.remove(f"rpc:{request_uuid}")
+
+    def expire(self, now=None):
+        """
+        :return: (resent, failed) request uuids whose deadline passed.
+        """
+        resent, failed = [], []
+        for request_uuid in self.wheel.advance(now):
+            awaiting_path = nadoo_rpc.get_rpc_request_path(
+                nadoo_rpc.awaiting_response_dir, request_uuid
+            )
+            if os.path.exists(nadoo_rpc.get_rpc_request_path(nadoo_rpc.done_dir, request_uuid)):
+                self.answered(request_uuid)  # Answered in another process
+                continue
+            resends = self.resends.get(request_uuid, 0)
+            try:
+                if resends < rpc_resend_attempts:
+                    # Tracked again with the new send, see move_to_awaiting
+                    self.resends[request_uuid] = resends + 1
+                    os.rename(
+                        awaiting_path,
+                        nadoo_rpc.get_rpc_request_path(nadoo_rpc.staged_dir, request_uuid),
+                    )
+                    resent.append(request_uuid)
+                    continue
+                os.makedirs(nadoo_rpc.failed_dir, exist_ok=True)
+                os.rename(
+                    awaiting_path,
+                    nadoo_rpc.get_rpc_request_path(nadoo_rpc.failed_dir, request_uuid),
+                )
+                failed.append(request_uuid)
+            except FileNotFoundError:
+                pass  # Gone meanwhile, e.g. answered
+            self.answered(request_uuid)
+        if resent:
+            logger.warning(f"Sending {len(resent)} unanswered RPC requests again.")
+        if failed:
+            logger.error(f"{len(failed)} RPC requests got no reply in time, moved to rpc_failed.")
+        return resent, failed
+
+
+async def rpc_expiry_loop(deadlines):
+    while True:
+        try:
+            deadlines.expire()
+        except OSError as e:
+            logger.warning(f"Unable to expire RPC requests: {e}")
+        await asyncio.sleep(expiry_tick)
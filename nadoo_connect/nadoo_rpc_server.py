@@ -0,0 +1,249 @@
+import json
+import time
+import email
+import asyncio
+import logging
+import multiprocessing
+from email.utils import parseaddr
+from concurrent.futures import ProcessPoolExecutor
+
+from .nadoo_email import (
+    get_email_address_from_email_account,
+    get_email_address_password_from_email_account,
+    get_smtp_port_from_email_account,
+    get_smtp_server_from_email_account,
+    send_email,
+)
+from .nadoo_imap import get_imap_account_for_email_address, watch_mailbox
+from .nadoo_parts import add_received_part, is_message_part
+from .nadoo_pop3 import sync_pop3_mailbox
+
+
+logger = logging.getLogger(__name__)
+
+# Server settings: the receiving side of "Batched RPC Requests" emails. Replies
+# go back as {"request_uuid": ..., "result": ...} (or "error") lists, which
+# parse_rpc_replies on the calling side understands.
+rpc_handler_timeout = 60  # Default seconds a call may take before it fails
+rpc_handler_concurrency = 8  # Default calls of one procedure at the same time
+rpc_process_workers = None  # Worker processes for CPU-bound handlers, None for one per CPU
+reply_batch_count = 50  # Replies per reply email
+reply_batch_bytes = 64 * 1024  # JSON bytes per reply email
+reply_linger = 0.5  # Seconds a part-filled reply email waits for more replies
+pop3_request_poll_interval = 10  # Seconds between POP3 polls without an IMAP account
+
+
+class RPCHandler:
+    def __init__(self, func, cpu_bound=False, timeout=None, concurrency=None):
+        self.func = func
+        self.cpu_bound = cpu_bound
+        self.timeout = timeout or rpc_handler_timeout
+        self.semaphore = asyncio.Semaphore(concurrency or rpc_handler_concurrency)
+        self.is_coroutine = asyncio.iscoroutinefunction(func)
+
+
+class RPCServer:
+    """
+    Runs the procedures of incoming RPC requests and batches the replies.
+
+    Every procedure UUID maps to a handler taking the request's data:
+    coroutine functions run on the event loop (I/O-bound work), plain
+    functions registered with cpu_bound=True in a process pool, and other
+    plain functions on a worker thread. Each handler has its own concurrency
+    limit and timeout; a call that fails or times out is answered with an
+    "error" instead of a "result". A process pool call that times out keeps
+    its worker busy until it returns, as processes cannot be interrupted.
+
+    :param send_replies: Coroutine function (to_email, replies) returning True
+        if the reply email was sent.
+    """
+
+    def __init__(self, send_replies):
+        self.send_replies = send_replies
+        self.handlers = {}
+        self.pool = None
+        self.tasks = set()
+        self.pending = {}  # Reply address -> replies not sent yet
+        self.flushers = {}  # Reply address -> task sending them after reply_linger
+
+    def register(self, procedure_uuid, func, cpu_bound=False, timeout=None, concurrency=None):
+        """
+        :param cpu_bound: Runs func in a worker process; it must be picklable
+            (a module level function) and so must its data and result.
+        :param timeout: Seconds a call may take, defaults to rpc_handler_timeout.
+        :param concurrency: Calls at the same time, defaults to rpc_handler_concurrency.
+        """
+        self.handlers[str(procedure_uuid)] = RPCHandler(func, cpu_bound, timeout, concurrency)
+
+    def procedure(self, procedure_uuid, **options):
+        # Decorator form of register
+        def decorator(func):
+            self.register(procedure_uuid, func, **options)
+            return func
+
+        return decorator
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=rpc_process_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self.pool
+
+    async def call(self, request):
+        """
+        :param request: {"request_uuid", "uuid" (the procedure), "data"}.
+        :return: The reply dict.
+        """
+        request_uuid = request.get("request_uuid")
+        handler = self.handlers.get(str(request.get("uuid")))
+        if handler is None:
+            return {"request_uuid": request_uuid, "error": f"Unknown procedure {request.get('uuid')}"}
+        async with handler.semaphore:
+            started = time.monotonic()
+            try:
+                if handler.is_coroutine:
+                    result = handler.func(request.get("data"))
+                else:
+                    loop = asyncio.get_running_loop()
+                    pool = self.get_pool() if handler.cpu_bound else None
+                    result = loop.run_in_executor(pool, handler.func, request.get("data"))
+                result = await asyncio.wait_for(result, handler.timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"RPC {request_uuid} timed out after {handler.timeout}s.")
+                return {"request_uuid": request_uuid, "error": "Timed out"}
+            except Exception as e:
+                logger.error(f"RPC {request_uuid} failed: {e!r}")
+                return {"request_uuid": request_uuid, "error": repr(e)}
+            logger.debug(f"RPC {request_uuid} took {time.monotonic() - started:.3f}s.")
+            return {"request_uuid": request_uuid, "result": result}
+
+    async def handle_requests(self, requests, reply_to):
+        # The batch fans out at once; limits apply per handler
+        replies = await asyncio.gather(*(self.call(request) for request in requests))
+        for reply in replies:
+            await self.add_reply(reply_to, reply)
+        return replies
+
+    async def handle_message(self, message_bytes):
+        """
+        Runs the requests of one email and queues their replies.
+
+        :return: The replies, empty for an email without requests.
+        """
+        message = email.message_from_bytes(message_bytes)
+        reply_to = parseaddr(message.get("Reply-To") or message.get("From") or "")[1]
+        requests = []
+        for part in message.walk():
+            if part.is_multipart():
+                continue
+            try:
+                content = json.loads(part.get_payload(decode=True) or b"")
+            except ValueError:
+                continue
+            if is_message_part(content):
+                # Requests too large for one email arrive in parts
+                payload = add_received_part(content)
+                if payload is None:
+                    continue
+                content = json.loads(payload)
+            for request in content if isinstance(content, list) else [content]:
+                if isinstance(request, dict) and "request_uuid" in request and "uuid" in request:
+                    requests.append(request)
+        if not requests:
+            return []
+        if not reply_to:
+            logger.warning(f"Dropping {len(requests)} RPC requests without a sender address.")
+            return []
+        return await self.handle_requests(requests, reply_to)
+
+    def submit_message(self, message_bytes):
+        # For mailbox watchers, which call a plain function per message
+        task = asyncio.ensure_future(self.handle_message(message_bytes))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def add_reply(self, reply_to, reply):
+        pending = self.pending.setdefault(reply_to, [])
+        pending.append(reply)
+        size = sum(len(json.dumps(reply)) + 2 for reply in pending)
+        if len(pending) >= reply_batch_count or size >= reply_batch_bytes:
+            await self.flush(reply_to)
+        elif reply_to not in self.flushers:
+            self.flushers[reply_to] = asyncio.ensure_future(self.flush_later(reply_to))
+
+    async def flush_later(self, reply_to):
+        await asyncio.sleep(reply_linger)
+        self.flushers.pop(reply_to, None)
+        await self.flush(reply_to)
+
+    async def flush(self, reply_to=None):
+        """
+        Sends the pending replies, of one address or all. Replies of a failed
+        send stay pending for the next flush.
+        """
+        for address in [reply_to] if reply_to else list(self.pending):
+            replies = self.pending.pop(address, [])
+            if not replies:
+                continue
+            flusher = self.flushers.pop(address, None)
+            if flusher is not None and flusher is not asyncio.current_task():
+                flusher.cancel()
+            if not await self.send_replies(address, replies):
+                logger.warning(f"Unable to send {len(replies)} RPC replies to {address}.")
+                self.pending.setdefault(address, [])[:0] = replies
+
+    async def close(self):
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.flush()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+
+def get_email_reply_sender(email_account):
+    """
+    :return: A send_replies function for RPCServer that sends from the account.
+    """
+
+    async def send_replies(to_email, replies):
+        return await send_email(
+            "RPC Replies",
+            json.dumps(replies),
+            to_email,
+            get_smtp_server_from_email_account(email_account),
+            int(get_smtp_port_from_email_account(email_account)),
+            get_email_address_from_email_account(email_account),
+            get_email_address_password_from_email_account(email_account),
+        )
+
+    return send_replies
+
+
+async def serve_rpc_requests(server, email_account, email_account_db_name, should_stop=None):
+    """
+    Runs the server on the requests arriving in the account's mailbox: pushed
+    by IMAP where the account has an IMAP account, polled by POP3 otherwise.
+
+    :param should_stop: Optional callable; serving ends once it returns True.
+    """
+    should_stop = should_stop or (lambda: False)
+    email_address = get_email_address_from_email_account(email_account)
+    imap_account = await get_imap_account_for_email_address(
+        email_address, email_account_db_name=email_account_db_name
+    )
+    try:
+        if imap_account is not None:
+            await watch_mailbox(
+                imap_account, server.submit_message, should_stop, email_account_db_name
+            )
+        else:
+            while not should_stop():
+                for path in await sync_pop3_mailbox(email_account, email_account_db_name):
+                    with open(path, "rb") as file:
+                        await server.handle_message(file.read())
+                await asyncio.sleep(pop3_request_poll_interval)
+    finally:
+        await server.close()
@@ -0,0 +1,143 @@
+import os
+import time
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Lane settings: weights decide the share of send slots while both lanes are
+# backlogged, SLOs the age after which a lane's oldest item takes the next slot.
+rpc_lane_weight = 3
+execution_lane_weight = 1
+rpc_latency_slo = 2  # Seconds
+execution_latency_slo = 60  # Seconds
+wake_poll_interval = 0.2  # Seconds between checks for newly staged work
+
+
+class Lane:
+    def __init__(self, name, weight, latency_slo, priority=0):
+        self.name = name
+        self.weight = weight
+        self.latency_slo = latency_slo
+        self.priority = priority  # Breaks ties, higher goes first
+        self.current_weight = 0
+        self.slots = 0
+        self.slo_misses = 0
+
+
+class SendScheduler:
+    """
+    Decides which lane gets the next send slot.
+
+    Backlogged lanes share slots by smooth weighted round robin. A lane whose
+    oldest pending item is older than its latency SLO takes the next slot.
+    Idle lanes keep no credit, so a lane that becomes busy again (a newly staged
+    RPC) wins the next slot as long as its weight is the highest.
+    """
+
+    def __init__(self, lanes):
+        self.lanes = {lane.name: lane for lane in lanes}
+
+    def choose(self, oldest_ages):
+        """
+        :param oldest_ages: Maps lane name to the age in seconds of its oldest
+            pending item, or None if the lane has nothing pending.
+        :return: The name of the lane to serve, or None if all lanes are idle.
+        """
+        pending = []
+        for lane in self.lanes.values():
+            if oldest_ages.get(lane.name) is None:
+                lane.current_weight = 0
+            else:
+                pending.append(lane)
+        if not pending:
+            return None
+
+        total_weight = sum(lane.weight for lane in pending)
+        for lane in pending:
+            lane.current_weight += lane.weight
+
+        overdue = [
+            lane for lane in pending if oldest_ages[lane.name] >= lane.latency_slo
+        ]
+        if overdue:
+            chosen = max(
+                overdue,
+                key=lambda lane: (oldest_ages[lane.name] / lane.latency_slo, lane.priority),
+            )
+            chosen.slo_misses += 1
+            logger.warning(
+                f"Lane {chosen.name} missed its {chosen.latency_slo}s SLO "
+                f"(oldest item {oldest_ages[chosen.name]:.1f}s)."
+            )
+        else:
+            chosen = max(pending, key=lambda lane: (lane.current_weight, lane.priority))
+
+        chosen.current_weight -= total_weight
+        chosen.slots += 1
+        return chosen.name
+
+    def get_stats(self):
+        return {
+            name: {"slots": lane.slots, "slo_misses": lane.slo_misses}
+            for name, lane in self.lanes.items()
+        }
+
+
+def create_default_scheduler():
+    return SendScheduler(
+        [
+            Lane("rpc", rpc_lane_weight, rpc_latency_slo, priority=1),
+            Lane("executions", execution_lane_weight, execution_latency_slo),
+        ]
+    )
+
+
+def get_oldest_pending_age(directory, suffix=".json"):
+    oldest = None
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if not entry.name.endswith(suffix) or not entry.is_file():
+                    continue
+                try:
+                    mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                if oldest is None or mtime < oldest:
+                    oldest = mtime
+    except FileNotFoundError:
+        return None
+    if oldest is None:
+        return None
+    return max(0.0, time.time() - oldest)
+
+
+def get_directory_versions(directories):
+    versions = []
+    for directory in directories:
+        try:
+            versions.append(os.stat(directory).st_mtime_ns)
+        except FileNotFoundError:
+            versions.append(None)
+    return versions
+
+
+async def wait_for_new_work(directories, timeout, poll_interval=None):
+    """
+    Waits until one of the directories changes or the timeout passes.
+
+    Adding a file changes the directory mtime, so this is a cheap stat per poll
+    and also sees files staged by other processes.
+
+    :return: True if new work arrived, False on timeout.
+    """
+    poll_interval = poll_interval or wake_poll_interval
+    versions = get_directory_versions(directories)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(min(poll_interval, max(0, deadline - time.monotonic())))
+        if get_directory_versions(directories) != versions:
+            return True
+    return False
@@ -0,0 +1,383 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+import portalocker
+
+
+logger = logging.getLogger(__name__)
+
+executions_dir = "executions"
+overflow_dir = "executions_overflow"  # Aggregated summaries written under the spill policy
+
+# Spool quotas
+spool_max_records = 100000  # Pending execution files before the overflow policy applies
+spool_max_bytes = 256 * 1024 * 1024  # Pending execution bytes before the overflow policy applies
+spool_overflow_policy = "block"  # "block", "reject" or "spill"
+spool_block_timeout = 30  # Seconds the block policy waits for room before rejecting
+spool_depth_cache_ttl = 1.0  # Seconds a spool scan is reused by get_spool_depth
+
+# Spool layout: executions/<bucket>/<execution_uuid>.json, one bucket per minute.
+# Bucket names sort chronologically, so draining buckets in name order is oldest first.
+spool_bucket_format = "%Y%m%d%H%M"
+spool_bucket_seconds = 60
+empty_bucket_grace = 120  # Seconds before an empty bucket may be removed
+overflow_policies = ("block", "reject", "spill")
+
+
+class SpoolFullError(Exception):
+    """Raised when the execution spool is over quota and the record was not stored."""
+
+    def __init__(self, depth, message=None):
+        self.depth = depth
+        super().__init__(
+            message
+            or f"Execution spool is full ({depth['records']} records, {depth['bytes']} bytes)."
+        )
+
+
+_depth_cache = {"scanned_at": 0.0, "records": 0, "bytes": 0}
+
+
+def scan_spool_depth(directory=None):
+    directory = directory or executions_dir
+    records = 0
+    size = 0
+    for path in iter_spool_files(directory):
+        try:
+            size += os.path.getsize(path)
+        except FileNotFoundError:
+            continue
+        records += 1
+    return records, size
+
+
+def get_spool_depth(max_age=None):
+    """
+    Returns the current spool depth, so producers can adapt under backlog.
+
+    The directory scan is shared for max_age seconds (spool_depth_cache_ttl by
+    default); records written by this process in between are added on top.
+
+    :return: A dict with records, bytes, the quotas, utilization (0..1+) and
+        the number of spilled summaries waiting in the overflow directory.
+    """
+    max_age = spool_depth_cache_ttl if max_age is None else max_age
+    now = time.monotonic()
+    if now - _depth_cache["scanned_at"] > max_age:
+        records, size = scan_spool_depth()
+        _depth_cache.update(scanned_at=now, records=records, bytes=size)
+
+    try:
+        overflow_summaries = len(
+            [name for name in os.listdir(overflow_dir) if name.endswith(".json")]
+        )
+    except FileNotFoundError:
+        overflow_summaries = 0
+
+    return {
+        "records": _depth_cache["records"],
+        "bytes": _depth_cache["bytes"],
+        "max_records": spool_max_records,
+        "max_bytes": spool_max_bytes,
+        "utilization": max(
+            _depth_cache["records"] / spool_max_records,
+            _depth_cache["bytes"] / spool_max_bytes,
+        ),
+        "overflow_summaries": overflow_summaries,
+    }
+
+
+def note_spooled(record_size):
+    # Keeps the cached depth honest between scans
+    _depth_cache["records"] += 1
+    _depth_cache["bytes"] += record_size
+
+
+def is_over_quota(depth, record_size=0):
+    return (
+        depth["records"] + 1 > spool_max_records
+        or depth["bytes"] + record_size > spool_max_bytes
+    )
+
+
+async def reserve_spool_slot(record_size, policy=None, timeout=None):
+    """
+    Applies the overflow policy before a record is written to the spool.
+
+    :param record_size: Size of the serialized record in bytes.
+    :param policy: "block", "reject" or "spill"; spool_overflow_policy by default.
+    :param timeout: Seconds the block policy waits; spool_block_timeout by default.
+    :return: True if the record may be spooled, False if it must be spilled.
+    :raises SpoolFullError: If the spool is full under the reject policy, or stays
+        full for the whole timeout under the block policy.
+    """
+    policy = policy or spool_overflow_policy
+    if policy not in overflow_policies:
+        raise ValueError(f"Unknown spool overflow policy: {policy}")
+
+    depth = get_spool_depth()
+    if not is_over_quota(depth, record_size):
+        return True
+
+    if policy == "spill":
+        return False
+    if policy == "reject":
+        raise SpoolFullError(depth)
+
+    timeout = spool_block_timeout if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(min(spool_depth_cache_ttl, max(0, deadline - time.monotonic())))
+        depth = get_spool_depth()
+        if not is_over_quota(depth, record_size):
+            return True
+    raise SpoolFullError(depth)
+
+
+def get_overflow_summary_path(customer_program_uuid):
+    key = hashlib.sha256(str(customer_program_uuid).encode("utf-8")).hexdigest()[:32]
+    return os.path.join(overflow_dir, f"{key}.json")
+
+
+def spill_execution_to_summary(execution_data):
+    """
+    Folds an execution into the aggregated overflow summary of its program.
+
+    One summary per customer_program_uuid counts the spilled executions and the
+    time range they cover; the sender turns it into a single record later.
+    """
+    os.makedirs(overflow_dir, exist_ok=True)
+    path = get_overflow_summary_path(execution_data["customer_program_uuid"])
+    with portalocker.Lock(f"{path}.lock", mode="a", timeout=10):
+        summary = None
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                summary = json.load(file)
+        if summary is None:
+            summary = {
+                "customer_program_uuid": execution_data["customer_program_uuid"],
+                "execution_count": 0,
+                "timestamp": execution_data["timestamp"],
+                "last_timestamp": execution_data["timestamp"],
+            }
+        summary["execution_count"] += execution_data.get("execution_count", 1)
+        summary["last_timestamp"] = execution_data["timestamp"]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(summary, file)
+        os.replace(tmp_path, path)
+
+
+def drain_overflow_summaries(write_record):
+    """
+    Moves spilled summaries back into the spool while it has room.
+
+    :param write_record: Callable storing one execution record in the spool.
+    :return: The number of summaries drained.
+    """
+    try:
+        names = [name for name in os.listdir(overflow_dir) if name.endswith(".json")]
+    except FileNotFoundError:
+        return 0
+
+    drained = 0
+    for name in names:
+        if is_over_quota(get_spool_depth(max_age=0)):
+            break
+        path = os.path.join(overflow_dir, name)
+        with portalocker.Lock(f"{path}.lock", mode="a", timeout=10):
+            try:
+                with open(path, "r") as file:
+                    summary = json.load(file)
+            except FileNotFoundError:
+                continue
+            record = dict(summary, execution_uuid=str(uuid.uuid4()))
+            write_record(record)
+            os.remove(path)
+        drained += 1
+        logger.info(
+            f"Drained overflow summary of {summary['execution_count']} executions "
+            f"for {summary['customer_program_uuid']}."
+        )
+    return drained
+
+
+def get_spool_bucket(timestamp=None):
+    return time.strftime(spool_bucket_format, time.localtime(timestamp or time.time()))
+
+
+def is_spool_bucket(name):
+    return len(name) == 12 and name.isdigit()
+
+
+def get_bucket_start(bucket):
+    return time.mktime(time.strptime(bucket, spool_bucket_format))
+
+
+def get_spool_file_path(execution_uuid, timestamp=None, directory=None):
+    directory = directory or executions_dir
+    return os.path.join(directory, get_spool_bucket(timestamp), f"{execution_uuid}.json")
+
+
+def list_spool_buckets(directory=None):
+    directory = directory or executions_dir
+    try:
+        with os.scandir(directory) as it:
+            return sorted(
+                entry.name for entry in it if entry.is_dir() and is_spool_bucket(entry.name)
+            )
+    except FileNotFoundError:
+        return []
+
+
+def iter_spool_files(directory=None):
+    # Oldest bucket first; files written before sharding sit at the top level.
+    directory = directory or executions_dir
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.endswith(".json") and entry.is_file():
+                    yield entry.path
+    except FileNotFoundError:
+        return
+    for bucket in list_spool_buckets(directory):
+        try:
+            with os.scandir(os.path.join(directory, bucket)) as it:
+                for entry in it:
+                    if entry.name.endswith(".json"):
+                        yield entry.path
+        except FileNotFoundError:
+            continue
+
+
+class SpoolCursor:
+    """
+    Drains the sharded spool oldest bucket first.
+
+    The cursor only lists the small top-level directory when it changed (a new
+    bucket appeared) and scans buckets in order until a batch is full, so the
+    cost of a batch does not grow with the total number of pending files.
+    Buckets that are empty and older than empty_bucket_grace are removed.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or executions_dir
+        self.buckets = []
+        self._version = None
+
+    def refresh(self):
+        try:
+            version = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            self.buckets = []
+            return
+        if version != self._version:
+            self._version = version
+            self.buckets = list_spool_buckets(self.directory)
+
+    def next_batch(self, limit, skip=None):
+        """
+        :param limit: Maximum number of paths to return.
+        :param skip: Optional predicate for paths to leave out (e.g. in flight).
+        :return: Up to limit spool file paths, oldest buckets first.
+        """
+        self.refresh()
+        batch = []
+        for bucket in list(self.buckets):
+            bucket_path = os.path.join(self.directory, bucket)
+            found = False
+            try:
+                with os.scandir(bucket_path) as it:
+                    for entry in it:
+                        if not entry.name.endswith(".json"):
+                            found = True  # e.g. a write in progress
+                            continue
+                        found = True
+                        if skip is not None and skip(entry.path):
+                            continue
+                        batch.append(entry.path)
+                        if len(batch) >= limit:
+                            return batch
+            except FileNotFoundError:
+                self.buckets.remove(bucket)
+                continue
+            if not found:
+                self.remove_bucket_if_stale(bucket)
+        return batch
+
+    def remove_bucket_if_stale(self, bucket):
+        if time.time() - get_bucket_start(bucket) < spool_bucket_seconds + empty_bucket_grace:
+            return
+        try:
+            os.rmdir(os.path.join(self.directory, bucket))
+            self.buckets.remove(bucket)
+        except OSError:
+            pass  # A producer wrote into it meanwhile
+
+    def get_oldest_pending_age(self):
+        # The first non-empty bucket bounds the age of the oldest record.
+        self.refresh()
+        for bucket in self.buckets:
+            try:
+                with os.scandir(os.path.join(self.directory, bucket)) as it:
+                    if any(entry.name.endswith(".json") for entry in it):
+                        return max(0.0, time.time() - get_bucket_start(bucket))
+            except FileNotFoundError:
+                continue
+        return None
+
+
+def get_record_timestamp(path):
+    try:
+        with open(path, "r") as file:
+            timestamp = json.load(file).get("timestamp")
+        return time.mktime(time.strptime(timestamp[:19], "%Y-%m-%d %H:%M:%S"))
+    except (ValueError, TypeError, AttributeError, json.JSONDecodeError):
+        return os.path.getmtime(path)
+
+
+def migrate_flat_spool(directory=None):
+    """
+    Moves execution files from the old flat layout into time buckets.
+
+    Each file goes to the bucket of its recorded timestamp (or its mtime), so
+    migrated records keep their place in the oldest-first order.
+
+    :return: The number of files moved.
+    """
+    directory = directory or executions_dir
+    moved = 0
+    try:
+        with os.scandir(directory) as it:
+            flat_files = [
+                entry.path for entry in it if entry.name.endswith(".json") and entry.is_file()
+            ]
+    except FileNotFoundError:
+        return 0
+
+    for path in flat_files:
+        try:
+            bucket_dir = os.path.join(directory, get_spool_bucket(get_record_timestamp(path)))
+            os.makedirs(bucket_dir, exist_ok=True)
+            os.rename(path, os.path.join(bucket_dir, os.path.basename(path)))
+            moved += 1
+        except FileNotFoundError:
+            continue  # Sent by a running sender meanwhile
+    if moved:
+        logger.info(f"Migrated {moved} execution files into the sharded spool layout.")
+    return moved
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["migrate"]:
+        print(f"Migrated {migrate_flat_spool()} execution files.")
+    elif sys.argv[1:] == ["depth"]:
+        print(json.dumps(get_spool_depth(max_age=0)))
+    else:
+        print("Usage: python -m nadoo_connect.nadoo_spool [migrate|depth]")
@@ -0,0 +1,214 @@
+import os
+import queue
+import atexit
+import sqlite3
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+# Storage settings
+storage_busy_timeout = 5  # Seconds sqlite waits for a lock held by another process
+storage_write_retries = 3  # Attempts before a batch that cannot lock the database fails
+storage_write_batch_max = 256  # Queued writes committed together in one transaction
+storage_read_connections = 4  # Reader threads, each with its own connection, per database
+
+storages = {}  # Absolute database path -> StorageActor of this process
+storages_lock = threading.Lock()
+
+
+def get_database_inode(db_path):
+    try:
+        return os.stat(db_path).st_ino
+    except FileNotFoundError:
+        return None
+
+
+class StorageActor:
+    """
+    Owns all access to one sqlite database within this process.
+
+    Writes are queued to one writer thread with a long-lived connection. It
+    commits everything that queued up while the previous transaction ran (up
+    to storage_write_batch_max writes) in one transaction, each write in its
+    own savepoint, so a failing write is rolled back alone. Reads run on a
+    small pool of threads with one long-lived connection each. The caller's
+    thread never touches the disk.
+
+    Writes and reads are functions taking the connection as first argument.
+    A setup function (creating tables) runs once per writer connection before
+    the first write or read that names it.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.prepared = set()  # Setup functions run on the current writer connection
+        self.writer_conn = None
+        self.writer_inode = None
+        self.local = threading.local()
+        self.readers = ThreadPoolExecutor(
+            storage_read_connections, thread_name_prefix=f"storage-read-{os.path.basename(db_path)}"
+        )
+        self.writer = threading.Thread(
+            target=self.run_writer,
+            name=f"storage-write-{os.path.basename(db_path)}",
+            daemon=True,
+        )
+        self.writer.start()
+
+    def connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=storage_busy_timeout,
+            isolation_level=None,  # Transactions are opened explicitly
+            check_same_thread=False,
+        )
+        return conn, get_database_inode(self.db_path)
+
+    def get_writer_connection(self):
+        # A database file replaced or deleted under us is opened anew
+        if self.writer_conn is not None and get_database_inode(self.db_path) != self.writer_inode:
+            logger.info(f"{self.db_path} was replaced, reconnecting.")
+            self.writer_conn.close()
+            self.writer_conn = None
+        if self.writer_conn is None:
+            self.writer_conn, self.writer_inode = self.connect()
+            self.prepared.clear()
+        return self.writer_conn
+
+    def get_read_connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None and get_database_inode(self.db_path) != self.local.inode:
+            conn.close()
+            conn = None
+        if conn is None:
+            conn, self.local.inode = self.connect()
+            self.local.conn = conn
+        return conn
+
+    def run_writer(self):
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < storage_write_batch_max:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = batch[-1] is None
+            writes = [write for write in batch if write is not None]
+            if writes:
+                self.commit_batch(writes)
+            if closing:
+                if self.writer_conn is not None:
+                    self.writer_conn.close()
+                return
+
+    def prepare(self, conn, writes):
+        # Setup runs outside the batch transaction: schema pragmas need that
+        for _, _, setup, future in writes:
+            if setup is None or setup in self.prepared or future.done():
+                continue
+            try:
+                setup(conn)
+                self.prepared.add(setup)
+            except Exception as e:
+                future.set_exception(e)
+        return [write for write in writes if not write[3].done()]
+
+    def commit_batch(self, writes):
+        for attempt in range(storage_write_retries):
+            results = []
+            conn = None
+            try:
+                conn = self.get_writer_connection()
+                pending = self.prepare(conn, writes)
+                conn.execute("BEGIN IMMEDIATE")
+                for func, args, _, future in pending:
+                    conn.execute("SAVEPOINT write")
+                    try:
+                        results.append((future, func(conn, *args), None))
+                        conn.execute("RELEASE write")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO write")
+                        conn.execute("RELEASE write")
+                        results.append((future, None, e))
+                conn.execute("COMMIT")
+                break
+            except sqlite3.Error as e:
+                if conn is not None and conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                if attempt == storage_write_retries - 1:
+                    results = [(write[3], None, e) for write in writes if not write[3].done()]
+                    break
+                logger.warning(f"Retrying write batch on {self.db_path}: {e}")
+                self.prepared.clear()  # The table may have been dropped meanwhile
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def submit(self, func, *args, setup=None):
+        """
+        Queues a write from any thread.
+
+        :param func: Function taking the connection and args, run in a transaction.
+        :return: A concurrent.futures.Future resolved once the write is committed.
+        """
+        future = Future()
+        self.queue.put((func, args, setup, future))
+        return future
+
+    async def write(self, func, *args, setup=None):
+        """
+        :return: The return value of func, once its transaction committed.
+        """
+        return await asyncio.wrap_future(self.submit(func, *args, setup=setup))
+
+    def run_read(self, func, args):
+        conn = self.get_read_connection()
+        return func(conn, *args)
+
+    async def read(self, func, *args, setup=None):
+        """
+        Runs func(connection, *args) on a reader thread.
+
+        :return: The return value of func.
+        """
+        if setup is not None and setup not in self.prepared:
+            await self.write(lambda conn: None, setup=setup)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.readers, self.run_read, func, args)
+
+    def close(self):
+        # Commits what is queued, then closes the writer connection
+        self.queue.put(None)
+        self.writer.join()
+        self.readers.shutdown()
+
+
+def get_storage(db_path):
+    """
+    :return: This process's StorageActor for the database.
+    """
+    key = os.path.abspath(db_path)
+    with storages_lock:
+        storage = storages.get(key)
+        if storage is None or storage.pid != os.getpid():
+            # Threads do not survive a fork, so a child starts its own actor
+            storage = storages[key] = StorageActor(db_path)
+        return storage
+
+
+@atexit.register
+def close_all_storages():
+    with storages_lock:
+        for key, storage in list(storages.items()):
+            if storage.pid == os.getpid():
+                storage.close()
+            del storages[key]
@@ -0,0 +1,91 @@
+import time
+
+
+class TimerWheel:
+    """
+    A hierarchical timing wheel.
+
+    Level 0 has `slots` slots of one tick each, every higher level `slots`
+    slots that each span a whole turn of the level below. A timer goes into
+    the lowest level whose range covers its deadline and moves down a level
+    each time the wheel above turns over its slot, so add and cancel are O(1)
+    and a tick costs O(1) plus the timers it expires or moves, each of which
+    moves at most once per level. With the defaults (1 s ticks, 256 slots,
+    4 levels) deadlines up to 136 years ahead are exact.
+    """
+
+    def __init__(self, tick=1.0, slots=256, levels=4, now=None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.current = self.get_tick(time.time() if now is None else now)
+        self.locations = {}  # key -> (level, slot)
+        self.deadlines = {}  # key -> deadline tick
+
+    def get_tick(self, timestamp):
+        return int(timestamp // self.tick)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, key):
+        return key in self.locations
+
+    def add(self, key, deadline):
+        """
+        Sets the timer of key, replacing any earlier one.
+
+        :param deadline: Timestamp at which the timer expires.
+        """
+        self.cancel(key)
+        self.deadlines[key] = max(self.get_tick(deadline), self.current + 1)
+        self.place(key)
+
+    def place(self, key):
+        deadline = self.deadlines[key]
+        delta = deadline - self.current
+        for level in range(self.levels):
+            if delta < self.slots ** (level + 1) or level == self.levels - 1:
+                slot = (deadline // self.slots**level) % self.slots
+                self.wheels[level][slot][key] = deadline
+                self.locations[key] = (level, slot)
+                return
+
+    def cancel(self, key):
+        location = self.locations.pop(key, None)
+        if location is not None:
+            level, slot = location
+            del self.wheels[level][slot][key]
+            del self.deadlines[key]
+
+    def advance(self, now=None):
+        """
+        Moves the wheel up to now.
+
+        :return: The keys whose deadline passed, oldest tick first.
+        """
+        target = self.get_tick(time.time() if now is None else now)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            # Higher levels first, so their timers can fall all the way down
+            for level in range(self.levels - 1, 0, -1):
+                span = self.slots**level
+                if self.current % span == 0:
+                    slot = (self.current // span) % self.slots
+                    moving = self.wheels[level][slot]
+                    self.wheels[level][slot] = {}
+                    for key in moving:
+                        self.place(key)
+            slot = self.current % self.slots
+            due = self.wheels[0][slot]
+            self.wheels[0][slot] = {}
+            for key, deadline in due.items():
+                if deadline > self.current:
+                    self.place(key)  # Beyond the top level's range, goes round again
+                    continue
+                del self.locations[key]
+                del self.deadlines[key]
+                expired.append(key)
+        return expired
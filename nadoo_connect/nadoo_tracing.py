@@ -0,0 +1,165 @@
+import os
+import json
+import math
+import time
+from datetime import datetime
+
+
+# Lifecycle stages of an execution:
+#   spool   created -> spooled (written to the spool)
+#   pickup  spooled -> batched (picked up by the sender)
+#   smtp    batched -> emailed (batch accepted by the SMTP server)
+#   record  emailed -> recorded (in executions.db, spool file removed)
+#   total   created -> recorded
+# RPCs use the same stages with an "rpc_" prefix, ending when moved to awaiting response.
+histogram_window = 300  # Seconds of samples covered by the rolling histograms
+histogram_min_seconds = 0.001  # Lower bound of the first bucket
+histogram_growth = 1.25  # Each bucket is this much wider than the previous one
+histogram_buckets = 80  # 1ms up to about 14 hours
+percentiles = (0.5, 0.95, 0.99)
+timestamp_format = "%Y-%m-%d %H:%M:%S.%f"
+
+
+class RollingHistogram:
+    """
+    Log-scale latency histogram covering the last one to two windows.
+
+    Samples go into the current window; when it is older than histogram_window
+    it becomes the previous window and a new one starts. Recording is O(1) and
+    memory is fixed, whatever the throughput; percentiles are accurate to one
+    bucket (histogram_growth).
+    """
+
+    def __init__(self, window=None):
+        self.window = window or histogram_window
+        self.current = [0] * histogram_buckets
+        self.previous = [0] * histogram_buckets
+        self.window_started = time.monotonic()
+
+    def rotate(self):
+        now = time.monotonic()
+        if now - self.window_started < self.window:
+            return
+        if now - self.window_started < 2 * self.window:
+            self.previous = self.current
+        else:
+            self.previous = [0] * histogram_buckets  # Idle for a whole window
+        self.current = [0] * histogram_buckets
+        self.window_started = now
+
+    def record(self, seconds):
+        self.rotate()
+        if seconds <= histogram_min_seconds:
+            index = 0
+        else:
+            index = int(math.log(seconds / histogram_min_seconds, histogram_growth)) + 1
+        self.current[min(index, histogram_buckets - 1)] += 1
+
+    def count(self):
+        self.rotate()
+        return sum(self.current) + sum(self.previous)
+
+    def percentile(self, q):
+        # Upper bound of the bucket holding the q-th sample
+        self.rotate()
+        counts = [a + b for a, b in zip(self.current, self.previous)]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return histogram_min_seconds * histogram_growth**index
+        return histogram_min_seconds * histogram_growth ** (histogram_buckets - 1)
+
+
+stage_histograms = {}  # Stage name -> RollingHistogram
+
+
+def record_stage(stage, seconds):
+    histogram = stage_histograms.get(stage)
+    if histogram is None:
+        histogram = stage_histograms[stage] = RollingHistogram()
+    histogram.record(max(0.0, seconds))
+
+
+def get_stage_percentiles():
+    """
+    :return: Stage name -> {"count", "p50", "p95", "p99"}, latencies in seconds.
+    """
+    stats = {}
+    for stage, histogram in stage_histograms.items():
+        entry = {"count": histogram.count()}
+        for q in percentiles:
+            value = histogram.percentile(q)
+            entry[f"p{int(q * 100)}"] = round(value, 4) if value is not None else None
+        stats[stage] = entry
+    return stats
+
+
+def parse_created_time(timestamp):
+    try:
+        return datetime.strptime(timestamp, timestamp_format).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class BatchTrace:
+    """
+    Timestamps of one batch on its way from the spool to the database.
+
+    Only the batch keeps timestamps; per item it keeps the creation and spool
+    times, which the spool already holds (record timestamp and file mtime).
+    """
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.items = []  # (created, spooled) per item, either may be None
+        self.batched_at = None
+        self.emailed_at = None
+
+    def add(self, created=None, spooled=None):
+        self.items.append((created, spooled))
+
+    def mark_batched(self):
+        self.batched_at = time.time()
+        for created, spooled in self.items:
+            if created is not None and spooled is not None:
+                record_stage(f"{self.prefix}spool", spooled - created)
+            if spooled is not None:
+                record_stage(f"{self.prefix}pickup", self.batched_at - spooled)
+
+    def mark_emailed(self):
+        self.emailed_at = time.time()
+        record_stage(f"{self.prefix}smtp", self.emailed_at - self.batched_at)
+
+    def mark_recorded(self):
+        recorded_at = time.time()
+        if self.emailed_at is not None:
+            record_stage(f"{self.prefix}record", recorded_at - self.emailed_at)
+        for created, spooled in self.items:
+            start = created if created is not None else spooled
+            if start is not None:
+                record_stage(f"{self.prefix}total", recorded_at - start)
+
+
+def read_traced_record(filepath):
+    """
+    Loads a spool or staging file along with its spool time (the file mtime).
+
+    :return: (record, created, spooled)
+    """
+    with open(filepath, "r") as file:
+        spooled = os.fstat(file.fileno()).st_mtime
+        record = json.load(file)
+    return record, parse_created_time(record.get("timestamp")), spooled
+
+
+if __name__ == "__main__":
+    # Prints the percentiles the running sender publishes in its heartbeat
+    from .nadoo_leader import read_heartbeat
+
+    heartbeat = read_heartbeat()
+    print(json.dumps((heartbeat or {}).get("latency"), indent=2))
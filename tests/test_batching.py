@@ -0,0 +1,44 @@
+import nadoo_connect.nadoo_batching as nadoo_batching
+from nadoo_connect.nadoo_batching import *
+
+
+def test_batches_grow_under_backlog_within_bounds():
+    controller = BatchController("test", (10, 200))
+    sizes = []
+    for _ in range(10):
+        limits = controller.get_limits(backlog=1000)
+        sizes.append(limits.count)
+        controller.record_send(0.5, True, limits.count, limits.count * 100)
+    assert sizes[:5] == [10, 20, 40, 80, 160]
+    assert max(sizes) == 200
+
+    # Batches that are not full mean there is no backlog to grow for
+    controller = BatchController("test", (10, 200))
+    controller.record_send(0.5, True, 3, 300)
+    assert controller.count == 10
+
+
+def test_slow_or_failing_sends_shrink_batches(monkeypatch):
+    monkeypatch.setattr(nadoo_batching, "target_send_latency", 1)
+    controller = BatchController("test", (10, 200))
+    controller.count = 160
+    controller.record_send(3, True, 160, 16000)
+    assert controller.count == 120
+    controller.record_send(0.1, False, 120, 12000)
+    assert controller.count == 60
+    for _ in range(10):
+        controller.record_send(0.1, False, 10, 1000)
+    assert controller.count == 10
+    # Growth resumes only once failures have become rare
+    controller.record_send(0.1, True, 10, 1000)
+    assert controller.count == 10
+
+
+def test_linger_and_urgent_work():
+    controller = BatchController("test", (10, 200), linger_bounds=(0, 2))
+    controller.count = 100
+    controller.record_send(1.5, True, 50, 5000)
+    assert controller.get_limits(backlog=5).linger == 1.5  # Waits to fill up
+    assert controller.get_limits(backlog=500).linger == 0  # A full batch is ready
+    urgent = controller.get_limits(backlog=500, urgent=True)
+    assert urgent.count == 10 and urgent.linger == 0
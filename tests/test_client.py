@@ -0,0 +1,87 @@
+import glob
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import nadoo_connect.nadoo_client as nadoo_client
+import nadoo_connect.nadoo_spool as nadoo_spool
+from nadoo_connect.nadoo_client import *
+from nadoo_connect.nadoo_spool import iter_spool_files
+
+
+@pytest.fixture
+def spool(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(nadoo_spool, "executions_dir", str(tmp_path / "executions"))
+    monkeypatch.setattr(nadoo_spool, "overflow_dir", str(tmp_path / "overflow"))
+    monkeypatch.setattr(nadoo_spool, "spool_depth_cache_ttl", 0)
+    sender_checks = []
+    monkeypatch.setattr(
+        nadoo_client, "start_sender_loop_if_not_running", lambda: sender_checks.append(1)
+    )
+    return sender_checks
+
+
+def read_spool():
+    records = []
+    for path in iter_spool_files():
+        with open(path) as file:
+            records.append(json.load(file))
+    return records
+
+
+def test_threads_enqueue_and_close_flushes_everything(spool, monkeypatch):
+    monkeypatch.setattr(nadoo_client, "client_flush_batch_size", 100)
+    client = ExecutionClient()
+
+    def produce(n):
+        for _ in range(250):
+            client.create_execution(f"program-{n}")
+
+    threads = [threading.Thread(target=produce, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.close()
+
+    records = read_spool()
+    assert len(records) == 1000
+    assert {record["customer_program_uuid"] for record in records} == {
+        f"program-{n}" for n in range(4)
+    }
+    assert len(spool) <= 20  # One sender check per batch, not per execution
+    with pytest.raises(RuntimeError):
+        client.create_execution("program-0")
+
+
+def test_enqueue_does_not_wait_for_the_spool(spool, monkeypatch):
+    monkeypatch.setattr(nadoo_client, "client_flush_linger", 0.5)
+    monkeypatch.setattr(nadoo_client, "client_flush_batch_size", 5000)
+    client = ExecutionClient()
+    client.create_execution("program")  # Starts the thread
+    client.flush()
+    started = time.perf_counter()
+    for _ in range(1000):
+        client.create_execution("program")
+    per_call = (time.perf_counter() - started) / 1000
+    assert len(read_spool()) == 1  # The rest is still lingering in memory
+    assert per_call < 0.001
+    client.flush()
+    assert len(read_spool()) == 1001
+    client.close()
+
+
+def test_full_spool_spills_instead_of_dropping(spool, monkeypatch):
+    monkeypatch.setattr(nadoo_spool, "spool_max_records", 2)
+    client = ExecutionClient(overflow_policy="reject")
+    for _ in range(5):
+        client.create_execution("program")
+    client.close()
+    assert len(read_spool()) == 2
+    summaries = glob.glob(os.path.join(nadoo_spool.overflow_dir, "*.json"))
+    with open(summaries[0]) as file:
+        assert json.load(file)["execution_count"] == 3
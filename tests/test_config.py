@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+import nadoo_connect.nadoo_config as nadoo_config
+from nadoo_connect.nadoo_config import *
+
+
+@pytest.fixture
+def env_file(tmp_path, monkeypatch):
+    path = tmp_path / ".env"
+    monkeypatch.setattr(nadoo_config, "config_path", str(path))
+    monkeypatch.setattr(nadoo_config, "current_snapshot", None)
+    monkeypatch.setattr(nadoo_config, "applied_values", {})
+    for key in ("SMTP_PORT", "SMTP_SERVER", "NADOO_TEST_VALUE"):
+        monkeypatch.delenv(key, raising=False)
+    yield path
+    for key in nadoo_config.applied_values:
+        os.environ.pop(key, None)
+
+
+def test_snapshot_is_cached_until_env_changes(env_file, monkeypatch):
+    env_file.write_text("SMTP_SERVER=mail.example.com\nSMTP_PORT=587\n")
+    config = get_config_snapshot()
+    assert config["SMTP_PORT"] == 587 and config.get("SMTP_SERVER") == "mail.example.com"
+    assert get_config_snapshot() is config
+    with pytest.raises(TypeError):
+        config["SMTP_PORT"] = 25
+
+    env_file.write_text("SMTP_SERVER=mail.example.com\nSMTP_PORT=2525\n")
+    assert get_config_snapshot() is config  # Not checked again within the interval
+    monkeypatch.setattr(nadoo_config, "next_check", 0.0)
+    assert get_config_snapshot()["SMTP_PORT"] == 2525
+    assert os.environ["SMTP_PORT"] == "2525"  # Changed values reach os.getenv users too
+
+
+def test_environment_wins_and_invalid_values_are_rejected(env_file, monkeypatch):
+    env_file.write_text("SMTP_PORT=587\n")
+    monkeypatch.setenv("SMTP_PORT", "465")
+    config = get_config_snapshot()
+    assert config["SMTP_PORT"] == 465
+
+    env_file.write_text("SMTP_PORT=465\nSMTP_SERVER=x\n")
+    monkeypatch.setenv("SMTP_PORT", "not a port")
+    assert reload_config() is config  # A bad edit keeps the last good snapshot
+    monkeypatch.setattr(nadoo_config, "current_snapshot", None)
+    with pytest.raises(ConfigError):
+        get_config_snapshot()
+
+
+def test_save_missing_config_skips_lines_without_equals(env_file):
+    env_file.write_text("# comment\nBROKEN LINE\n\nNADOO_TEST_VALUE=a")
+    save_missing_config_to_env({"NADOO_TEST_VALUE": "a", "SMTP_SERVER": "x", "EMPTY": None})
+    assert env_file.read_text().endswith("NADOO_TEST_VALUE=a\nSMTP_SERVER=x\n")
+    mtime = os.stat(env_file).st_mtime_ns
+    save_missing_config_to_env({"SMTP_SERVER": "x"})
+    assert os.stat(env_file).st_mtime_ns == mtime  # Nothing to add, not reopened
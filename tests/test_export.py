@@ -0,0 +1,90 @@
+import csv
+import os
+import gzip
+import sqlite3
+
+import pytest
+
+import nadoo_connect.nadoo_export as nadoo_export
+from nadoo_connect.nadoo_connect import setup_execution_records_table
+from nadoo_connect.nadoo_retention import connect_execution_db
+from nadoo_connect.nadoo_export import *
+
+
+def add_executions(db_path, rows):
+    conn = sqlite3.connect(db_path)
+    setup_execution_records_table(conn.cursor())
+    conn.executemany(
+        """INSERT INTO execution_records
+           (execution_uuid, customer_program_uuid, is_sent, timestamp, execution_count)
+           VALUES (?, ?, 1, ?, ?)""",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+
+
+def read_csv(path):
+    with gzip.open(path, "rt", encoding="utf-8", newline="") as file:
+        return list(csv.reader(file))[1:]
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(nadoo_export, "export_chunk_size", 2)  # Several chunks per export
+    return str(tmp_path / "executions.db")
+
+
+def test_export_filters_by_range_and_customer(db_path, tmp_path):
+    add_executions(
+        db_path,
+        [
+            ("a", "c1", "2024-01-31 23:59:59.000000", 1),
+            ("b", "c1", "2024-02-01 08:00:00.000000", 1),
+            ("c", "c2", "2024-02-01 09:00:00.000000", 1),
+            ("d", "c1", "2024-02-02 08:00:00.000000", 5),
+            ("e", "c1", "2024-02-02 08:00:00.000000", 1),
+            ("f", "c3", "2024-02-03 08:00:00.000000", 1),
+            ("g", "c1", "2024-03-01 00:00:00.000000", 1),
+        ],
+    )
+    summary = export_executions(
+        "2024-02-01", "2024-03-01", ["c1", "c2"], output_dir=str(tmp_path / "out"), db_path=db_path
+    )
+    assert summary["rows"] == 4
+    executions, rollups = summary["files"]
+    assert [row[0] for row in read_csv(executions)] == ["b", "c", "d", "e"]
+    assert read_csv(rollups) == [
+        ["2024-02-01", "c1", "1"],
+        ["2024-02-01", "c2", "1"],
+        ["2024-02-02", "c1", "6"],
+    ]
+    assert not [name for name in os.listdir(tmp_path / "out") if name.endswith(".tmp")]
+
+
+def test_incremental_export_continues_from_watermark(db_path, tmp_path):
+    output_dir = str(tmp_path / "out")
+    add_executions(db_path, [(uuid, "c1", "2024-02-01 08:00:00.000000", 1) for uuid in "abc"])
+    first = export_executions(watermark="billing", output_dir=output_dir, db_path=db_path)
+    assert (first["rows"], first["watermark"]) == (3, 3)
+
+    add_executions(db_path, [(uuid, "c1", "2024-01-15 08:00:00.000000", 1) for uuid in "de"])
+    second = export_executions(watermark="billing", output_dir=output_dir, db_path=db_path)
+    assert [row[0] for row in read_csv(second["files"][0])] == ["d", "e"]
+    assert read_csv(second["files"][1]) == [["2024-01-15", "c1", "2"]]
+
+    third = export_executions(watermark="billing", output_dir=output_dir, db_path=db_path)
+    assert (third["rows"], third["watermark"]) == (0, 5)
+
+
+def test_rollups_include_archived_executions(db_path, tmp_path):
+    add_executions(db_path, [("a", "c1", "2024-02-01 08:00:00.000000", 1)])
+    conn = connect_execution_db(db_path)
+    conn.execute("INSERT INTO execution_rollups VALUES ('2024-02-01', 'c1', 10)")
+    conn.execute("INSERT INTO execution_rollups VALUES ('2024-01-01', 'c1', 7)")
+    conn.close()
+    summary = export_executions(start="2024-02-01", output_dir=str(tmp_path), db_path=db_path)
+    assert read_csv(summary["files"][-1]) == [["2024-02-01", "c1", "11"]]
+
+    with pytest.raises(ExportError):
+        export_executions(formats=["xlsx"], db_path=db_path)
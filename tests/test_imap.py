@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+from email.mime.text import MIMEText
+
+import pytest
+
+import nadoo_connect.nadoo_connect as nadoo_connect
+import nadoo_connect.nadoo_imap as nadoo_imap
+import nadoo_connect.nadoo_rpc as nadoo_rpc
+from nadoo_connect.nadoo_email import setup_database
+from nadoo_connect.nadoo_imap import *
+from nadoo_connect.nadoo_rpc import deliver_rpc_replies_from_message
+
+
+class LocalIMAPServer:
+    """IMAP stand-in with just enough of the protocol for watch_mailbox."""
+
+    def __init__(self, idle=True, uidvalidity=1):
+        self.idle = idle
+        self.uidvalidity = uidvalidity
+        self.messages = {}
+        self.next_uid = 1
+        self.fetched = []
+        self.idlers = set()
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def append(self, message):
+        self.messages[self.next_uid] = message
+        self.next_uid += 1
+        for idler in self.idlers:
+            idler.set()
+
+    def search(self, criteria):
+        uids = sorted(self.messages)
+        if criteria.startswith("UID "):
+            first = int(criteria.split()[1].split(":")[0])
+            matched = [uid for uid in uids if uid >= first]
+            return matched or uids[-1:]  # "n:*" always matches the newest message
+        return uids  # SINCE: everything is from today
+
+    async def handle(self, reader, writer):
+        writer.write(b"* OK IMAP4rev1 ready\r\n")
+        while line := await reader.readline():
+            tag, command, *rest = line.decode().rstrip("\r\n").split(" ", 2)
+            command = command.upper()
+            if command == "CAPABILITY":
+                writer.write(b"* CAPABILITY IMAP4rev1" + (b" IDLE" if self.idle else b"") + b"\r\n")
+            elif command == "SELECT":
+                writer.write(f"* {len(self.messages)} EXISTS\r\n".encode())
+                writer.write(f"* OK [UIDVALIDITY {self.uidvalidity}] UIDs valid\r\n".encode())
+                writer.write(f"* OK [UIDNEXT {self.next_uid}] Predicted next UID\r\n".encode())
+            elif command == "UID" and rest[0].startswith("SEARCH"):
+                uids = self.search(rest[0].split(" ", 1)[1])
+                writer.write(("* SEARCH " + " ".join(map(str, uids))).rstrip().encode() + b"\r\n")
+            elif command == "UID" and rest[0].startswith("FETCH"):
+                for uid in map(int, rest[0].split()[1].split(",")):
+                    body = self.messages[uid]
+                    self.fetched.append(uid)
+                    writer.write(f"* {uid} FETCH (UID {uid} BODY[] {{{len(body)}}}\r\n".encode())
+                    writer.write(body + b")\r\n")
+            elif command == "IDLE":
+                new_mail = asyncio.Event()
+                self.idlers.add(new_mail)
+                writer.write(b"+ idling\r\n")
+                await writer.drain()
+                done = asyncio.create_task(reader.readline())
+                waiter = asyncio.create_task(new_mail.wait())
+                await asyncio.wait({done, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                if new_mail.is_set():
+                    writer.write(f"* {len(self.messages)} EXISTS\r\n".encode())
+                    await writer.drain()
+                await done
+                waiter.cancel()
+                self.idlers.discard(new_mail)
+            elif command == "LOGOUT":
+                writer.write(b"* BYE\r\n" + f"{tag} OK LOGOUT\r\n".encode())
+                await writer.drain()
+                break
+            writer.write(f"{tag} OK {command}\r\n".encode())
+            await writer.drain()
+        writer.close()
+
+
+def make_reply(request_uuid, result):
+    return MIMEText(json.dumps({"request_uuid": request_uuid, "result": result})).as_bytes()
+
+
+@pytest.fixture
+def imap_db(tmp_path):
+    db_path = str(tmp_path / "email_account.db")
+    setup_database(email_account_db_name=db_path)
+    return db_path
+
+
+async def start_watch(server, db_path, received, stop):
+    port = await server.start()
+    await save_imap_account(
+        email_account_db_name=db_path,
+        imap_account={
+            "email": "user@example.com",
+            "imap_server": "127.0.0.1",
+            "imap_port": port,
+            "use_ssl": False,
+            "password": "secret",
+        },
+    )
+    account = await get_imap_account_for_email_address(
+        "user@example.com", email_account_db_name=db_path
+    )
+    return asyncio.create_task(
+        watch_mailbox(account, received.append, lambda: stop[0], db_path)
+    )
+
+
+@pytest.mark.asyncio
+async def test_idle_pushes_new_mail_and_resumes_by_uid(imap_db):
+    server = LocalIMAPServer()
+    server.append(b"Subject: old\r\n\r\nbefore\r\n")
+    received = []
+    stop = [False]
+    watch = await start_watch(server, imap_db, received, stop)
+    await asyncio.sleep(0.2)
+    assert len(received) == 1  # Resync picks up today's mail
+
+    server.append(b"Subject: new\r\n\r\npushed\r\n")
+    for _ in range(50):
+        if len(received) == 2:
+            break
+        await asyncio.sleep(0.02)
+    assert received[1].startswith(b"Subject: new")  # Pushed, no poll interval
+
+    stop[0] = True
+    server.append(b"Subject: third\r\n\r\n\r\n")
+    await asyncio.wait_for(watch, 2)
+
+    # A new session continues after the last UID instead of refetching
+    server.fetched.clear()
+    server.append(b"Subject: fourth\r\n\r\n\r\n")
+    account = await get_imap_account_for_email_address(
+        "user@example.com", email_account_db_name=imap_db
+    )
+    await asyncio.wait_for(watch_mailbox(account, received.append, lambda: True, imap_db), 2)
+    await server.stop()
+    assert server.fetched == [4]
+    assert len(received) == 4
+
+
+@pytest.mark.asyncio
+async def test_polling_fallback_without_idle(imap_db, monkeypatch):
+    monkeypatch.setattr(nadoo_imap, "imap_poll_interval", 0.05)
+    server = LocalIMAPServer(idle=False)
+    received = []
+    stop = [False]
+    watch = await start_watch(server, imap_db, received, stop)
+    await asyncio.sleep(0.1)
+    server.append(b"Subject: polled\r\n\r\n\r\n")
+    await asyncio.sleep(0.3)
+    stop[0] = True
+    await asyncio.wait_for(watch, 2)
+    await server.stop()
+    assert received == [b"Subject: polled\r\n\r\n\r\n"]
+
+
+@pytest.mark.asyncio
+async def test_get_xyz_for_xyz_remote_returns_the_reply(tmp_path, monkeypatch):
+    for name in ("staged_dir", "awaiting_response_dir", "done_dir", "inflight_dir"):
+        directory = str(tmp_path / name)
+        os.makedirs(directory)
+        monkeypatch.setattr(nadoo_rpc, name, directory)
+    monkeypatch.setattr(nadoo_connect, "directories_ready", True)
+    monkeypatch.setattr(nadoo_connect, "start_sender_loop_if_not_running", lambda: None)
+
+    call = asyncio.create_task(
+        nadoo_connect.get_xyz_for_xyz_remote("procedure", {"x": 1}, timeout=5)
+    )
+    await asyncio.sleep(0.05)
+    (staged,) = os.listdir(nadoo_rpc.staged_dir)
+    request = json.load(open(os.path.join(nadoo_rpc.staged_dir, staged)))
+    assert request["uuid"] == "procedure" and request["data"] == {"x": 1}
+
+    assert deliver_rpc_replies_from_message(make_reply(request["request_uuid"], 42)) == 1
+    assert await asyncio.wait_for(call, 2) == 42
+    assert await nadoo_connect.get_xyz_for_xyz_remote("procedure", {}, timeout=0.1) is None
@@ -0,0 +1,64 @@
+import asyncio
+import pytest
+
+from nadoo_connect.nadoo_inflight import *
+
+
+@pytest.mark.asyncio
+async def test_batches_run_concurrently_up_to_limit():
+    dispatcher = InflightDispatcher(limit=2)
+    running = []
+    peak = []
+
+    async def send():
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.05)
+        running.pop()
+        return True
+
+    for index in range(4):
+        await dispatcher.submit([f"file-{index}"], send)
+    await dispatcher.drain()
+
+    assert max(peak) == 2
+    assert dispatcher.acked_through == 3
+    assert not dispatcher.claimed
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_releases_keys_without_blocking_others():
+    dispatcher = InflightDispatcher(limit=2)
+    acknowledged = []
+    requeued = []
+
+    async def failing_send():
+        await asyncio.sleep(0.05)
+        return False
+
+    async def succeeding_send():
+        return True
+
+    async def on_success():
+        acknowledged.append("b")
+
+    async def on_failure():
+        requeued.append("a")
+
+    await dispatcher.submit(["a"], failing_send, on_failure=on_failure)
+    await dispatcher.submit(["b"], succeeding_send, on_success=on_success)
+    await asyncio.sleep(0.01)
+    assert acknowledged == ["b"] and dispatcher.is_claimed("a")
+
+    await dispatcher.drain()
+    assert requeued == ["a"] and not dispatcher.is_claimed("a")
+    assert not dispatcher.can_submit()  # Backing off after the failure
+
+
+def test_limit_varies_per_account(monkeypatch):
+    monkeypatch.setitem(max_inflight_batches_per_account, "fast@example.com", 8)
+    assert get_max_inflight_batches_for_email_account({"email": "fast@example.com"}) == 8
+    assert (
+        get_max_inflight_batches_for_email_account({"email": "other@example.com"})
+        == default_max_inflight_batches
+    )
@@ -0,0 +1,52 @@
+import io
+import os
+import time
+import asyncio
+
+import pytest
+
+import nadoo_connect.nadoo_instrumentation as nadoo_instrumentation
+from nadoo_connect.nadoo_instrumentation import *
+
+
+@pytest.mark.asyncio
+async def test_dump_all_task_stacks_lists_tasks():
+    async def stuck_worker():
+        await asyncio.sleep(10)
+
+    task = asyncio.create_task(stuck_worker())
+    await asyncio.sleep(0)
+    output = io.StringIO()
+    dump_all_task_stacks(file=output)
+    task.cancel()
+    assert "stuck_worker" in output.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_loop_lag_monitor_sees_blocking_callback(monkeypatch):
+    monkeypatch.setattr(nadoo_instrumentation, "loop_lag_stats", dict(loop_lag_stats, max=0.0))
+    monitor = asyncio.create_task(loop_lag_monitor(interval=0.01, warn_after=0.05))
+    await asyncio.sleep(0.02)
+    time.sleep(0.1)  # Blocks the loop
+    await asyncio.sleep(0.03)
+    monitor.cancel()
+    assert get_loop_lag_stats()["max"] >= 0.05
+    assert get_loop_lag_stats()["over_warn"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_profile_trigger_writes_collapsed_stacks(tmp_path, monkeypatch):
+    monkeypatch.setattr(nadoo_instrumentation, "diagnostics_dir", str(tmp_path))
+    with open(tmp_path / profile_trigger_name, "w") as file:
+        file.write("0.2 collapsed")
+    open(tmp_path / dump_trigger_name, "w").close()
+
+    await check_triggers()
+
+    names = os.listdir(tmp_path)
+    assert profile_trigger_name not in names and dump_trigger_name not in names
+    profile = [name for name in names if name.endswith(".folded")]
+    assert len(profile) == 1
+    lines = open(tmp_path / profile[0]).read().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any(name.startswith("task-stacks-") for name in names)
@@ -0,0 +1,47 @@
+import os
+import time
+from unittest.mock import patch
+
+import nadoo_connect.nadoo_connect as nadoo_connect
+from nadoo_connect.nadoo_leader import *
+
+
+def test_write_file_exclusive_publishes_complete_file(tmp_path):
+    path = str(tmp_path / "record.json")
+    write_file_exclusive(path, '{"a": 1}')
+    assert os.listdir(tmp_path) == ["record.json"]
+    assert open(path).read() == '{"a": 1}'
+
+
+def test_is_sender_alive_follows_heartbeat(tmp_path):
+    directory = str(tmp_path)
+    assert not is_sender_alive(directory, max_age=0)
+    write_heartbeat(directory=directory)
+    assert is_sender_alive(directory, max_age=0)
+    stale = time.time() - heartbeat_stale_after - 1
+    os.utime(os.path.join(directory, heartbeat_name), (stale, stale))
+    assert not is_sender_alive(directory, max_age=0)
+
+
+def test_only_one_spawn_claim_and_leader(tmp_path):
+    directory = str(tmp_path)
+    assert claim_spawn(directory)
+    assert not claim_spawn(directory)
+    release_spawn_claim(directory)
+    assert claim_spawn(directory)
+
+    lock = try_acquire_leadership(directory)
+    assert lock is not None
+    assert try_acquire_leadership(directory) is None
+    lock.release()
+
+
+def test_producer_does_not_spawn_while_sender_alive(tmp_path, monkeypatch):
+    monkeypatch.setattr(nadoo_connect, "executions_dir", str(tmp_path))
+    monkeypatch.setattr(nadoo_connect, "sender_process", None)
+    write_heartbeat(directory=str(tmp_path))
+    with patch("nadoo_connect.nadoo_connect.is_sender_alive", return_value=True), patch(
+        "nadoo_connect.nadoo_connect.Process"
+    ) as process:
+        nadoo_connect.start_sender_loop_if_not_running()
+    process.assert_not_called()
@@ -0,0 +1,45 @@
+import time
+
+import pytest
+
+import nadoo_connect.nadoo_lifecycle as nadoo_lifecycle
+from nadoo_connect.nadoo_leader import write_heartbeat
+from nadoo_connect.nadoo_lifecycle import *
+
+
+def test_cold_and_warm_start_latencies():
+    lifecycle = SenderLifecycle(spawn_requested_at=time.time() - 0.5)
+    lifecycle.mark_ready()
+    assert lifecycle.state == "active"
+    assert lifecycle.cold_start_latency >= 0.5
+
+    lifecycle.enter_standby()
+    assert lifecycle.as_dict()["state"] == "standby"
+    lifecycle.wake(0.2)
+    stats = lifecycle.as_dict()
+    assert stats["state"] == "active"
+    assert stats["warm_start_count"] == 1
+    assert stats["last_warm_start_latency"] == 0.2
+
+
+def test_standby_timeout(monkeypatch):
+    lifecycle = SenderLifecycle()
+    lifecycle.enter_standby()
+    assert not lifecycle.standby_expired()  # No timeout by default
+    monkeypatch.setattr(nadoo_lifecycle, "standby_timeout", 0)
+    time.sleep(0.01)
+    assert lifecycle.standby_expired()
+    with pytest.raises(ValueError):
+        SenderLifecycle(policy="sleep")
+
+
+def test_lifecycle_stats_come_from_heartbeat(tmp_path):
+    directory = str(tmp_path)
+    assert get_sender_lifecycle_stats(directory) is None
+    lifecycle = SenderLifecycle(spawn_requested_at=time.time())
+    lifecycle.mark_ready()
+    write_heartbeat(directory=directory, **lifecycle.as_dict())
+    stats = get_sender_lifecycle_stats(directory)
+    assert stats["state"] == "active"
+    assert stats["policy"] == "standby"
+    assert stats["cold_start_latency"] is not None
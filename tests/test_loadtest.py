@@ -0,0 +1,58 @@
+import json
+import os
+
+import pytest
+
+import nadoo_connect.nadoo_email as nadoo_email
+from nadoo_connect.nadoo_email import send_email
+from nadoo_connect.nadoo_loadtest import *
+
+
+def make_batch(count):
+    return json.dumps(
+        [
+            {"execution_uuid": str(i), "timestamp": "2024-01-01 10:00:00.000000"}
+            for i in range(count)
+        ]
+    )
+
+
+@pytest.mark.asyncio
+async def test_smtp_sink_receives_send_email(monkeypatch):
+    monkeypatch.setattr(nadoo_email, "smtp_use_tls", False)
+    monkeypatch.delenv("NADOO_SMTP_USE_TLS", raising=False)
+    delivered = DeliveryStats()
+    sink = SmtpSink(delivered)
+    port = await sink.start()
+    try:
+        sent = await send_email(
+            "Batched Executions", make_batch(3), "to@localhost", "127.0.0.1", port,
+            "from@localhost", "secret",
+        )
+    finally:
+        await sink.stop()
+    assert sent
+    assert delivered.messages == 1
+    assert delivered.executions == 3
+    assert len(delivered.latencies) == 3
+
+
+@pytest.mark.asyncio
+async def test_directory_transport_drops_messages(tmp_path, monkeypatch):
+    monkeypatch.setenv("NADOO_EMAIL_TRANSPORT", "directory")
+    monkeypatch.setenv("NADOO_EMAIL_DROP_DIR", str(tmp_path))
+    assert await send_email("Batched Executions", make_batch(2), "to", "host", 0, "from", "pw")
+
+    delivered = DeliveryStats()
+    collect_dropped_messages(str(tmp_path), delivered, set())
+    assert [name.endswith(".eml") for name in os.listdir(tmp_path)] == [True]
+    assert delivered.executions == 2
+
+
+def test_get_percentiles_and_process_usage():
+    assert get_percentiles([]) == {"p50": None, "p95": None, "p99": None}
+    stats = get_percentiles(list(range(1, 101)))
+    assert stats["p50"] == 51 and stats["p99"] == 100
+    usage = get_process_usage(os.getpid())
+    if usage is not None:  # Needs /proc
+        assert usage[0] >= 0 and usage[1] > 0
@@ -0,0 +1,94 @@
+import json
+import os
+
+import pytest
+
+import nadoo_connect.nadoo_connect as nadoo_connect
+import nadoo_connect.nadoo_manifest as nadoo_manifest
+import nadoo_connect.nadoo_retry as nadoo_retry
+from nadoo_connect.nadoo_manifest import *
+
+
+@pytest.fixture
+def manifest_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(nadoo_manifest, "manifest_dir", str(tmp_path / "manifests"))
+    monkeypatch.setattr(nadoo_manifest, "spool_manifests", {})
+    monkeypatch.setattr(nadoo_retry, "retry_dir", str(tmp_path / "retry"))
+    monkeypatch.setattr(nadoo_retry, "retry_queues", {})
+    monkeypatch.setattr(nadoo_connect, "spool_manifest", None)
+    monkeypatch.setattr(nadoo_connect, "reply_observers", [])
+    for name in ("staged_dir", "awaiting_response_dir"):
+        os.makedirs(tmp_path / name)
+        monkeypatch.setattr(nadoo_connect, name, str(tmp_path / name))
+    return tmp_path
+
+
+def test_journal_reloads_only_live_entries(manifest_dirs):
+    manifest = SpoolManifest("test")
+    for n in range(50):
+        manifest.put(f"rpc:{n}", {"state": "awaiting", "sent_at": n})
+    for n in range(48):
+        manifest.remove(f"rpc:{n}")
+    manifest.close()
+    with open(manifest.path, "a") as file:
+        file.write('{"op": "remove", "key": "rpc:48"')  # Torn by a crash
+
+    manifest = SpoolManifest("test")
+    assert get_awaited_rpcs(manifest) == {"48": 48, "49": 49}
+    with open(manifest.path) as file:
+        assert len(file.readlines()) == 2  # Compacted on load
+
+
+@pytest.mark.asyncio
+async def test_restart_completes_emailed_batches_without_resending(manifest_dirs, monkeypatch):
+    recorded = []
+
+    async def record_executions_in_db(rows):
+        recorded.extend(rows)
+
+    monkeypatch.setattr(nadoo_connect, "record_executions_in_db", record_executions_in_db)
+    spool = manifest_dirs / "spool"
+    spool.mkdir()
+    emailed, inflight = str(spool / "a.json"), str(spool / "b.json")
+    for path in (emailed, inflight):
+        open(path, "w").write("{}")
+    staged = manifest_dirs / "staged_dir" / "r1.json"
+    staged.write_text("{}")
+
+    manifest = get_spool_manifest("sender")
+    manifest.put("batch:1", {"lane": "executions", "state": "emailed", "paths": [emailed], "rows": [["a"]]})
+    manifest.put("batch:2", {"lane": "executions", "state": "inflight", "paths": [inflight], "rows": [["b"]]})
+    manifest.put("batch:3", {"lane": "rpc", "state": "emailed", "paths": [str(staged)], "rows": []})
+    track_awaited_rpc(manifest, "answered")
+    manifest.close()
+    monkeypatch.setattr(nadoo_manifest, "spool_manifests", {})
+
+    manifest = await nadoo_connect.open_spool_manifest("sender")
+    assert recorded == [["a"]]
+    assert not os.path.exists(emailed) and os.path.exists(inflight)
+    assert os.listdir(manifest_dirs / "awaiting_response_dir") == ["r1.json"]
+    assert manifest.items("batch:") == []
+    assert list(get_awaited_rpcs(manifest)) == ["r1"]
+
+    # A delivered reply ends the wait in the manifest too
+    for observer in nadoo_connect.reply_observers:
+        observer("r1")
+    assert get_awaited_rpcs(manifest) == {}
+
+
+def test_file_watcher_start_keeps_staged_rpcs(manifest_dirs, monkeypatch):
+    import nadoo_connect.nadoo_file_watcher_processor as processor
+
+    started = []
+    monkeypatch.setattr(processor, "staged_dir", str(manifest_dirs / "staged_dir"))
+    monkeypatch.setattr(processor, "awaiting_response_dir", nadoo_connect.awaiting_response_dir)
+    monkeypatch.setattr(processor, "start_sender_loop_if_not_running", lambda: started.append(1))
+    staged = manifest_dirs / "staged_dir" / "r1.json"
+    staged.write_text(json.dumps({"request_uuid": "r1"}))
+    partial = manifest_dirs / "staged_dir" / ".r2.json.abc.tmp"
+    partial.write_text("{")
+    os.utime(partial, (0, 0))
+
+    processor.resume_rpc_requests()
+    assert staged.exists() and not partial.exists()
+    assert started == [1]
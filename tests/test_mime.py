@@ -0,0 +1,68 @@
+import email
+import json
+from email import policy
+from email.mime.text import MIMEText
+
+import pytest
+
+import nadoo_connect.nadoo_email as nadoo_email
+import nadoo_connect.nadoo_mime as nadoo_mime
+from nadoo_connect.nadoo_email import send_batch_message
+from nadoo_connect.nadoo_loadtest import DeliveryStats, SmtpSink
+from nadoo_connect.nadoo_mime import *
+
+
+def make_records(count):
+    return [
+        {"execution_uuid": str(i), "timestamp": "2024-01-01 10:00:00.000000", "note": "ü" * (i % 7)}
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize("count", [0, 1, 500])
+def test_matches_mimetext_encoding(count, monkeypatch):
+    monkeypatch.setattr(nadoo_mime, "mime_chunk_size", 100)  # Many partial encodes
+    records = make_records(count)
+    message = StreamingBatchMessage("Batched Executions", "from@x", "to@x")
+    for record in records:
+        message.add(record)
+    streamed = b"".join(message.iter_chunks())
+
+    expected = MIMEText(json.dumps(records), _subtype="plain", _charset="utf-8")
+    expected["Subject"] = "Batched Executions"
+    expected["From"] = "from@x"
+    expected["To"] = "to@x"
+    assert streamed == expected.as_bytes(policy=policy.SMTP)
+
+
+def test_large_batches_spill_to_disk(monkeypatch):
+    monkeypatch.setattr(nadoo_mime, "mime_memory_limit", 64 * 1024)
+    message = StreamingBatchMessage("Batched Executions", "from@x", "to@x")
+    for record in make_records(5000):
+        message.add(record)
+        assert len(message.pending) < nadoo_mime.mime_chunk_size
+    message.finish()
+    assert message.buffer._rolled  # Moved from memory to a temporary file
+    parsed = email.message_from_bytes(b"".join(message.iter_chunks()))
+    assert len(json.loads(parsed.get_payload(decode=True))) == 5000
+    message.close()
+
+
+@pytest.mark.asyncio
+async def test_send_batch_message_streams_over_smtp(monkeypatch):
+    monkeypatch.setattr(nadoo_email, "smtp_use_tls", False)
+    monkeypatch.delenv("NADOO_SMTP_USE_TLS", raising=False)
+    monkeypatch.delenv("NADOO_EMAIL_TRANSPORT", raising=False)
+    monkeypatch.setattr(nadoo_mime, "mime_chunk_size", 1024)
+    delivered = DeliveryStats()
+    sink = SmtpSink(delivered)
+    port = await sink.start()
+    message = StreamingBatchMessage("Batched Executions", "from@localhost", "to@localhost")
+    for record in make_records(3000):
+        message.add(record)
+    try:
+        assert await send_batch_message(message, "127.0.0.1", port, "from@localhost", "secret")
+    finally:
+        await sink.stop()
+    assert delivered.messages == 1
+    assert delivered.executions == 3000
@@ -105,15 +105,10 @@ async def test_create_execution():
     await create_execution("program_uuid")
 
     # Test
-    files = os.listdir(executions_dir)
+    files = list(iter_spool_files(executions_dir))
     assert len(files) > 0, "No files found in executions_dir"
 
-    for filename in files:
-        # Skip the lock file
-        if filename == "sender.lock":
-            continue
-
-        file_path = os.path.join(executions_dir, filename)
+    for file_path in files:
         with open(file_path, "r") as file:
             file_content = file.read()
             assert file_content, f"File {file_path} is empty"
@@ -0,0 +1,95 @@
+import json
+import os
+import time
+from email.mime.text import MIMEText
+
+import pytest
+
+import nadoo_connect.nadoo_connect as nadoo_connect
+import nadoo_connect.nadoo_parts as nadoo_parts
+from nadoo_connect.nadoo_parts import *
+from nadoo_connect.nadoo_rpc import parse_rpc_replies
+
+
+@pytest.fixture
+def parts_dirs(tmp_path, monkeypatch):
+    for name in ("parts_outbox_dir", "parts_inbox_dir", "parts_resend_dir"):
+        monkeypatch.setattr(nadoo_parts, name, str(tmp_path / name))
+    monkeypatch.setattr(nadoo_parts, "message_part_size", 1000)
+
+
+def test_parts_reassemble_in_any_order(parts_dirs):
+    payload = os.urandom(3500)
+    parts = split_into_parts(payload, "m1")
+    assert [part["part"]["count"] for part in parts] == [4] * 4
+
+    corrupt = dict(parts[0], data=parts[1]["data"])
+    assert add_received_part(corrupt) is None
+    assert add_received_part(parts[3]) is None
+    assert add_received_part(parts[1]) is None
+    assert add_received_part(parts[1]) is None  # Duplicates are harmless
+    assert add_received_part(parts[2]) is None
+    assert add_received_part(parts[0]) == payload
+    assert os.listdir(nadoo_parts.parts_inbox_dir) == []
+
+
+@pytest.mark.asyncio
+async def test_only_missing_parts_are_requested_and_resent(parts_dirs):
+    parts = split_into_parts(os.urandom(5000), "m2")
+    save_sent_parts(parts)
+    for part in parts[:2] + parts[3:]:
+        add_received_part(part)
+    assert expire_incomplete_sets() == []  # Not stalled yet
+
+    later = time.time() + nadoo_parts.part_assembly_timeout + 1
+    (request,) = expire_incomplete_sets(now=later)
+    assert request == {"resend_parts": {"message_id": "m2", "missing": [2]}}
+
+    # The request travels back to the sender, which resends just that part
+    queue_resend_request(json.loads(json.dumps(request)))
+    sent = []
+
+    async def send_part(part):
+        sent.append(part)
+        return True
+
+    assert await resend_requested_parts(send_part) == 1
+    assert sent == [parts[2]]
+    assert add_received_part(sent[0]) is not None
+
+    # A set that stays incomplete is given up after part_resend_attempts
+    add_received_part(parts[0])
+    for _ in range(nadoo_parts.part_resend_attempts):
+        later += nadoo_parts.part_assembly_timeout + 1
+        assert len(expire_incomplete_sets(now=later)) == 1
+    assert expire_incomplete_sets(now=later + nadoo_parts.part_assembly_timeout + 1) == []
+    assert os.listdir(nadoo_parts.parts_inbox_dir) == []
+
+
+@pytest.mark.asyncio
+async def test_large_rpc_request_is_sent_in_parts(parts_dirs, tmp_path, monkeypatch):
+    for name in ("staged_dir", "awaiting_response_dir"):
+        os.makedirs(tmp_path / name)
+        monkeypatch.setattr(nadoo_connect, name, str(tmp_path / name))
+    monkeypatch.setattr(nadoo_connect, "message_part_size", 1000)
+    emails = []
+
+    async def send_rpc_email(subject, content):
+        emails.append((subject, content))
+        return True
+
+    monkeypatch.setattr(nadoo_connect, "send_rpc_email", send_rpc_email)
+    request = {"request_uuid": "r1", "procedure_uuid": "p", "data": "x" * 2500}
+    with open(tmp_path / "staged_dir" / "r1.json", "w") as file:
+        json.dump(request, file)
+
+    assert await nadoo_connect.process_rpc_requests()
+    assert sorted(subject for subject, _ in emails) == [f"RPC Request Part {n}/3" for n in (1, 2, 3)]
+    assert os.listdir(tmp_path / "awaiting_response_dir") == ["r1.json"]
+
+    # The receiving side gets the request back as one batch; replies use the same path
+    replies = []
+    for _, content in emails:
+        msg = MIMEText(json.dumps(content), "plain", "utf-8")
+        replies += parse_rpc_replies(msg.as_bytes())
+    assert [reply["data"] for reply in replies] == ["x" * 2500]
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import sqlite3
+
+import pytest
+
+import nadoo_connect.nadoo_pop3 as nadoo_pop3
+from nadoo_connect.nadoo_email import get_emails_for_email_address, setup_database
+from nadoo_connect.nadoo_pop3 import *
+
+
+class LocalPOP3Server:
+    """POP3 stand-in with a mutable mailbox of {uidl: bytes}."""
+
+    def __init__(self, mailbox, pipelining=True):
+        self.mailbox = mailbox
+        self.pipelining = pipelining
+        self.retrieved = []
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        messages = list(self.mailbox.items())  # Numbered for this session
+        writer.write(b"+OK ready\r\n")
+        while line := await reader.readline():
+            command, *args = line.decode().split()
+            command = command.upper()
+            if command == "CAPA":
+                writer.write(b"+OK\r\nUIDL\r\n")
+                if self.pipelining:
+                    writer.write(b"PIPELINING\r\n")
+                writer.write(b".\r\n")
+            elif command in ("USER", "PASS"):
+                writer.write(b"+OK\r\n")
+            elif command == "UIDL":
+                writer.write(b"+OK\r\n")
+                for number, (unique_id, _) in enumerate(messages, 1):
+                    writer.write(f"{number} {unique_id}\r\n".encode())
+                writer.write(b".\r\n")
+            elif command == "RETR":
+                unique_id, body = messages[int(args[0]) - 1]
+                self.retrieved.append(unique_id)
+                writer.write(b"+OK\r\n")
+                for body_line in body.split(b"\r\n"):
+                    if body_line.startswith(b"."):
+                        body_line = b"." + body_line
+                    writer.write(body_line + b"\r\n")
+                writer.write(b".\r\n")
+            elif command == "QUIT":
+                writer.write(b"+OK bye\r\n")
+                await writer.drain()
+                break
+            else:
+                writer.write(b"-ERR unknown\r\n")
+            await writer.drain()
+        writer.close()
+
+
+def make_message(subject, body_lines=1):
+    body = "\r\n".join(f"line {i}" for i in range(body_lines))
+    return f"Subject: {subject}\r\n\r\n{body}\r\n.starts with a dot".encode()
+
+
+@pytest.fixture
+def pop3_account(tmp_path, monkeypatch):
+    monkeypatch.setattr(nadoo_pop3, "pop3_use_ssl", False)
+    monkeypatch.setattr(nadoo_pop3, "inbox_dir", str(tmp_path / "inbox"))
+    db_path = str(tmp_path / "email_account.db")
+    setup_database(email_account_db_name=db_path)
+    return db_path
+
+
+def save_account(db_path, port):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO email_accounts VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ("user@example.com", "127.0.0.1", port, None, None, "secret", 0),
+        )
+
+
+@pytest.mark.asyncio
+async def test_sync_downloads_only_new_messages(pop3_account):
+    mailbox = {"uid-1": make_message("one"), "uid-2": make_message("two")}
+    server = LocalPOP3Server(mailbox)
+    port = await server.start()
+    save_account(pop3_account, port)
+    try:
+        paths = await get_emails_for_email_address(
+            "user@example.com", email_account_db_name=pop3_account
+        )
+        assert len(paths) == 2
+        with open(paths[1], "rb") as file:
+            content = file.read()
+        assert content == make_message("two") + b"\r\n"  # Dot-stuffing undone
+
+        assert await get_emails_for_email_address(
+            "user@example.com", email_account_db_name=pop3_account
+        ) == []
+
+        del mailbox["uid-1"]
+        mailbox["uid-3"] = make_message("three")
+        paths = await get_emails_for_email_address(
+            "user@example.com", email_account_db_name=pop3_account
+        )
+    finally:
+        await server.stop()
+
+    assert len(paths) == 1
+    assert server.retrieved == ["uid-1", "uid-2", "uid-3"]
+    with sqlite3.connect(pop3_account) as conn:
+        uidls = {row[0] for row in conn.execute("SELECT uidl FROM pop3_uidl")}
+    assert uidls == {"uid-2", "uid-3"}  # uid-1 left the server
+
+
+@pytest.mark.asyncio
+async def test_pipelined_retrieval_streams_large_messages(pop3_account, tmp_path):
+    mailbox = {f"uid-{i}": make_message(str(i), body_lines=2000) for i in range(40)}
+    server = LocalPOP3Server(mailbox)
+    port = await server.start()
+    try:
+        async with AsyncPOP3Client("127.0.0.1", port, use_ssl=False) as client:
+            assert "PIPELINING" in await client.capabilities()
+            listing = await client.uidl()
+            paths = await client.retrieve_many(
+                [(number, str(tmp_path / f"{number}.eml")) for number, _ in listing],
+                pipelining=True,
+                window=8,
+            )
+    finally:
+        await server.stop()
+    assert len(paths) == 40
+    assert all(os.path.getsize(path) > 10000 for path in paths)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+
+
+@pytest.mark.asyncio
+async def test_unreachable_server_returns_no_emails(pop3_account):
+    save_account(pop3_account, 1)  # Nothing listens on port 1
+    assert await get_emails_for_email_address(
+        "user@example.com", email_account_db_name=pop3_account
+    ) == []
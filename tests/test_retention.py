@@ -0,0 +1,180 @@
+import os
+import gzip
+import json
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from nadoo_connect.nadoo_connect import setup_execution_records_table
+from nadoo_connect.nadoo_retention import *
+
+
+def create_execution_db(db_path, timestamps):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    setup_execution_records_table(cursor)
+    for index, timestamp in enumerate(timestamps):
+        cursor.execute(
+            """INSERT INTO execution_records
+               (execution_uuid, customer_program_uuid, is_sent, timestamp)
+               VALUES (?, ?, ?, ?)""",
+            (f"uuid-{index}", "program_uuid", True, timestamp),
+        )
+    conn.commit()
+    conn.close()
+
+
+def read_archive(path):
+    with gzip.open(path, "rt", encoding="utf-8") as archive_file:
+        return [json.loads(line) for line in archive_file]
+
+
+def test_archive_old_execution_records(tmp_path):
+    db_path = str(tmp_path / "executions.db")
+    archive_root = str(tmp_path / "archive")
+    old = (datetime.now() - timedelta(days=100)).strftime(timestamp_format)
+    new = datetime.now().strftime(timestamp_format)
+    create_execution_db(db_path, [old, old, new])
+
+    moved = archive_old_execution_records(db_path, archive_root, retention_days=90)
+
+    assert moved == 2
+    conn = sqlite3.connect(db_path)
+    remaining = conn.execute("SELECT timestamp FROM execution_records").fetchall()
+    rollups = conn.execute("SELECT * FROM execution_rollups").fetchall()
+    conn.close()
+    assert remaining == [(new,)]
+    assert rollups == [(old[:10], "program_uuid", 2)]
+
+    archive_path = get_archive_partition_path(archive_root, "executions", old)
+    records = read_archive(archive_path)
+    assert [record["execution_uuid"] for record in records] == ["uuid-0", "uuid-1"]
+
+
+def test_compact_rpc_done(tmp_path):
+    done = tmp_path / "rpc_done"
+    done.mkdir()
+    archive_root = str(tmp_path / "archive")
+    for index in range(3):
+        (done / f"request-{index}.json").write_text(json.dumps({"index": index}))
+    old_time = time.time() - 30 * 86400
+    os.utime(done / "request-0.json", (old_time, old_time))
+
+    compacted = compact_rpc_done(str(done), archive_root, retention_days=7, max_files=1)
+
+    # request-0 is too old, request-1 is the oldest file beyond max_files
+    assert compacted == 2
+    assert os.listdir(done) == ["request-2.json"]
+    segments = os.listdir(os.path.join(archive_root, "rpc_done"))
+    records = read_archive(os.path.join(archive_root, "rpc_done", segments[0]))
+    assert [record["content"]["index"] for record in records] == [0, 1]
+
+
+def test_legacy_schema_migration_stamps_rows_with_migration_time(tmp_path):
+    db_path = str(tmp_path / "executions.db")
+    archive_root = str(tmp_path / "archive")
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        """CREATE TABLE execution_records
+           (execution_uuid TEXT, customer_program_uuid TEXT, is_sent BOOLEAN)"""
+    )
+    conn.execute("INSERT INTO execution_records VALUES ('legacy', 'program_uuid', 1)")
+    setup_execution_records_table(conn.cursor())
+    conn.commit()
+    (timestamp,) = conn.execute("SELECT timestamp FROM execution_records").fetchone()
+    conn.close()
+
+    assert timestamp.startswith(datetime.now().strftime("%Y-%m-%d"))
+    # Legacy rows age out normally instead of being archived on the first pass
+    assert archive_old_execution_records(db_path, archive_root, retention_days=90) == 0
+
+
+def test_enforce_execution_db_size_limit_keeps_recent_rows(tmp_path):
+    db_path = str(tmp_path / "executions.db")
+    archive_root = str(tmp_path / "archive")
+    old = (datetime.now() - timedelta(days=30)).strftime(timestamp_format)
+    new = datetime.now().strftime(timestamp_format)
+    create_execution_db(db_path, [old] * 500 + [new] * 5)
+
+    moved = enforce_execution_db_size_limit(
+        db_path, archive_root, size_limit=1, min_age_days=7
+    )
+
+    assert moved == 500
+    conn = sqlite3.connect(db_path)
+    (remaining,) = conn.execute("SELECT COUNT(*) FROM execution_records").fetchone()
+    conn.close()
+    assert remaining == 5
+
+
+def test_concurrent_passes_do_not_double_count(tmp_path, monkeypatch):
+    import threading
+    import nadoo_connect.nadoo_retention as retention
+
+    monkeypatch.setattr(retention, "retention_chunk_size", 50)
+    db_path = str(tmp_path / "executions.db")
+    archive_root = str(tmp_path / "archive")
+    old = (datetime.now() - timedelta(days=100)).strftime(timestamp_format)
+    create_execution_db(db_path, [old] * 1000)
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                archive_old_execution_records(db_path, archive_root, retention_days=90)
+            )
+        )
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(results) == 1000
+    conn = sqlite3.connect(db_path)
+    (total,) = conn.execute("SELECT SUM(execution_count) FROM execution_rollups").fetchone()
+    conn.close()
+    assert total == 1000
+
+
+def test_purge_expired_archives(tmp_path):
+    archive_root = tmp_path / "archive"
+    (archive_root / "rpc_done").mkdir(parents=True)
+    expired = archive_root / "rpc_done" / "old.jsonl.gz"
+    kept = archive_root / "rpc_done" / "new.jsonl.gz"
+    expired.write_bytes(b"")
+    kept.write_bytes(b"")
+    old_time = time.time() - 400 * 86400
+    os.utime(expired, (old_time, old_time))
+
+    assert purge_expired_archives(str(archive_root), retention_days=365) == 1
+    assert not expired.exists() and kept.exists()
+
+
+def test_size_limit_vacuum_shrinks_file(tmp_path):
+    db_path = str(tmp_path / "executions.db")
+    archive_root = str(tmp_path / "archive")
+    old = (datetime.now() - timedelta(days=30)).strftime(timestamp_format)
+    create_execution_db(db_path, [old] * 20000)
+    size_before = os.path.getsize(db_path)
+
+    moved = enforce_execution_db_size_limit(
+        db_path, archive_root, size_limit=size_before // 2, min_age_days=7
+    )
+
+    # Only enough rows to get under the limit are archived, and the file shrinks
+    assert 0 < moved < 20000
+    assert os.path.getsize(db_path) < size_before * 0.75
+
+
+def test_retention_pass_runs_once_per_interval(tmp_path, monkeypatch):
+    import nadoo_connect.nadoo_retention as retention
+
+    monkeypatch.setattr(retention, "execution_db_path", str(tmp_path / "executions.db"))
+    monkeypatch.setattr(retention, "done_dir", str(tmp_path / "rpc_done"))
+    monkeypatch.setattr(retention, "archive_dir", str(tmp_path / "archive"))
+
+    assert run_retention_pass() is not None
+    assert run_retention_pass() is None
+    assert run_retention_pass(force=True) is not None
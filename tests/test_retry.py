@@ -0,0 +1,97 @@
+import email
+import json
+import os
+
+import pytest
+
+import nadoo_connect.nadoo_connect as nadoo_connect
+import nadoo_connect.nadoo_retry as nadoo_retry
+from nadoo_connect.nadoo_mime import StreamingBatchMessage
+from nadoo_connect.nadoo_retry import *
+
+
+@pytest.fixture
+def retry_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(nadoo_retry, "retry_dir", str(tmp_path / "retry"))
+    monkeypatch.setattr(nadoo_retry, "dead_letter_dir", str(tmp_path / "dead"))
+    monkeypatch.setattr(nadoo_retry, "retry_queues", {})
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    paths = []
+    for n in range(3):
+        path = spool / f"{n}.json"
+        path.write_text(json.dumps({"execution_uuid": str(n), "customer_program_uuid": "p"}))
+        paths.append(str(path))
+    return paths
+
+
+def make_message(paths):
+    message = StreamingBatchMessage("Batched Executions", "from@x", "to@x")
+    for path in paths:
+        message.add(json.load(open(path)))
+    return message.finish()
+
+
+def test_backoff_grows_with_jitter_up_to_the_cap():
+    for attempts in (1, 2, 3):
+        base = nadoo_retry.retry_base_delay * 2 ** (attempts - 1)
+        delays = [get_retry_delay(attempts) for _ in range(50)]
+        assert all(base / 2 <= delay <= base for delay in delays)
+        assert len(set(delays)) > 1
+    assert get_retry_delay(100) <= nadoo_retry.retry_max_delay
+
+
+def test_queue_survives_restart_and_dead_letters(retry_dirs):
+    message = make_message(retry_dirs)
+    encoded = b"".join(message.iter_chunks())
+    entry = RetryQueue("executions").add(retry_dirs, [("0", "p", True, "t", 1)], message)
+    assert entry["next_attempt_at"] > entry["first_failed_at"]
+
+    retries = RetryQueue("executions")  # As after a restart
+    assert retries.is_held(retry_dirs[0]) and len(retries) == 1
+    assert retries.next_due() is None
+    assert retries.next_due(now=entry["next_attempt_at"] + 1)["batch_id"] == entry["batch_id"]
+    stored = retries.open_message(entry)
+    assert b"".join(stored.iter_chunks()) == encoded  # Not encoded again
+    stored.close()
+
+    for _ in range(nadoo_retry.retry_max_attempts - 1):
+        retries.record_failure(entry)
+    assert len(retries) == 0 and not retries.is_held(retry_dirs[0])
+    records = os.path.join(nadoo_retry.dead_letter_dir, "executions", entry["batch_id"], "records")
+    assert sorted(os.listdir(records)) == ["0.json", "1.json", "2.json"]
+    assert not any(os.path.exists(path) for path in retry_dirs)
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_is_retried_from_its_encoded_message(retry_dirs, monkeypatch):
+    recorded = []
+    sent = []
+
+    async def record_executions_in_db(rows):
+        recorded.extend(rows)
+
+    async def get_account():
+        return {"email": "from@x"}
+
+    async def failing_send(message, account):
+        return False
+
+    monkeypatch.setattr(nadoo_connect, "record_executions_in_db", record_executions_in_db)
+    monkeypatch.setattr(nadoo_connect, "get_cached_default_email_account", get_account)
+    monkeypatch.setattr(nadoo_connect, "send_execution_batch", failing_send)
+
+    assert not await nadoo_connect.process_execution_requests(retry_dirs)
+    retries = get_retry_queue("executions")
+    entry = retries.next_due(now=float("inf"))
+    assert all(retries.is_held(path) for path in retry_dirs)
+
+    async def send_message(message):
+        sent.append(b"".join(message.iter_chunks()))
+        return True
+
+    assert await nadoo_connect.retry_batch(retries, entry, send_message)
+    records = json.loads(email.message_from_bytes(sent[0]).get_payload(decode=True))
+    assert records[2] == {"execution_uuid": "2", "customer_program_uuid": "p"}
+    assert [row[0] for row in recorded] == ["0", "1", "2"]
+    assert len(retries) == 0 and not any(os.path.exists(path) for path in retry_dirs)
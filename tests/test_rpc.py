@@ -0,0 +1,58 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+import nadoo_connect.nadoo_connect as nadoo_connect
+import nadoo_connect.nadoo_rpc as nadoo_rpc
+from nadoo_connect.nadoo_rpc import *
+
+
+@pytest.fixture
+def rpc_dirs(tmp_path, monkeypatch):
+    for name in ("staged_dir", "awaiting_response_dir", "done_dir", "inflight_dir"):
+        directory = str(tmp_path / name)
+        os.makedirs(directory)
+        monkeypatch.setattr(nadoo_rpc, name, directory)
+    monkeypatch.setattr(nadoo_connect, "directories_ready", True)
+    monkeypatch.setattr(nadoo_connect, "start_sender_loop_if_not_running", lambda: None)
+
+
+def test_identical_requests_join_across_processes(rpc_dirs):
+    request_uuid, marker = stage_or_join_rpc_request("p", {"a": 1, "b": 2})
+    assert marker is not None
+    # Another process sees the marker and joins instead of staging
+    assert stage_or_join_rpc_request("p", {"b": 2, "a": 1}) == (request_uuid, None)
+    other_uuid, other_marker = stage_or_join_rpc_request("p", {"a": 2})
+    assert other_marker is not None and other_uuid != request_uuid
+    assert len(os.listdir(nadoo_rpc.staged_dir)) == 2
+
+    release_inflight_request(marker, request_uuid)
+    assert stage_or_join_rpc_request("p", {"a": 1, "b": 2})[0] != request_uuid
+
+
+def test_stale_marker_is_taken_over(rpc_dirs):
+    request_uuid, marker = stage_or_join_rpc_request("p", {})
+    old = time.time() - nadoo_rpc.inflight_stale_after - 1
+    os.utime(marker, (old, old))
+    new_uuid, new_marker = stage_or_join_rpc_request("p", {})
+    assert new_uuid != request_uuid and new_marker == marker
+    release_inflight_request(marker, request_uuid)  # Not ours any more
+    assert os.path.exists(marker)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_calls_share_one_request(rpc_dirs):
+    calls = [
+        asyncio.create_task(nadoo_connect.get_xyz_for_xyz_remote("p", {"x": 1}, timeout=5))
+        for _ in range(5)
+    ]
+    await asyncio.sleep(0.05)
+    (staged,) = os.listdir(nadoo_rpc.staged_dir)
+    request_uuid = json.load(open(os.path.join(nadoo_rpc.staged_dir, staged)))["request_uuid"]
+
+    deliver_rpc_reply({"request_uuid": request_uuid, "result": "shared"})
+    assert await asyncio.wait_for(asyncio.gather(*calls), 2) == ["shared"] * 5
+    assert os.listdir(nadoo_rpc.inflight_dir) == []
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+import pytest
+
+import nadoo_connect.nadoo_rpc_cache as nadoo_rpc_cache
+from nadoo_connect.nadoo_rpc_cache import *
+
+
+def make_fetch(results):
+    calls = []
+
+    async def fetch():
+        calls.append(time.time())
+        return results[min(len(calls), len(results)) - 1]
+
+    return fetch, calls
+
+
+def test_cache_key_ignores_key_order():
+    assert get_rpc_cache_key("p", {"a": 1, "b": [1, 2]}) == get_rpc_cache_key("p", {"b": [1, 2], "a": 1})
+    assert get_rpc_cache_key("p", {"a": 1}) != get_rpc_cache_key("q", {"a": 1})
+
+
+@pytest.mark.asyncio
+async def test_fresh_results_survive_a_restart(tmp_path):
+    db_path = str(tmp_path / "rpc_cache.db")
+    fetch, calls = make_fetch(["first", "second"])
+    cache = RPCResultCache(db_path)
+    assert await cache.call("p", {"x": 1}, 60, fetch) == "first"
+    assert await cache.call("p", {"x": 1}, 60, fetch) == "first"
+    assert len(calls) == 1
+
+    restarted = RPCResultCache(db_path)
+    assert await restarted.call("p", {"x": 1}, 60, fetch) == "first"
+    assert len(calls) == 1
+    assert await restarted.call("p", {"x": 2}, 60, fetch) == "second"
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate(tmp_path, monkeypatch):
+    monkeypatch.setattr(nadoo_rpc_cache, "rpc_stale_while_revalidate", 60)
+    fetch, calls = make_fetch(["old", "new"])
+    cache = RPCResultCache(str(tmp_path / "rpc_cache.db"))
+    assert await cache.call("p", {}, 0.05, fetch) == "old"
+    await asyncio.sleep(0.1)
+
+    assert await cache.call("p", {}, 0.05, fetch) == "old"  # Served at once
+    assert await cache.call("p", {}, 0.05, fetch) == "old"  # One refresh only
+    await asyncio.sleep(0.05)
+    assert len(calls) == 2
+    assert await cache.call("p", {}, 60, fetch) == "new"
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction_and_no_caching_of_missing_replies():
+    fetch, calls = make_fetch([None, "a", "b", "c"])
+    cache = RPCResultCache(max_entries=2, persistent=False)
+    assert await cache.call("p", {"n": 0}, 60, fetch) is None
+    assert len(cache.entries) == 0
+    for n in (1, 2, 3):
+        await cache.call("p", {"n": n}, 60, fetch)
+    assert list(cache.entries) == [get_rpc_cache_key("p", {"n": 2}), get_rpc_cache_key("p", {"n": 3})]
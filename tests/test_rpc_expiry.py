@@ -0,0 +1,77 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+import nadoo_connect.nadoo_manifest as nadoo_manifest
+import nadoo_connect.nadoo_rpc as nadoo_rpc
+import nadoo_connect.nadoo_rpc_expiry as nadoo_rpc_expiry
+from nadoo_connect.nadoo_manifest import SpoolManifest, get_awaited_rpcs
+from nadoo_connect.nadoo_rpc import wait_for_rpc_reply
+from nadoo_connect.nadoo_rpc_expiry import *
+
+
+@pytest.fixture
+def rpc_dirs(tmp_path, monkeypatch):
+    for name in ("staged_dir", "awaiting_response_dir", "done_dir", "failed_dir"):
+        directory = str(tmp_path / name)
+        os.makedirs(directory)
+        monkeypatch.setattr(nadoo_rpc, name, directory)
+    monkeypatch.setattr(nadoo_manifest, "manifest_dir", str(tmp_path / "manifests"))
+    monkeypatch.setattr(nadoo_rpc_expiry, "rpc_response_deadline", 60)
+    return tmp_path
+
+
+def await_request(tmp_path, request_uuid):
+    (tmp_path / "awaiting_response_dir" / f"{request_uuid}.json").write_text("{}")
+
+
+@pytest.mark.asyncio
+async def test_unanswered_request_fails_and_its_waiter_gives_up(rpc_dirs):
+    deadlines = RPCDeadlines(now=1000)
+    for request_uuid in ("a", "b"):
+        await_request(rpc_dirs, request_uuid)
+        deadlines.track(request_uuid, sent_at=1000)
+    deadlines.answered("b")
+    assert deadlines.expire(now=1059) == ([], [])
+
+    waiter = asyncio.create_task(wait_for_rpc_reply("a", timeout=30))
+    await asyncio.sleep(0.05)
+    assert deadlines.expire(now=1060) == ([], ["a"])
+    assert os.listdir(rpc_dirs / "failed_dir") == ["a.json"]
+    started = time.monotonic()
+    assert await asyncio.wait_for(waiter, 5) is None
+    assert time.monotonic() - started < 5  # Not held until its own timeout
+
+
+def test_unanswered_request_is_staged_again(rpc_dirs, monkeypatch):
+    monkeypatch.setattr(nadoo_rpc_expiry, "rpc_resend_attempts", 1)
+    deadlines = RPCDeadlines(now=1000)
+    await_request(rpc_dirs, "a")
+    deadlines.track("a", sent_at=1000)
+    assert deadlines.expire(now=1060) == (["a"], [])
+    assert os.listdir(rpc_dirs / "staged_dir") == ["a.json"]
+
+    # The sender sends it again and tracks it anew; the next expiry fails it
+    os.rename(rpc_dirs / "staged_dir" / "a.json", rpc_dirs / "awaiting_response_dir" / "a.json")
+    deadlines.track("a", sent_at=1100)
+    assert deadlines.expire(now=1160) == ([], ["a"])
+
+
+def test_deadlines_reload_from_manifest_and_directory(rpc_dirs):
+    manifest = SpoolManifest("sender")
+    deadlines = RPCDeadlines(manifest, now=1000)
+    await_request(rpc_dirs, "a")
+    deadlines.track("a", sent_at=1000)
+    await_request(rpc_dirs, "old")  # Sent before deadlines were journaled
+    os.utime(rpc_dirs / "awaiting_response_dir" / "old.json", (900, 900))
+    manifest.close()
+
+    manifest = SpoolManifest("sender")
+    deadlines = RPCDeadlines(manifest, now=1000)
+    assert deadlines.load() == 2
+    assert deadlines.expire(now=960) == ([], [])
+    assert deadlines.expire(now=1059) == ([], ["old"])
+    assert deadlines.expire(now=1060) == ([], ["a"])
+    assert get_awaited_rpcs(manifest) == {}
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import math
+import time
+from email.mime.text import MIMEText
+
+import pytest
+
+import nadoo_connect.nadoo_rpc_server as nadoo_rpc_server
+from nadoo_connect.nadoo_rpc import parse_rpc_replies
+from nadoo_connect.nadoo_rpc_server import *
+
+
+def request(procedure, data, n=0):
+    return {"request_uuid": f"r{n}", "uuid": procedure, "data": data}
+
+
+@pytest.mark.asyncio
+async def test_handlers_limits_and_errors():
+    server = RPCServer(None)
+    running = []
+    peak = []
+
+    @server.procedure("slow", concurrency=2)
+    async def slow(data):
+        running.append(data)
+        peak.append(len(running))
+        await asyncio.sleep(0.05)
+        running.remove(data)
+        return data * 2
+
+    server.register("blocking", lambda data: data.upper())
+    server.register("stuck", lambda data: time.sleep(0.5), timeout=0.05)
+    server.register("broken", lambda data: 1 / 0)
+
+    replies = await asyncio.gather(*(server.call(request("slow", n, n)) for n in range(6)))
+    assert [reply["result"] for reply in replies] == [0, 2, 4, 6, 8, 10]
+    assert max(peak) == 2
+    assert (await server.call(request("blocking", "a")))["result"] == "A"
+    assert (await server.call(request("stuck", None)))["error"] == "Timed out"
+    assert "ZeroDivisionError" in (await server.call(request("broken", None)))["error"]
+    assert "Unknown procedure" in (await server.call(request("missing", None)))["error"]
+
+
+@pytest.mark.asyncio
+async def test_cpu_bound_handlers_run_in_worker_processes(monkeypatch):
+    monkeypatch.setattr(nadoo_rpc_server, "rpc_process_workers", 2)
+    server = RPCServer(None)
+    server.register("factorial", math.factorial, cpu_bound=True)
+    try:
+        replies = await asyncio.gather(*(server.call(request("factorial", n, n)) for n in range(5)))
+    finally:
+        await server.close()
+    assert [reply["result"] for reply in replies] == [1, 1, 2, 6, 24]
+
+
+@pytest.mark.asyncio
+async def test_batch_email_is_answered_with_batched_replies(monkeypatch):
+    monkeypatch.setattr(nadoo_rpc_server, "reply_batch_count", 3)
+    sent = []
+
+    async def send_replies(to_email, replies):
+        sent.append((to_email, replies))
+        return True
+
+    server = RPCServer(send_replies)
+    server.register("echo", lambda data: data)
+    message = MIMEText(json.dumps([request("echo", n, n) for n in range(4)]), "plain", "utf-8")
+    message["From"] = "Client <client@example.com>"
+    await server.handle_message(message.as_bytes())
+    assert [len(replies) for _, replies in sent] == [3]  # The fourth waits for more
+    await server.close()
+    assert [len(replies) for _, replies in sent] == [3, 1]
+    assert {to_email for to_email, _ in sent} == {"client@example.com"}
+
+    # The calling side reads the reply emails as before
+    replies = []
+    for _, batch in sent:
+        replies += parse_rpc_replies(MIMEText(json.dumps(batch)).as_bytes())
+    assert [reply["result"] for reply in replies] == [0, 1, 2, 3]
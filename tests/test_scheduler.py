@@ -0,0 +1,43 @@
+import os
+import asyncio
+import pytest
+
+from nadoo_connect.nadoo_scheduler import *
+
+
+def test_backlogged_lanes_share_slots_by_weight():
+    scheduler = SendScheduler(
+        [Lane("rpc", 3, 100, priority=1), Lane("executions", 1, 100)]
+    )
+    picks = [scheduler.choose({"rpc": 0.1, "executions": 0.1}) for _ in range(8)]
+    assert picks.count("rpc") == 6
+    assert picks.count("executions") == 2
+
+
+def test_new_rpc_preempts_running_execution_backlog():
+    scheduler = create_default_scheduler()
+    for _ in range(5):
+        assert scheduler.choose({"rpc": None, "executions": 1}) == "executions"
+    assert scheduler.choose({"rpc": 0, "executions": 1}) == "rpc"
+
+
+def test_overdue_lane_takes_next_slot():
+    scheduler = SendScheduler([Lane("rpc", 10, 100), Lane("executions", 1, 5)])
+    assert scheduler.choose({"rpc": 1, "executions": 30}) == "executions"
+    assert scheduler.get_stats()["executions"]["slo_misses"] == 1
+
+
+def test_idle_lanes_choose_nothing():
+    assert create_default_scheduler().choose({"rpc": None, "executions": None}) is None
+
+
+@pytest.mark.asyncio
+async def test_wait_for_new_work_wakes_on_new_file(tmp_path):
+    async def stage_later():
+        await asyncio.sleep(0.1)
+        (tmp_path / "request.json").write_text("{}")
+
+    task = asyncio.create_task(stage_later())
+    assert await wait_for_new_work([str(tmp_path)], timeout=5, poll_interval=0.02)
+    await task
+    assert get_oldest_pending_age(str(tmp_path)) is not None
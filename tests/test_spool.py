@@ -0,0 +1,85 @@
+import os
+import json
+import pytest
+
+import nadoo_connect.nadoo_spool as spool
+from nadoo_connect.nadoo_spool import *
+
+
+@pytest.fixture
+def small_spool(tmp_path, monkeypatch):
+    monkeypatch.setattr(spool, "executions_dir", str(tmp_path / "executions"))
+    monkeypatch.setattr(spool, "overflow_dir", str(tmp_path / "overflow"))
+    monkeypatch.setattr(spool, "spool_max_records", 2)
+    monkeypatch.setattr(spool, "spool_depth_cache_ttl", 0)
+    os.makedirs(spool.executions_dir)
+    for index in range(2):
+        with open(os.path.join(spool.executions_dir, f"{index}.json"), "w") as file:
+            file.write("{}")
+    return tmp_path
+
+
+def test_get_spool_depth(small_spool):
+    depth = get_spool_depth()
+    assert depth["records"] == 2
+    assert depth["bytes"] == 4
+    assert depth["utilization"] == 1.0
+
+
+@pytest.mark.asyncio
+async def test_reject_policy_raises(small_spool):
+    with pytest.raises(SpoolFullError):
+        await reserve_spool_slot(2, policy="reject")
+
+
+@pytest.mark.asyncio
+async def test_block_policy_times_out(small_spool):
+    with pytest.raises(SpoolFullError):
+        await reserve_spool_slot(2, policy="block", timeout=0.05)
+
+
+@pytest.mark.asyncio
+async def test_spill_policy_aggregates_and_drains(small_spool):
+    assert await reserve_spool_slot(2, policy="spill") is False
+    for timestamp in ("2024-01-01 10:00:00.000000", "2024-01-01 11:00:00.000000"):
+        spill_execution_to_summary(
+            {"customer_program_uuid": "program_uuid", "timestamp": timestamp}
+        )
+    assert get_spool_depth()["overflow_summaries"] == 1
+
+    written = []
+    assert drain_overflow_summaries(written.append) == 0  # Spool still full
+
+    os.remove(os.path.join(spool.executions_dir, "0.json"))
+    assert drain_overflow_summaries(written.append) == 1
+    assert written[0]["execution_count"] == 2
+    assert written[0]["last_timestamp"] == "2024-01-01 11:00:00.000000"
+
+
+def test_cursor_drains_oldest_bucket_first(tmp_path):
+    directory = str(tmp_path)
+    for bucket, name in (("202401010001", "new"), ("202401010000", "old")):
+        os.makedirs(os.path.join(directory, bucket))
+        with open(os.path.join(directory, bucket, f"{name}.json"), "w") as file:
+            file.write("{}")
+
+    cursor = SpoolCursor(directory)
+    batch = cursor.next_batch(1)
+    assert [os.path.basename(path) for path in batch] == ["old.json"]
+    assert cursor.get_oldest_pending_age() > 0
+
+    os.remove(batch[0])
+    # The empty old bucket is removed and the next batch comes from the newer one
+    assert [os.path.basename(path) for path in cursor.next_batch(5)] == ["new.json"]
+    assert list_spool_buckets(directory) == ["202401010001"]
+
+
+def test_migrate_flat_spool(tmp_path):
+    directory = str(tmp_path)
+    with open(os.path.join(directory, "flat.json"), "w") as file:
+        json.dump({"timestamp": "2024-01-01 10:05:00.000000"}, file)
+
+    assert migrate_flat_spool(directory) == 1
+    assert list(iter_spool_files(directory)) == [
+        os.path.join(directory, "202401011005", "flat.json")
+    ]
@@ -0,0 +1,59 @@
+import asyncio
+import os
+import sqlite3
+
+import pytest
+
+from nadoo_connect.nadoo_storage import *
+
+
+def setup_items(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS items (name TEXT PRIMARY KEY)")
+
+
+def insert_item(conn, name):
+    conn.execute("INSERT INTO items (name) VALUES (?)", (name,))
+    return name
+
+
+def select_items(conn):
+    return sorted(row[0] for row in conn.execute("SELECT name FROM items"))
+
+
+@pytest.mark.asyncio
+async def test_queued_writes_share_transactions_and_fail_alone(tmp_path):
+    storage = StorageActor(str(tmp_path / "items.db"))
+    commits = []
+    storage.submit(lambda conn: conn.set_trace_callback(
+        lambda sql: commits.append(sql) if sql == "COMMIT" else None
+    ))
+    names = [f"item{n}" for n in range(200)] + ["item0"]  # The duplicate fails
+    results = await asyncio.gather(
+        *(storage.write(insert_item, name, setup=setup_items) for name in names),
+        return_exceptions=True,
+    )
+    assert results[:200] == names[:200]
+    assert isinstance(results[200], sqlite3.IntegrityError)
+    assert len(commits) < 20  # Batched, not one transaction per write
+    assert len(await storage.read(select_items)) == 200
+    storage.close()
+
+
+@pytest.mark.asyncio
+async def test_read_prepares_tables_and_sees_committed_writes(tmp_path):
+    storage = StorageActor(str(tmp_path / "items.db"))
+    assert await storage.read(select_items, setup=setup_items) == []
+    await storage.write(insert_item, "a")
+    assert await storage.read(select_items) == ["a"]
+    storage.close()
+
+
+@pytest.mark.asyncio
+async def test_replaced_database_is_reopened(tmp_path):
+    db_path = str(tmp_path / "items.db")
+    storage = get_storage(db_path)
+    assert get_storage(db_path) is storage
+    await storage.write(insert_item, "old", setup=setup_items)
+    os.remove(db_path)
+    await storage.write(insert_item, "new", setup=setup_items)
+    assert await storage.read(select_items) == ["new"]
@@ -0,0 +1,32 @@
+import random
+
+from nadoo_connect.nadoo_timers import *
+
+
+def test_timers_expire_at_their_tick_across_levels():
+    wheel = TimerWheel(tick=1.0, slots=8, levels=3, now=0)
+    deadlines = {f"t{n}": random.randint(1, 600) for n in range(500)}
+    for key, deadline in deadlines.items():
+        wheel.add(key, deadline)
+    wheel.add("cancelled", 5)
+    wheel.cancel("cancelled")
+    wheel.add("moved", 3)
+    wheel.add("moved", 50)  # Replaces the first timer
+
+    expired_at = {}
+    for now in range(1, 700):
+        for key in wheel.advance(now):
+            expired_at[key] = now
+    assert expired_at.pop("moved") == 50
+    assert expired_at == deadlines  # 8 * 8 * 8 = 512 < 600, so some wrap the top level
+    assert len(wheel) == 0
+
+
+def test_advance_catches_up_after_a_pause():
+    wheel = TimerWheel(now=1000)
+    wheel.add("soon", 1001)
+    wheel.add("later", 1000 + 3600)
+    wheel.add("overdue", 500)  # Due on the next tick
+    assert sorted(wheel.advance(1001)) == ["overdue", "soon"]
+    assert wheel.advance(1000 + 3599) == []
+    assert wheel.advance(1000 + 7200) == ["later"]
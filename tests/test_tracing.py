@@ -0,0 +1,46 @@
+import json
+import time
+
+import nadoo_connect.nadoo_tracing as nadoo_tracing
+from nadoo_connect.nadoo_tracing import *
+
+
+def test_rolling_histogram_percentiles():
+    histogram = RollingHistogram()
+    for _ in range(90):
+        histogram.record(0.01)
+    for _ in range(10):
+        histogram.record(2.0)
+    assert histogram.count() == 100
+    # Accurate to one bucket
+    assert 0.01 <= histogram.percentile(0.5) <= 0.01 * histogram_growth
+    assert 2.0 <= histogram.percentile(0.99) <= 2.0 * histogram_growth
+
+
+def test_rolling_histogram_forgets_old_windows():
+    histogram = RollingHistogram(window=0.05)
+    histogram.record(1.0)
+    time.sleep(0.06)
+    histogram.record(1.0)
+    assert histogram.count() == 2  # Previous window still counts
+    time.sleep(0.11)
+    assert histogram.count() == 0
+
+
+def test_batch_trace_records_every_stage(tmp_path, monkeypatch):
+    monkeypatch.setattr(nadoo_tracing, "stage_histograms", {})
+    path = tmp_path / "record.json"
+    path.write_text(json.dumps({"timestamp": "2024-01-01 10:00:00.000000"}))
+
+    record, created, spooled = read_traced_record(str(path))
+    assert created == parse_created_time("2024-01-01 10:00:00.000000")
+    trace = BatchTrace()
+    trace.add(created, spooled)
+    trace.mark_batched()
+    trace.mark_emailed()
+    trace.mark_recorded()
+
+    stats = get_stage_percentiles()
+    assert set(stats) == {"spool", "pickup", "smtp", "record", "total"}
+    assert all(entry["count"] == 1 for entry in stats.values())
+    assert stats["total"]["p99"] >= stats["smtp"]["p99"]